@@ -20,9 +20,10 @@ from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from qwen_agent.llm import get_chat_model
 from qwen_agent.llm.base import BaseChatModel
+from qwen_agent.llm.delta import MessageDumper
 from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, ContentItem, Message
 from qwen_agent.log import logger
-from qwen_agent.tools import TOOL_REGISTRY, BaseTool, MCPManager
+from qwen_agent.tools import TOOL_REGISTRY, BaseTool
 from qwen_agent.tools.base import ToolServiceError
 from qwen_agent.tools.simple_doc_parser import DocParserError
 from qwen_agent.utils.utils import has_chinese_messages, merge_generate_cfgs
@@ -121,6 +122,8 @@ class Agent(ABC):
                     new_messages[0][CONTENT] = [ContentItem(text=self.system_message + '\n\n')
                                                ] + new_messages[0][CONTENT]  # noqa
 
+        # Only the messages changed since the last chunk are converted to dicts
+        dumper = MessageDumper()
         for rsp in self._run(messages=new_messages, **kwargs):
             for i in range(len(rsp)):
                 if not rsp[i].name and self.name:
@@ -128,7 +131,7 @@ class Agent(ABC):
             if _return_message_type == 'message':
                 yield [Message(**x) if isinstance(x, dict) else x for x in rsp]
             else:
-                yield [x.model_dump() if not isinstance(x, dict) else x for x in rsp]
+                yield dumper.dump(rsp)
 
     @abstractmethod
     def _run(self, messages: List[Message], lang: str = 'en', **kwargs) -> Iterator[List[Message]]:
@@ -189,7 +192,7 @@ class Agent(ABC):
             return f'Tool {tool_name} does not exists.'
         tool = self.function_map[tool_name]
         try:
-            tool_result = tool.call(tool_args, **kwargs)
+            tool_result = tool.call_with_cache(tool_args, **kwargs)
         except (ToolServiceError, DocParserError) as ex:
             raise ex
         except Exception as ex:
@@ -216,6 +219,7 @@ class Agent(ABC):
                 logger.warning(f'Repeatedly adding tool {tool_name}, will use the newest tool in function list')
             self.function_map[tool_name] = tool
         elif isinstance(tool, dict) and 'mcpServers' in tool:
+            from qwen_agent.tools.mcp_manager import MCPManager
             tools = MCPManager().initConfig(tool)
             for tool in tools:
                 tool_name = tool.name
@@ -88,13 +88,15 @@ class Assistant(FnCallAgent):
                  name: Optional[str] = None,
                  description: Optional[str] = None,
                  files: Optional[List[str]] = None,
-                 rag_cfg: Optional[Dict] = None):
+                 rag_cfg: Optional[Dict] = None,
+                 max_tool_workers: Optional[int] = None):
         super().__init__(function_list=function_list,
                          llm=llm,
                          system_message=system_message,
                          name=name,
                          description=description,
                          files=files,
+                         max_tool_workers=max_tool_workers,
                          rag_cfg=rag_cfg)
 
     def _run(self,
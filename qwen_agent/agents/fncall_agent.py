@@ -13,14 +13,15 @@
 # limitations under the License.
 
 import copy
-from typing import Dict, Iterator, List, Literal, Optional, Union
+from typing import Dict, Iterator, List, Literal, Optional, Tuple, Union
 
 from qwen_agent import Agent
 from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import DEFAULT_SYSTEM_MESSAGE, FUNCTION, Message
 from qwen_agent.memory import Memory
-from qwen_agent.settings import MAX_LLM_CALL_PER_RUN
+from qwen_agent.settings import MAX_LLM_CALL_PER_RUN, MAX_TOOL_WORKERS
 from qwen_agent.tools import BaseTool
+from qwen_agent.utils.parallel_executor import parallel_exec_in_order
 from qwen_agent.utils.utils import extract_files_from_messages
 
 
@@ -34,6 +35,7 @@ class FnCallAgent(Agent):
                  name: Optional[str] = None,
                  description: Optional[str] = None,
                  files: Optional[List[str]] = None,
+                 max_tool_workers: Optional[int] = None,
                  **kwargs):
         """Initialization the agent.
 
@@ -46,12 +48,15 @@ class FnCallAgent(Agent):
             name: The name of this agent.
             description: The description of this agent, which will be used for multi_agent.
             files: A file url list. The initialized files for the agent.
+            max_tool_workers: The max number of parallel function calls run concurrently, 1 for sequential.
+              Defaults to the QWEN_AGENT_MAX_TOOL_WORKERS environment variable.
         """
         super().__init__(function_list=function_list,
                          llm=llm,
                          system_message=system_message,
                          name=name,
                          description=description)
+        self.max_tool_workers = max_tool_workers or MAX_TOOL_WORKERS
 
         if not hasattr(self, 'mem'):
             # Default to use Memory to manage files
@@ -83,31 +88,62 @@ class FnCallAgent(Agent):
             output_stream = self._call_llm(messages=messages,
                                            functions=[func.function for func in self.function_map.values()],
                                            extra_generate_cfg=extra_generate_cfg)
+            # The response list is updated in place, rather than copied for every chunk
+            num_done = len(response)
             output: List[Message] = []
             for output in output_stream:
                 if output:
-                    yield response + output
+                    response[num_done:] = output
+                    yield response
+            response[num_done:] = output
             if output:
-                response.extend(output)
                 messages.extend(output)
-                used_any_tool = False
+                tool_calls = []
                 for out in output:
                     use_tool, tool_name, tool_args, _ = self._detect_tool(out)
                     if use_tool:
-                        tool_result = self._call_tool(tool_name, tool_args, messages=messages, **kwargs)
-                        fn_msg = Message(
-                            role=FUNCTION,
-                            name=tool_name,
-                            content=tool_result,
-                        )
-                        messages.append(fn_msg)
-                        response.append(fn_msg)
-                        yield response
-                        used_any_tool = True
-                if not used_any_tool:
+                        tool_calls.append((tool_name, tool_args))
+                if not tool_calls:
                     break
+                for fn_msg in self._call_tools(tool_calls, messages=messages, **kwargs):
+                    messages.append(fn_msg)
+                    response.append(fn_msg)
+                    yield response
         yield response
 
+    def _call_tools(self, tool_calls: List[Tuple[str, Union[str, dict]]], messages: List[Message],
+                    **kwargs) -> Iterator[Message]:
+        """Call the tools requested by one LLM response, and yield the results in the order of the calls.
+
+        The calls run concurrently if `max_tool_workers` > 1, where each tool runs at most `tool.max_concurrency`
+        calls at a time. A result is yielded as soon as it and the results of all the calls before it are ready.
+        """
+        if (self.max_tool_workers <= 1) or (len(tool_calls) <= 1):
+            for tool_name, tool_args in tool_calls:
+                # The messages include the results of the previous calls, which are appended by the caller.
+                tool_result = self._call_tool(tool_name, tool_args, messages=messages, **kwargs)
+                yield Message(role=FUNCTION, name=tool_name, content=tool_result)
+            return
+
+        # All the concurrent calls see the same messages, i.e., those up to the LLM response.
+        messages = list(messages)
+        list_of_kwargs = [
+            dict(tool_name=tool_name, tool_args=tool_args, messages=messages, **kwargs)
+            for tool_name, tool_args in tool_calls
+        ]
+        max_workers_per_group = {
+            tool_name: tool.max_concurrency
+            for tool_name, tool in self.function_map.items()
+            if tool.max_concurrency is not None
+        }
+        tool_results = parallel_exec_in_order(self._call_tool,
+                                              list_of_kwargs,
+                                              max_workers=min(self.max_tool_workers, len(tool_calls)),
+                                              groups=[tool_name for tool_name, _ in tool_calls],
+                                              max_workers_per_group=max_workers_per_group)
+        for (tool_name, _), tool_result in zip(tool_calls, tool_results):
+            yield Message(role=FUNCTION, name=tool_name, content=tool_result)
+
     def _call_tool(self, tool_name: str, tool_args: Union[str, dict] = '{}', **kwargs) -> str:
         if tool_name not in self.function_map:
             return f'Tool {tool_name} does not exists.'
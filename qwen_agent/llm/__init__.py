@@ -13,18 +13,31 @@
 # limitations under the License.
 
 import copy
+import importlib
 from typing import Union
 
-from .azure import TextChatAtAzure
 from .base import LLM_REGISTRY, BaseChatModel, ModelServiceError
-from .oai import TextChatAtOAI
-from .openvino import OpenVINO
-from .transformers_llm import Transformers
-from .qwen_dashscope import QwenChatAtDS
-from .qwenaudio_dashscope import QwenAudioChatAtDS
-from .qwenomni_oai import QwenOmniChatAtOAI
-from .qwenvl_dashscope import QwenVLChatAtDS
-from .qwenvl_oai import QwenVLChatAtOAI
+
+# The backends are imported on first access, since they pull in SDKs such as openai and dashscope.
+_LAZY_IMPORTS = {
+    'TextChatAtAzure': 'qwen_agent.llm.azure',
+    'TextChatAtOAI': 'qwen_agent.llm.oai',
+    'OpenVINO': 'qwen_agent.llm.openvino',
+    'Transformers': 'qwen_agent.llm.transformers_llm',
+    'QwenChatAtDS': 'qwen_agent.llm.qwen_dashscope',
+    'QwenAudioChatAtDS': 'qwen_agent.llm.qwenaudio_dashscope',
+    'QwenOmniChatAtOAI': 'qwen_agent.llm.qwenomni_oai',
+    'QwenVLChatAtDS': 'qwen_agent.llm.qwenvl_dashscope',
+    'QwenVLChatAtOAI': 'qwen_agent.llm.qwenvl_oai',
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_IMPORTS:
+        value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
@@ -18,7 +18,7 @@ from typing import Dict, Optional
 import openai
 
 from qwen_agent.llm.base import register_llm
-from qwen_agent.llm.oai import TextChatAtOAI
+from qwen_agent.llm.oai import TextChatAtOAI, get_async_openai_client, get_openai_client
 
 
 @register_llm('azure')
@@ -47,9 +47,19 @@ class TextChatAtAzure(TextChatAtOAI):
             api_kwargs['api_key'] = api_key
         if api_version:
             api_kwargs['api_version'] = api_version
+        if cfg.get('timeout') is not None:
+            api_kwargs['timeout'] = cfg['timeout']
+        http_client_cfg = cfg.get('http_client_cfg')
 
         def _chat_complete_create(*args, **kwargs):
-            client = openai.AzureOpenAI(**api_kwargs)
+            client = get_openai_client(client_cls=openai.AzureOpenAI, http_client_cfg=http_client_cfg, **api_kwargs)
             return client.chat.completions.create(*args, **kwargs)
 
+        async def _achat_complete_create(*args, **kwargs):
+            client = get_async_openai_client(client_cls=openai.AsyncAzureOpenAI,
+                                             http_client_cfg=http_client_cfg,
+                                             **api_kwargs)
+            return await client.chat.completions.create(*args, **kwargs)
+
         self._chat_complete_create = _chat_complete_create
+        self._achat_complete_create = _achat_complete_create
@@ -12,29 +12,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import copy
-import json
-import os
+import functools
+import hashlib
 import random
+import re
+import threading
 import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from pprint import pformat
-from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
-
-from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, SYSTEM, USER, FUNCTION, Message
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union
+
+from qwen_agent.llm.cache import (BaseLLMCache, CacheEntry, LLMCache, StreamRecorder, areplay_cache_entry,
+                                  get_cache_key, replay_cache_entry)
+from qwen_agent.llm.delta import (AsyncDeltaStream, DeltaStream, MessageDelta, MessageDumper, MessageMemo,
+                                  aiter_chunk_deltas, aiter_deltas, aiter_message_deltas, iter_chunk_deltas,
+                                  iter_deltas, iter_message_deltas)
+from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, FUNCTION, SYSTEM, USER, ContentItem, Message
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_INPUT_TOKENS
+from qwen_agent.settings import DEFAULT_MAX_INPUT_TOKENS, TOKEN_COUNT_CACHE_SIZE
+from qwen_agent.utils.lazy_registry import LazyRegistry
 from qwen_agent.utils.tokenization_qwen import tokenizer
 from qwen_agent.utils.utils import (extract_text_from_message, format_as_multimodal_message, format_as_text_message,
-                                    has_chinese_messages, json_dumps_compact, merge_generate_cfgs, print_traceback)
-
-LLM_REGISTRY = {}
+                                    has_chinese_messages, merge_generate_cfgs)
+
+# The built-in backends are imported on their first lookup, e.g., LLM_REGISTRY['oai'].
+LLM_REGISTRY = LazyRegistry({
+    'azure': 'qwen_agent.llm.azure',
+    'oai': 'qwen_agent.llm.oai',
+    'openvino': 'qwen_agent.llm.openvino',
+    'qwen_dashscope': 'qwen_agent.llm.qwen_dashscope',
+    'qwenaudio_dashscope': 'qwen_agent.llm.qwenaudio_dashscope',
+    'qwenomni_oai': 'qwen_agent.llm.qwenomni_oai',
+    'qwenvl_dashscope': 'qwen_agent.llm.qwenvl_dashscope',
+    'qwenvl_oai': 'qwen_agent.llm.qwenvl_oai',
+    'transformers': 'qwen_agent.llm.transformers_llm',
+})
 
 
 def register_llm(model_type):
 
     def decorator(cls):
-        LLM_REGISTRY[model_type] = cls
+        # A custom backend registered before the built-in one of the same model_type is imported takes precedence
+        if not LLM_REGISTRY.is_overridden(model_type, cls):
+            LLM_REGISTRY[model_type] = cls
         return cls
 
     return decorator
@@ -79,24 +102,22 @@ class BaseChatModel(ABC):
         self.model = cfg.get('model', '').strip()
         generate_cfg = copy.deepcopy(cfg.get('generate_cfg', {}))
         cache_dir = cfg.get('cache_dir', generate_cfg.pop('cache_dir', None))
+        cache_cfg = cfg.get('cache_cfg', generate_cfg.pop('cache_cfg', None))
         self.max_retries = generate_cfg.pop('max_retries', 0)
         self.generate_cfg = generate_cfg
         self.model_type = cfg.get('model_type', '')
         if 'dashscope' in self.model_type:
             self.generate_cfg['incremental_output'] = True
 
-        if cache_dir:
-            try:
-                import diskcache
-            except ImportError:
-                print_traceback(is_error=False)
-                logger.warning('Caching disabled because diskcache is not installed. Please `pip install diskcache`.')
-                cache_dir = None
-        if cache_dir:
-            os.makedirs(cache_dir, exist_ok=True)
-            self.cache = diskcache.Cache(directory=cache_dir)
+        # The response cache. A custom cache can be plugged in by assigning a BaseLLMCache object to `self.cache`.
+        if cache_dir or cache_cfg:
+            self.cache: Optional[BaseLLMCache] = LLMCache(cache_dir=cache_dir, **(cache_cfg or {}))
         else:
-            self.cache = None
+            self.cache: Optional[BaseLLMCache] = None
+
+        # The token counts of the input messages, reused by the truncation of later calls, e.g., the later
+        # iterations of an agent's tool-calling loop, where the history grows but its messages stay unchanged.
+        self.token_counter = MessageTokenCounter()
 
     def quick_chat(self, prompt: str) -> str:
         *_, responses = self.chat(messages=[Message(role=USER, content=prompt)])
@@ -128,6 +149,182 @@ class BaseChatModel(ABC):
             the generated message list response by llm.
         """
 
+        messages, _return_message_type = self._unify_input_messages(messages)
+
+        # Cache lookup:
+        cache_key, cache_entry = self._lookup_cache(messages, functions, extra_generate_cfg, stream, delta_stream)
+        if cache_entry:
+            if stream:
+                return self._convert_messages_iterator_to_target_type(
+                    replay_cache_entry(cache_entry, replay_timing=getattr(self.cache, 'replay_timing', False)),
+                    _return_message_type)
+            return self._convert_messages_to_target_type(copy.deepcopy(cache_entry['output']), _return_message_type)
+
+        messages, generate_cfg, fncall_mode, lang = self._prepare_chat_inputs(
+            messages,
+            functions=functions,
+            stream=stream,
+            delta_stream=delta_stream,
+            extra_generate_cfg=extra_generate_cfg,
+        )
+
+        def _call_model_service():
+            if fncall_mode:
+                return self._chat_with_functions(
+                    messages=messages,
+                    functions=functions,
+                    stream=stream,
+                    delta_stream=delta_stream,
+                    generate_cfg=generate_cfg,
+                    lang=lang,
+                )
+            else:
+                # TODO: Optimize code structure
+                if messages[-1].role == ASSISTANT:
+                    assert not delta_stream, 'Continuation mode does not currently support `delta_stream`'
+                    return self._continue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
+                else:
+                    return self._chat(
+                        messages,
+                        stream=stream,
+                        delta_stream=delta_stream,
+                        generate_cfg=generate_cfg,
+                    )
+
+        if stream and delta_stream:
+            # No retry for delta streaming
+            output = DeltaStream(iter_chunk_deltas(_call_model_service()))
+        elif stream and (not delta_stream):
+            # A retry restarts the deltas from the first message, which replaces all that has been streamed.
+            output = DeltaStream(
+                retry_model_service_iterator(lambda: iter_deltas(_call_model_service()), max_retries=self.max_retries))
+        else:
+            output = retry_model_service(_call_model_service, max_retries=self.max_retries)
+
+        if isinstance(output, list):
+            assert not stream
+            return self._finalize_output(output, fncall_mode, generate_cfg, cache_key, _return_message_type)
+        else:
+            assert stream
+            generate_cfg = self._get_stream_postproc_cfg(generate_cfg, delta_stream=delta_stream)
+            output = self._postprocess_messages_iterator(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+
+            def _format_and_cache() -> Iterator[List[Message]]:
+                recorder = self._get_stream_recorder(delta_stream)
+                text_formatter = MessageMemo(_format_as_text_message)
+                for o in output:
+                    if o:
+                        if not self.support_multimodal_output:
+                            o = text_formatter.map(o)
+                        if recorder:
+                            recorder.add(o)
+                        yield o
+                self._save_stream_to_cache(cache_key, recorder)
+
+            return self._convert_messages_iterator_to_target_type(_format_and_cache(), _return_message_type)
+
+    async def achat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]] = None,
+        stream: bool = True,
+        delta_stream: bool = False,
+        extra_generate_cfg: Optional[Dict] = None,
+    ) -> Union[List[Message], List[Dict], AsyncIterator[List[Message]], AsyncIterator[List[Dict]]]:
+        """The asyncio version of the LLM chat interface.
+
+        It shares the preprocessing, truncation, caching and postprocessing pipeline with `chat`.
+        Backends that implement `_achat_stream` and `_achat_no_stream` natively serve the request
+        within the event loop, while the others fall back to running `chat` backends in worker threads.
+
+        Args:
+            The same as `chat`.
+
+        Returns:
+            When stream=False, the generated message list.
+            When stream=True, an async iterator of the generated message lists, which can be consumed by
+              `async for rsp in await llm.achat(messages): ...`.
+        """
+        messages, _return_message_type = self._unify_input_messages(messages)
+
+        # Cache lookup:
+        cache_key, cache_entry = self._lookup_cache(messages, functions, extra_generate_cfg, stream, delta_stream)
+        if cache_entry:
+            if stream:
+                return self._aconvert_messages_iterator_to_target_type(
+                    areplay_cache_entry(cache_entry, replay_timing=getattr(self.cache, 'replay_timing', False)),
+                    _return_message_type)
+            return self._convert_messages_to_target_type(copy.deepcopy(cache_entry['output']), _return_message_type)
+
+        messages, generate_cfg, fncall_mode, lang = self._prepare_chat_inputs(
+            messages,
+            functions=functions,
+            stream=stream,
+            delta_stream=delta_stream,
+            extra_generate_cfg=extra_generate_cfg,
+        )
+
+        async def _call_model_service():
+            if fncall_mode:
+                return await self._achat_with_functions(
+                    messages=messages,
+                    functions=functions,
+                    stream=stream,
+                    delta_stream=delta_stream,
+                    generate_cfg=generate_cfg,
+                    lang=lang,
+                )
+            else:
+                if messages[-1].role == ASSISTANT:
+                    assert not delta_stream, 'Continuation mode does not currently support `delta_stream`'
+                    return await self._acontinue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
+                else:
+                    return await self._achat(
+                        messages,
+                        stream=stream,
+                        delta_stream=delta_stream,
+                        generate_cfg=generate_cfg,
+                    )
+
+        async def _call_model_service_for_deltas():
+            return aiter_deltas(await _call_model_service())
+
+        if stream and delta_stream:
+            # No retry for delta streaming
+            output = AsyncDeltaStream(aiter_chunk_deltas(await _call_model_service()))
+        elif stream and (not delta_stream):
+            # A retry restarts the deltas from the first message, which replaces all that has been streamed.
+            output = AsyncDeltaStream(
+                aretry_model_service_iterator(_call_model_service_for_deltas, max_retries=self.max_retries))
+        else:
+            output = await aretry_model_service(_call_model_service, max_retries=self.max_retries)
+
+        if isinstance(output, list):
+            assert not stream
+            return self._finalize_output(output, fncall_mode, generate_cfg, cache_key, _return_message_type)
+        else:
+            assert stream
+            generate_cfg = self._get_stream_postproc_cfg(generate_cfg, delta_stream=delta_stream)
+
+            async def _postprocess_format_and_cache() -> AsyncIterator[List[Message]]:
+                recorder = self._get_stream_recorder(delta_stream)
+                text_formatter = MessageMemo(_format_as_text_message)
+                postprocess_chunk = self._get_stream_postprocessor(fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+                async for o, deltas in aiter_message_deltas(output):
+                    o = postprocess_chunk(o, deltas)
+                    if o:
+                        if not self.support_multimodal_output:
+                            o = text_formatter.map(o)
+                        if recorder:
+                            recorder.add(o)
+                        yield o
+                self._save_stream_to_cache(cache_key, recorder)
+
+            return self._aconvert_messages_iterator_to_target_type(_postprocess_format_and_cache(),
+                                                                   _return_message_type)
+
+    @staticmethod
+    def _unify_input_messages(messages: List[Union[Message, Dict]]) -> Tuple[List[Message], str]:
         # Unify the input messages to type List[Message]:
         messages = copy.deepcopy(messages)
         _return_message_type = 'dict'
@@ -142,20 +339,44 @@ class BaseChatModel(ABC):
 
         if not messages:
             raise ValueError("Messages can not be empty.")
+        return messages, _return_message_type
 
-        # Cache lookup:
-        if self.cache is not None:
-            cache_key = dict(messages=messages, functions=functions, extra_generate_cfg=extra_generate_cfg)
-            cache_key: str = json_dumps_compact(cache_key, sort_keys=True)
-            cache_value: str = self.cache.get(cache_key)
-            if cache_value:
-                cache_value: List[dict] = json.loads(cache_value)
-                if _return_message_type == 'message':
-                    cache_value: List[Message] = [Message(**m) for m in cache_value]
-                if stream:
-                    cache_value: Iterator[List[Union[Message, dict]]] = iter([cache_value])
-                return cache_value
-
+    def _lookup_cache(
+        self,
+        messages: List[Message],
+        functions: Optional[List[Dict]],
+        extra_generate_cfg: Optional[Dict],
+        stream: bool,
+        delta_stream: bool,
+    ) -> Tuple[Optional[str], Optional[CacheEntry]]:
+        if self.cache is None:
+            return None, None
+        # Delta streams are cached separately, since their chunks can not be replayed as full responses.
+        cache_key = get_cache_key(messages=messages,
+                                  functions=functions,
+                                  extra_generate_cfg=extra_generate_cfg,
+                                  delta_stream=bool(stream and delta_stream))
+        return cache_key, self.cache.get(cache_key)
+
+    def _get_stream_recorder(self, delta_stream: bool) -> Optional[StreamRecorder]:
+        if self.cache is None:
+            return None
+        return StreamRecorder(delta_stream=delta_stream, max_chunks=getattr(self.cache, 'max_replay_chunks', 64))
+
+    def _save_stream_to_cache(self, cache_key: Optional[str], recorder: Optional[StreamRecorder]):
+        if (self.cache is not None) and recorder:
+            entry = recorder.to_entry()
+            if entry:
+                self.cache.set(cache_key, entry)
+
+    def _prepare_chat_inputs(
+        self,
+        messages: List[Message],
+        functions: Optional[List[Dict]],
+        stream: bool,
+        delta_stream: bool,
+        extra_generate_cfg: Optional[Dict],
+    ) -> Tuple[List[Message], dict, bool, Literal['en', 'zh']]:
         if stream and delta_stream:
             logger.warning(
                 'Support for `delta_stream=True` is deprecated. '
@@ -182,6 +403,7 @@ class BaseChatModel(ABC):
             messages = _truncate_input_messages_roughly(
                 messages=messages,
                 max_tokens=max_input_tokens,
+                token_counter=self.token_counter,
             )
 
         if functions:
@@ -208,67 +430,33 @@ class BaseChatModel(ABC):
                 if k in generate_cfg:
                     del generate_cfg[k]
 
-        def _call_model_service():
-            if fncall_mode:
-                return self._chat_with_functions(
-                    messages=messages,
-                    functions=functions,
-                    stream=stream,
-                    delta_stream=delta_stream,
-                    generate_cfg=generate_cfg,
-                    lang=lang,
-                )
-            else:
-                # TODO: Optimize code structure
-                if messages[-1].role == ASSISTANT:
-                    assert not delta_stream, 'Continuation mode does not currently support `delta_stream`'
-                    return self._continue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
-                else:
-                    return self._chat(
-                        messages,
-                        stream=stream,
-                        delta_stream=delta_stream,
-                        generate_cfg=generate_cfg,
-                    )
-
-        if stream and delta_stream:
-            # No retry for delta streaming
-            output = _call_model_service()
-        elif stream and (not delta_stream):
-            output = retry_model_service_iterator(_call_model_service, max_retries=self.max_retries)
-        else:
-            output = retry_model_service(_call_model_service, max_retries=self.max_retries)
-
-        if isinstance(output, list):
-            assert not stream
-            logger.debug(f'LLM Output:\n{pformat([_.model_dump() for _ in output], indent=2)}')
-            output = self._postprocess_messages(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
-            if not self.support_multimodal_output:
-                output = _format_as_text_messages(messages=output)
-            if self.cache:
-                self.cache.set(cache_key, json_dumps_compact(output))
-            return self._convert_messages_to_target_type(output, _return_message_type)
-        else:
-            assert stream
-            if delta_stream:
-                # Hack: To avoid potential errors during the postprocessing of stop words when delta_stream=True.
-                # Man, we should never have implemented the support for `delta_stream=True` in the first place!
-                generate_cfg = copy.deepcopy(generate_cfg)  # copy to avoid conflicts with `_call_model_service`
-                assert 'skip_stopword_postproc' not in generate_cfg
-                generate_cfg['skip_stopword_postproc'] = True
-            output = self._postprocess_messages_iterator(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
-
-            def _format_and_cache() -> Iterator[List[Message]]:
-                o = []
-                for o in output:
-                    if o:
-                        if not self.support_multimodal_output:
-                            o = _format_as_text_messages(messages=o)
-                        yield o
-                if o and (self.cache is not None):
-                    self.cache.set(cache_key, json_dumps_compact(o))
+        return messages, generate_cfg, fncall_mode, lang
 
-            return self._convert_messages_iterator_to_target_type(_format_and_cache(), _return_message_type)
+    def _finalize_output(
+        self,
+        output: List[Message],
+        fncall_mode: bool,
+        generate_cfg: dict,
+        cache_key: Optional[str],
+        return_message_type: str,
+    ) -> Union[List[Message], List[Dict]]:
+        logger.debug(f'LLM Output:\n{pformat([_.model_dump() for _ in output], indent=2)}')
+        output = self._postprocess_messages(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        if not self.support_multimodal_output:
+            output = _format_as_text_messages(messages=output)
+        if self.cache is not None:
+            self.cache.set(cache_key, {'output': [m.model_dump() for m in output], 'chunks': None})
+        return self._convert_messages_to_target_type(output, return_message_type)
+
+    @staticmethod
+    def _get_stream_postproc_cfg(generate_cfg: dict, delta_stream: bool) -> dict:
+        if delta_stream:
+            # Hack: To avoid potential errors during the postprocessing of stop words when delta_stream=True.
+            # Man, we should never have implemented the support for `delta_stream=True` in the first place!
+            generate_cfg = copy.deepcopy(generate_cfg)  # copy to avoid conflicts with `_call_model_service`
+            assert 'skip_stopword_postproc' not in generate_cfg
+            generate_cfg['skip_stopword_postproc'] = True
+        return generate_cfg
 
     def _chat(
         self,
@@ -319,6 +507,66 @@ class BaseChatModel(ABC):
     ) -> List[Message]:
         raise NotImplementedError
 
+    async def _achat(
+        self,
+        messages: List[Union[Message, Dict]],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        if stream:
+            return self._achat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+        else:
+            return await self._achat_no_stream(messages, generate_cfg=generate_cfg)
+
+    async def _achat_with_functions(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: List[Dict],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        # Fall back to the synchronous implementation if the backend has no native async support.
+        output = await _run_in_thread(self._chat_with_functions,
+                                      messages=messages,
+                                      functions=functions,
+                                      stream=stream,
+                                      delta_stream=delta_stream,
+                                      generate_cfg=generate_cfg,
+                                      lang=lang)
+        return output if isinstance(output, list) else _async_stream_in_thread(output)
+
+    async def _acontinue_assistant_response(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+        stream: bool,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        output = await _run_in_thread(self._continue_assistant_response,
+                                      messages,
+                                      generate_cfg=generate_cfg,
+                                      stream=stream)
+        return output if isinstance(output, list) else _async_stream_in_thread(output)
+
+    def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        # Backends with async clients should override this to avoid occupying a worker thread per stream.
+        return _async_stream_in_thread(self._chat_stream(messages, delta_stream=delta_stream,
+                                                         generate_cfg=generate_cfg))
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        return await _run_in_thread(self._chat_no_stream, messages, generate_cfg=generate_cfg)
+
     def _preprocess_messages(
         self,
         messages: List[Message],
@@ -346,16 +594,26 @@ class BaseChatModel(ABC):
         messages: List[Message],
         fncall_mode: bool,
         generate_cfg: dict,
+        stream_state: Optional[dict] = None,
     ) -> List[Message]:
-        messages = [
-            format_as_multimodal_message(msg,
-                                         add_upload_info=False,
-                                         add_multimodel_upload_info=False,
-                                         add_audio_upload_info=False) for msg in messages
-        ]
+        """Postprocess the model output, or a chunk of it if streaming.
+
+        When streaming, the same `stream_state` dict is passed for all chunks of the response, so that the
+        postprocessing steps can keep their state across chunks and process the output incrementally.
+        """
+        if stream_state is None:
+            messages = [_format_as_multimodal_output(msg) for msg in messages]
+        else:
+            # Only the messages changed since the last chunk are formatted again
+            messages = stream_state.setdefault('multimodal', MessageMemo(_format_as_multimodal_output)).map(messages)
         if not generate_cfg.get('skip_stopword_postproc', False):
             stop = generate_cfg.get('stop', [])
-            messages = _postprocess_stop_words(messages, stop=stop)
+            matcher = None
+            if stream_state is not None:
+                matcher = stream_state.get('stop_word_matcher')
+                if matcher is None:
+                    matcher = stream_state['stop_word_matcher'] = StopWordMatcher(stop)
+            messages = _postprocess_stop_words(messages, stop=stop, matcher=matcher)
         return messages
 
     def _postprocess_messages_iterator(
@@ -365,10 +623,39 @@ class BaseChatModel(ABC):
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
         pre_msg = []
-        for pre_msg in messages:
-            yield self._postprocess_messages(pre_msg, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        postprocess_chunk = self._get_stream_postprocessor(fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        for pre_msg, deltas in iter_message_deltas(messages):
+            yield postprocess_chunk(pre_msg, deltas)
         logger.debug(f'LLM Output:\n{pformat([_.model_dump() for _ in pre_msg], indent=2)}')
 
+    def _get_stream_postprocessor(
+        self,
+        fncall_mode: bool,
+        generate_cfg: dict,
+    ) -> Callable[[List[Message], List[MessageDelta]], List[Message]]:
+        """Get a stateful function that postprocesses the chunks of one streamed response.
+
+        The function receives each changed chunk (i.e., the full message list) together with its deltas, so that
+        subclasses can keep state across chunks and only process the newly generated part.
+        By default, the chunks are passed to `_postprocess_messages` with a state dict shared by the whole stream.
+        """
+        stream_state = {}
+
+        def _postprocess_chunk(messages: List[Message], deltas: List[MessageDelta]) -> List[Message]:
+            stop_word_matcher = stream_state.get('stop_word_matcher')
+            if stop_word_matcher is not None:
+                replaced = [d.index for d in deltas if d.replace]
+                if replaced:
+                    # Texts that are not simply appended to must be rescanned from the start.
+                    min_replaced = min(replaced)
+                    stop_word_matcher.reset(lambda key: key[0] >= min_replaced)
+            return self._postprocess_messages(messages,
+                                              fncall_mode=fncall_mode,
+                                              generate_cfg=generate_cfg,
+                                              stream_state=stream_state)
+
+        return _postprocess_chunk
+
     def _convert_messages_to_target_type(self, messages: List[Message],
                                          target_type: str) -> Union[List[Message], List[Dict]]:
         if target_type == 'message':
@@ -381,8 +668,22 @@ class BaseChatModel(ABC):
     def _convert_messages_iterator_to_target_type(
             self, messages_iter: Iterator[List[Message]],
             target_type: str) -> Union[Iterator[List[Message]], Iterator[List[Dict]]]:
+        dumper = MessageDumper()
         for messages in messages_iter:
-            yield self._convert_messages_to_target_type(messages, target_type)
+            if target_type == 'dict':
+                yield dumper.dump(messages)
+            else:
+                yield self._convert_messages_to_target_type(messages, target_type)
+
+    async def _aconvert_messages_iterator_to_target_type(
+            self, messages_iter: AsyncIterator[List[Message]],
+            target_type: str) -> Union[AsyncIterator[List[Message]], AsyncIterator[List[Dict]]]:
+        dumper = MessageDumper()
+        async for messages in messages_iter:
+            if target_type == 'dict':
+                yield dumper.dump(messages)
+            else:
+                yield self._convert_messages_to_target_type(messages, target_type)
 
     def quick_chat_oai(self, messages: List[dict], tools: Optional[list] = None) -> dict:
         """
@@ -462,32 +763,114 @@ class BaseChatModel(ABC):
 
 
 def _format_as_text_messages(messages: List[Message]) -> List[Message]:
-    for msg in messages:
-        if isinstance(msg.content, list):
-            for item in msg.content:
-                assert item.type == 'text'
+    return [_format_as_text_message(msg) for msg in messages]
+
+
+def _format_as_text_message(msg: Message) -> Message:
+    if isinstance(msg.content, list):
+        for item in msg.content:
+            assert item.type == 'text'
+    else:
+        assert isinstance(msg.content, str)
+    return format_as_text_message(msg, add_upload_info=False)
+
+
+def _format_as_multimodal_output(msg: Message) -> Message:
+    return format_as_multimodal_message(msg,
+                                        add_upload_info=False,
+                                        add_multimodel_upload_info=False,
+                                        add_audio_upload_info=False)
+
+
+class StopWordMatcher:
+    """Find stop words in texts that grow chunk by chunk.
+
+    The stop words are compiled once into a single regex, and the partial stop words are prepared once, so that
+    a streamed response does not repeat this work for every chunk. The matcher also remembers, for each text (as
+    identified by a key), how far it has been scanned, so that the next chunk only rescans the newly appended part.
+    """
+
+    def __init__(self, stop: List[str]):
+        self.stop = list(stop)
+        if self.stop:
+            # Python regexes return the leftmost match, which is where the first stop word starts.
+            alternatives = sorted(set(self.stop), key=len, reverse=True)
+            self._pattern = re.compile('|'.join(re.escape(s) for s in alternatives))
+            self._max_len = max(len(s) for s in self.stop)
         else:
-            assert isinstance(msg.content, str)
-    messages = [format_as_text_message(msg, add_upload_info=False) for msg in messages]
-    return messages
+            self._pattern = None
+            self._max_len = 0
+        self.partial_stop = _get_partial_stop_words(tuple(self.stop))
+        self._scanned: Dict[Any, int] = {}
 
+    def find(self, text: str, key: Any = None) -> int:
+        """Return the start of the first stop word in the text, or -1 if not found.
+
+        If a key is given, the text is assumed to be an extension of the text previously seen under the same key,
+        and only the part that may contain new stop words is rescanned. Call `reset` if this does not hold.
+        """
+        if self._pattern is None:
+            return -1
+        start = self._scanned.get(key, 0) if (key is not None) else 0
+        if start > len(text):
+            start = 0
+        m = self._pattern.search(text, max(start - self._max_len + 1, 0))
+        k = m.start() if m else -1
+        if key is not None:
+            self._scanned[key] = len(text) if (k < 0) else k
+        return k
+
+    def strip_partial_stop_word(self, text: str) -> str:
+        """Remove the partial stop word at the end, e.g., 'Observation' when the stop word is 'Observation:'."""
+        stripped = text
+        for s in self.partial_stop:
+            if text.endswith(s):
+                stripped = text[:-len(s)]
+        return stripped
+
+    def reset(self, key_filter: Optional[Callable[[Any], bool]] = None):
+        """Forget the scanned progress of the texts whose keys pass the filter, or of all texts if no filter."""
+        if key_filter is None:
+            self._scanned.clear()
+        else:
+            self._scanned = {k: v for k, v in self._scanned.items() if not key_filter(k)}
+
+
+@functools.lru_cache(maxsize=128)
+def _get_partial_stop_words(stop: Tuple[str, ...]) -> Tuple[str, ...]:
+    # It may ends with partial stopword 'Observation' when the full stopword is 'Observation:'.
+    partial_stop = []
+    for s in stop:
+        s = tokenizer.tokenize(s)[:-1]
+        if s:
+            s = tokenizer.convert_tokens_to_string(s)
+            partial_stop.append(s)
+    return tuple(sorted(set(partial_stop)))
 
-def _postprocess_stop_words(messages: List[Message], stop: List[str]) -> List[Message]:
-    messages = copy.deepcopy(messages)
+
+def _postprocess_stop_words(messages: List[Message],
+                            stop: List[str],
+                            matcher: Optional[StopWordMatcher] = None) -> List[Message]:
+    if matcher is None:
+        matcher = StopWordMatcher(stop)
 
     # Make sure it stops before stop words.
+    # The input messages are left intact. Only the truncated items and messages are replaced with new objects.
     trunc_messages = []
-    for msg in messages:
+    for i, msg in enumerate(messages):
         truncated = False
         trunc_content = []
-        for i, item in enumerate(msg.content):
-            item_type, item_text = item.get_type_and_value()
-            if item_type == 'text':
-                truncated, item.text = _truncate_at_stop_word(text=item_text, stop=stop)
+        for j, item in enumerate(msg.content):
+            if item.text is not None:
+                k = matcher.find(item.text, key=(i, j))
+                if k >= 0:
+                    truncated = True
+                    item = ContentItem(text=item.text[:k])
             trunc_content.append(item)
             if truncated:
                 break
-        msg.content = trunc_content
+        if truncated:
+            msg = msg.model_copy(update={'content': trunc_content})
         trunc_messages.append(msg)
         if truncated:
             break
@@ -495,36 +878,63 @@ def _postprocess_stop_words(messages: List[Message], stop: List[str]) -> List[Me
 
     # It may ends with partial stopword 'Observation' when the full stopword is 'Observation:'.
     # The following post-processing step removes partial stop words.
-    partial_stop = []
-    for s in stop:
-        s = tokenizer.tokenize(s)[:-1]
-        if s:
-            s = tokenizer.convert_tokens_to_string(s)
-            partial_stop.append(s)
-    partial_stop = sorted(set(partial_stop))
-    last_msg = messages[-1].content
-    for i in range(len(last_msg) - 1, -1, -1):
-        item_type, item_text = last_msg[i].get_type_and_value()
-        if item_type == 'text':
-            for s in partial_stop:
-                if item_text.endswith(s):
-                    last_msg[i].text = item_text[:-len(s)]
-            break
+    if matcher.partial_stop:
+        last_msg = messages[-1].content
+        for j in range(len(last_msg) - 1, -1, -1):
+            item_text = last_msg[j].text
+            if item_text is not None:
+                stripped = matcher.strip_partial_stop_word(item_text)
+                if stripped != item_text:
+                    new_content = list(last_msg)
+                    new_content[j] = ContentItem(text=stripped)
+                    messages[-1] = messages[-1].model_copy(update={'content': new_content})
+                break
 
     return messages
 
 
-def _truncate_at_stop_word(text: str, stop: List[str]):
-    truncated = False
-    for s in stop:
-        k = text.find(s)
-        if k >= 0:
-            truncated = True
-            text = text[:k]
-    return truncated, text
-
-
-def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -> List[Message]:
+class MessageTokenCounter:
+    """Counts the tokens of messages, and memoizes the counts in an LRU cache.
+
+    The counts are keyed by the tokenizer and the digest of the message text, so that a message is recognized
+    after being copied or rebuilt from a dict, which `chat` does to every input message. The texts are encoded
+    directly on misses, bypassing the memo of `tokenizer.count_tokens`, so that each text is hashed only once.
+    """
+
+    def __init__(self, maxsize: int = TOKEN_COUNT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.tokenizer = tokenizer
+        self.tokenizer_id = repr(
+            (type(tokenizer).__name__, str(tokenizer.vocab_file), str(tokenizer.extra_vocab_file))).encode('utf-8')
+        self._cache: 'OrderedDict[bytes, int]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, msg: Message) -> int:
+        text = extract_text_from_message(msg, add_upload_info=True)
+        if self.maxsize <= 0:
+            return len(self.tokenizer.encode(text))
+
+        key = hashlib.blake2b(self.tokenizer_id + b'\0' + text.encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            cnt = self._cache.get(key)
+            if cnt is not None:
+                self._cache.move_to_end(key)
+                return cnt
+        cnt = len(self.tokenizer.encode(text))
+        with self._lock:
+            self._cache[key] = cnt
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return cnt
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+def _truncate_input_messages_roughly(messages: List[Message],
+                                     max_tokens: int,
+                                     token_counter: Optional[MessageTokenCounter] = None) -> List[Message]:
     if len([m for m in messages if m.role == SYSTEM]) >= 2:
         raise ModelServiceError(
             code='400',
@@ -548,6 +958,8 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
                 )
 
     def _count_tokens(msg: Message) -> int:
+        if token_counter is not None:
+            return token_counter.count(msg)
         return tokenizer.count_tokens(extract_text_from_message(msg, add_upload_info=True))
 
     def _truncate_message(msg: Message, max_tokens: int, keep_both_sides: bool = False):
@@ -641,6 +1053,40 @@ def retry_model_service_iterator(
             num_retries, delay = _raise_or_delay(e, num_retries, delay, max_retries)
 
 
+async def aretry_model_service(
+    fn,
+    max_retries: int = 10,
+) -> Any:
+    """Retry a coroutine function"""
+
+    num_retries, delay = 0, 1.0
+    while True:
+        try:
+            return await fn()
+
+        except ModelServiceError as e:
+            num_retries, delay = _raise_or_get_delay(e, num_retries, delay, max_retries)
+            await asyncio.sleep(delay)
+
+
+async def aretry_model_service_iterator(
+    it_fn,
+    max_retries: int = 10,
+) -> AsyncIterator:
+    """Retry an async iterator"""
+
+    num_retries, delay = 0, 1.0
+    while True:
+        try:
+            async for rsp in await it_fn():
+                yield rsp
+            break
+
+        except ModelServiceError as e:
+            num_retries, delay = _raise_or_get_delay(e, num_retries, delay, max_retries)
+            await asyncio.sleep(delay)
+
+
 def _raise_or_delay(
     e: ModelServiceError,
     num_retries: int,
@@ -651,6 +1097,25 @@ def _raise_or_delay(
 ) -> Tuple[int, float]:
     """Retry with exponential backoff"""
 
+    num_retries, delay = _raise_or_get_delay(e,
+                                             num_retries,
+                                             delay,
+                                             max_retries=max_retries,
+                                             max_delay=max_delay,
+                                             exponential_base=exponential_base)
+    time.sleep(delay)
+    return num_retries, delay
+
+
+def _raise_or_get_delay(
+    e: ModelServiceError,
+    num_retries: int,
+    delay: float,
+    max_retries: int = 10,
+    max_delay: float = 300.0,
+    exponential_base: float = 2.0,
+) -> Tuple[int, float]:
+
     if max_retries <= 0:  # no retry
         raise e
 
@@ -676,10 +1141,31 @@ def _raise_or_delay(
     num_retries += 1
     jitter = 1.0 + random.random()
     delay = min(delay * exponential_base, max_delay) * jitter
-    time.sleep(delay)
     return num_retries, delay
 
 
+async def _run_in_thread(fn, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+
+def _async_stream_in_thread(stream: Union[DeltaStream, Iterator[List[Message]]]) -> AsyncIterator[List[Message]]:
+    """Consume a blocking stream in worker threads, keeping the deltas of a DeltaStream."""
+    if isinstance(stream, DeltaStream):
+        return AsyncDeltaStream(_async_iter_in_thread(stream.iter_deltas()))
+    return _async_iter_in_thread(stream)
+
+
+async def _async_iter_in_thread(it: Iterator) -> AsyncIterator:
+    """Consume a blocking iterator in worker threads without blocking the event loop."""
+    sentinel = object()
+    while True:
+        rsp = await _run_in_thread(next, it, sentinel)
+        if rsp is sentinel:
+            break
+        yield rsp
+
+
 def _rm_think(text: str) -> str:
     if '</think>' in text:
         return text.split('</think>')[-1].lstrip('\n')
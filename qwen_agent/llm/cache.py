@@ -0,0 +1,244 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from qwen_agent.llm.schema import Message
+from qwen_agent.log import logger
+from qwen_agent.utils.utils import json_dumps_compact, print_traceback
+
+# A cache entry is a dict with the following fields:
+#   output: The final response, i.e., a list of messages in dict format. None for delta streaming entries.
+#   chunks: The (sampled) streamed responses, which are replayed on cache hits in streaming mode.
+#   intervals: Seconds elapsed between two consecutive chunks, used when replaying with timing.
+CacheEntry = Dict
+
+
+def get_cache_key(**kwargs) -> str:
+    """Hash the request into a fixed-length cache key."""
+    return hashlib.sha256(json_dumps_compact(kwargs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class BaseLLMCache(ABC):
+    """The base class of LLM response caches.
+
+    A custom cache can be plugged into an LLM by setting `llm.cache = MyCache()`.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CacheEntry]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key: str, entry: CacheEntry) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        return {}
+
+
+class LLMCache(BaseLLMCache):
+    """A two-tier LLM response cache, i.e., an in-memory LRU cache in front of an optional disk cache.
+
+    Args:
+        cache_dir: The directory of the disk tier. Only the memory tier is used if not provided.
+        ttl: Seconds before an entry expires. Entries never expire if None.
+        max_memory_items: The max number of entries kept in memory, evicted in LRU order.
+        max_memory_bytes: The max total size of the entries kept in memory, measured by the length of their JSON.
+        disk_size_limit: The max bytes of the disk tier, evicted in LRU order.
+        max_replay_chunks: The max number of chunks recorded for replaying a full (non-delta) stream.
+        replay_timing: Whether to reproduce the original intervals between chunks when replaying a stream.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[str] = None,
+                 ttl: Optional[float] = None,
+                 max_memory_items: int = 256,
+                 max_memory_bytes: int = 2**26,
+                 disk_size_limit: int = 2**30,
+                 max_replay_chunks: int = 64,
+                 replay_timing: bool = False):
+        self.ttl = ttl
+        self.max_memory_items = max_memory_items
+        self.max_memory_bytes = max_memory_bytes
+        self.max_replay_chunks = max_replay_chunks
+        self.replay_timing = replay_timing
+
+        self._memory: 'OrderedDict[str, tuple]' = OrderedDict()  # key -> (expire_at, entry, size)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+        self._disk = None
+        if cache_dir:
+            try:
+                import diskcache
+            except ImportError:
+                print_traceback(is_error=False)
+                logger.warning('Disk caching disabled because diskcache is not installed. '
+                               'Please `pip install diskcache`.')
+                diskcache = None
+            if diskcache is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                self._disk = diskcache.Cache(directory=cache_dir,
+                                             size_limit=disk_size_limit,
+                                             eviction_policy='least-recently-used')
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                expire_at, entry, _ = item
+                if (expire_at is None) or (expire_at > time.time()):
+                    self._memory.move_to_end(key)
+                    self._stats['hits'] += 1
+                    self._stats['memory_hits'] += 1
+                    return entry
+                self._pop_memory(key)
+
+        if self._disk is not None:
+            value, expire_at = self._disk.get(key, expire_time=True)
+            if value:
+                entry = json.loads(value)
+                # The entry expires in memory when it does on disk, rather than a full ttl after being loaded
+                self._set_memory(key, entry, size=len(value), expire_at=expire_at)
+                with self._lock:
+                    self._stats['hits'] += 1
+                    self._stats['disk_hits'] += 1
+                return entry
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def set(self, key: str, entry: CacheEntry) -> None:
+        value = json_dumps_compact(entry)
+        expire_at = (time.time() + self.ttl) if self.ttl else None
+        self._set_memory(key, entry, size=len(value), expire_at=expire_at)
+        if self._disk is not None:
+            self._disk.set(key, value, expire=self.ttl)
+
+    def _set_memory(self, key: str, entry: CacheEntry, size: int, expire_at: Optional[float]) -> None:
+        with self._lock:
+            self._pop_memory(key)
+            if size > self.max_memory_bytes:
+                return  # Too large for the memory tier
+            self._memory[key] = (expire_at, entry, size)
+            self._memory_bytes += size
+            while (len(self._memory) > self.max_memory_items) or (self._memory_bytes > self.max_memory_bytes):
+                _, (_, _, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+                self._stats['evictions'] += 1
+
+    def _pop_memory(self, key: str) -> None:
+        # The caller holds the lock
+        item = self._memory.pop(key, None)
+        if item is not None:
+            self._memory_bytes -= item[2]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_items'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] / total) if total else 0.0
+        if self._disk is not None:
+            stats['disk_items'] = len(self._disk)
+            stats['disk_bytes'] = self._disk.volume()
+        return stats
+
+
+class StreamRecorder:
+    """Record a streamed response for later replay.
+
+    Delta chunks are all kept since each of them carries new content. For full streaming, where each chunk
+    contains the whole response so far, the recorded chunks are thinned out to at most `max_chunks`.
+    """
+
+    def __init__(self, delta_stream: bool, max_chunks: int = 64):
+        self.delta_stream = delta_stream
+        self.max_chunks = max(max_chunks, 2)
+        self._chunks: List[List[Message]] = []
+        self._timestamps: List[float] = []
+        self._stride = 1
+        self._num_seen = 0
+        self._last = None
+        self._start = time.time()
+
+    def add(self, chunk: List[Message]):
+        now = time.time() - self._start
+        self._num_seen += 1
+        if self.delta_stream:
+            self._chunks.append(chunk)
+            self._timestamps.append(now)
+            return
+        self._last = (chunk, now)
+        if (self._num_seen - 1) % self._stride == 0:
+            self._chunks.append(chunk)
+            self._timestamps.append(now)
+            if len(self._chunks) >= self.max_chunks:
+                self._chunks = self._chunks[::2]
+                self._timestamps = self._timestamps[::2]
+                self._stride *= 2
+
+    def to_entry(self) -> Optional[CacheEntry]:
+        chunks, timestamps = list(self._chunks), list(self._timestamps)
+        if (not self.delta_stream) and self._last and (not chunks or chunks[-1] is not self._last[0]):
+            chunks.append(self._last[0])
+            timestamps.append(self._last[1])
+        if not chunks:
+            return None
+        chunks = [[_dump(m) for m in chunk] for chunk in chunks]
+        intervals = [t - s for s, t in zip([0.0] + timestamps[:-1], timestamps)]
+        return {
+            'output': None if self.delta_stream else chunks[-1],
+            'chunks': chunks,
+            'intervals': intervals,
+        }
+
+
+def replay_cache_entry(entry: CacheEntry, replay_timing: bool = False) -> Iterator[List[Dict]]:
+    for chunk, interval in _iter_cached_chunks(entry):
+        if replay_timing and interval > 0:
+            time.sleep(interval)
+        yield chunk
+
+
+async def areplay_cache_entry(entry: CacheEntry, replay_timing: bool = False) -> AsyncIterator[List[Dict]]:
+    for chunk, interval in _iter_cached_chunks(entry):
+        if replay_timing and interval > 0:
+            await asyncio.sleep(interval)
+        yield chunk
+
+
+def _iter_cached_chunks(entry: CacheEntry) -> Iterator[Tuple[List[Dict], float]]:
+    chunks = entry.get('chunks') or [entry['output']]
+    intervals = entry.get('intervals') or [0.0] * len(chunks)
+    for chunk, interval in zip(chunks, intervals):
+        # Copy to keep the cached entry intact if the caller modifies the messages
+        yield copy.deepcopy(chunk), interval
+
+
+def _dump(msg) -> Dict:
+    return msg if isinstance(msg, dict) else msg.model_dump()
@@ -0,0 +1,336 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from qwen_agent.llm.schema import ASSISTANT, Message
+
+
+class MessageDelta:
+    """The change of one message between two consecutive chunks of a streamed response.
+
+    The public streaming interfaces yield the full message list on every chunk. Internally, the built-in backends
+    emit what has changed in each chunk, so that the streaming pipeline only needs to process the new part.
+
+    Attributes:
+        index: The index of the message in the response list.
+        message: The message after the change. It may be left as None by the backends for the text appends, and is
+          filled in when the delta is applied by `MessageAccumulator`.
+        content: The newly appended text of the content, if `replace` is False.
+        reasoning_content: The newly appended text of the reasoning content, if `replace` is False.
+        extra: The new extra of the message if it has changed, if `replace` is False.
+        replace: True if the message is new or has been changed in any way other than appending text.
+          The messages after a replaced message are dropped, and are given again by the following deltas if kept.
+    """
+
+    __slots__ = ('index', 'message', 'content', 'reasoning_content', 'extra', 'replace')
+
+    def __init__(self,
+                 index: int,
+                 message: Optional[Message] = None,
+                 content: str = '',
+                 reasoning_content: str = '',
+                 extra: Optional[dict] = None,
+                 replace=False):
+        self.index = index
+        self.message = message
+        self.content = content
+        self.reasoning_content = reasoning_content
+        self.extra = extra
+        self.replace = replace
+
+    def __repr__(self):
+        if self.replace:
+            return f'MessageDelta(index={self.index}, replace={self.message!r})'
+        return (f'MessageDelta(index={self.index}, content={self.content!r}, '
+                f'reasoning_content={self.reasoning_content!r})')
+
+
+class MessageDiffer:
+    """Compute the deltas of a stream of full message lists, chunk by chunk.
+
+    It is used for the backends that stream full message lists, e.g., those implemented by third parties.
+    """
+
+    def __init__(self):
+        self._prev: List[Message] = []
+
+    def diff(self, messages: List[Message]) -> List[MessageDelta]:
+        deltas = []
+        replaced = False
+        for i, msg in enumerate(messages):
+            if replaced:
+                # The messages after a replaced message are dropped, so they are given again
+                deltas.append(MessageDelta(index=i, message=msg, replace=True))
+                continue
+            prev = self._prev[i] if i < len(self._prev) else None
+            if prev is msg:
+                continue
+            delta = _diff_message(i, prev, msg)
+            if delta is not None:
+                deltas.append(delta)
+                replaced = delta.replace
+        if messages and (len(messages) < len(self._prev)) and (not replaced):
+            # Some trailing messages are removed. Mark the new last message as replaced to drop them.
+            if deltas and deltas[-1].index == len(messages) - 1:
+                deltas.pop()
+            deltas.append(MessageDelta(index=len(messages) - 1, message=messages[-1], replace=True))
+        self._prev = list(messages)
+        return deltas
+
+
+class MessageAccumulator:
+    """Rebuild the full message lists of a stream from its deltas.
+
+    The messages unchanged by a chunk are kept as the same objects, so that the later steps can skip them.
+    """
+
+    def __init__(self):
+        self._messages: List[Message] = []
+
+    def apply(self, deltas: List[MessageDelta]) -> List[Message]:
+        messages = self._messages
+        for delta in deltas:
+            if delta.replace:
+                del messages[delta.index:]
+                messages.append(delta.message)
+                continue
+            if delta.message is None:
+                msg = messages[delta.index]
+                update = {}
+                if delta.content:
+                    update['content'] = msg.content + delta.content
+                if delta.reasoning_content:
+                    update['reasoning_content'] = (msg.reasoning_content or '') + delta.reasoning_content
+                if delta.extra is not None:
+                    update['extra'] = delta.extra
+                delta.message = msg.model_copy(update=update) if update else msg
+            messages[delta.index] = delta.message
+        return list(messages)
+
+
+class DeltaStream:
+    """A streamed response given by the deltas of its chunks.
+
+    The built-in backends return it from `_chat_stream`, so that `chat` processes each chunk by what it changes
+    rather than by diffing the full message lists. Iterating it still yields the full message lists, as expected
+    by the code that consumes `_chat_stream` directly.
+    """
+
+    def __init__(self, deltas: Iterable[List[MessageDelta]]):
+        self._deltas = deltas
+
+    def iter_deltas(self) -> Iterator[List[MessageDelta]]:
+        return iter(self._deltas)
+
+    def __iter__(self) -> Iterator[List[Message]]:
+        accumulator = MessageAccumulator()
+        for deltas in self._deltas:
+            yield accumulator.apply(deltas)
+
+
+class AsyncDeltaStream:
+    """The asyncio version of `DeltaStream`, returned from `_achat_stream` by the built-in backends."""
+
+    def __init__(self, deltas: AsyncIterator[List[MessageDelta]]):
+        self._deltas = deltas
+
+    def aiter_deltas(self) -> AsyncIterator[List[MessageDelta]]:
+        return self._deltas
+
+    async def __aiter__(self) -> AsyncIterator[List[Message]]:
+        accumulator = MessageAccumulator()
+        async for deltas in self._deltas:
+            yield accumulator.apply(deltas)
+
+
+def iter_deltas(stream: Union[DeltaStream, Iterator[List[Message]]]) -> Iterator[List[MessageDelta]]:
+    """Get the deltas of the chunks of a stream, skipping the chunks that change nothing.
+
+    The deltas of a DeltaStream are taken as they are, while those of a stream of full message lists are derived
+    by diffing its consecutive chunks.
+    """
+    if isinstance(stream, DeltaStream):
+        for deltas in stream.iter_deltas():
+            if deltas:
+                yield deltas
+    else:
+        differ = MessageDiffer()
+        for messages in stream:
+            deltas = differ.diff(messages)
+            if deltas:
+                yield deltas
+
+
+async def aiter_deltas(
+        stream: Union[AsyncDeltaStream, AsyncIterator[List[Message]]]) -> AsyncIterator[List[MessageDelta]]:
+    """The asyncio version of `iter_deltas`."""
+    if isinstance(stream, AsyncDeltaStream):
+        async for deltas in stream.aiter_deltas():
+            if deltas:
+                yield deltas
+    else:
+        differ = MessageDiffer()
+        async for messages in stream:
+            deltas = differ.diff(messages)
+            if deltas:
+                yield deltas
+
+
+def iter_message_deltas(
+        stream: Union[DeltaStream, Iterator[List[Message]]]) -> Iterator[Tuple[List[Message], List[MessageDelta]]]:
+    """Pair each chunk of a stream, i.e., the full message list, with its deltas, see `iter_deltas`."""
+    accumulator = MessageAccumulator()
+    for deltas in iter_deltas(stream):
+        yield accumulator.apply(deltas), deltas
+
+
+async def aiter_message_deltas(
+    stream: Union[AsyncDeltaStream, AsyncIterator[List[Message]]]
+) -> AsyncIterator[Tuple[List[Message], List[MessageDelta]]]:
+    """The asyncio version of `iter_message_deltas`."""
+    accumulator = MessageAccumulator()
+    async for deltas in aiter_deltas(stream):
+        yield accumulator.apply(deltas), deltas
+
+
+def iter_chunk_deltas(stream: Iterator[List[Message]]) -> Iterator[List[MessageDelta]]:
+    """Get the deltas of a stream whose chunks are separate pieces, e.g., the chunks when `delta_stream=True`."""
+    for messages in stream:
+        yield [MessageDelta(index=i, message=msg, replace=True) for i, msg in enumerate(messages)]
+
+
+async def aiter_chunk_deltas(stream: AsyncIterator[List[Message]]) -> AsyncIterator[List[MessageDelta]]:
+    """The asyncio version of `iter_chunk_deltas`."""
+    async for messages in stream:
+        yield [MessageDelta(index=i, message=msg, replace=True) for i, msg in enumerate(messages)]
+
+
+def iter_text_deltas(pieces: Iterator[Tuple[str, Optional[str], Optional[dict]]]) -> Iterator[List[MessageDelta]]:
+    """Get the deltas of an assistant message streamed by the backend piece by piece.
+
+    Each piece is a tuple of (content, reasoning_content, extra), whose texts are appended to the message, and whose
+    extra, if not None, replaces that of the message.
+    """
+    first = True
+    for content, reasoning_content, extra in pieces:
+        delta = _get_text_delta(content, reasoning_content, extra, first=first)
+        first = False
+        if delta is not None:
+            yield [delta]
+
+
+async def aiter_text_deltas(
+        pieces: AsyncIterator[Tuple[str, Optional[str], Optional[dict]]]) -> AsyncIterator[List[MessageDelta]]:
+    """The asyncio version of `iter_text_deltas`."""
+    first = True
+    async for content, reasoning_content, extra in pieces:
+        delta = _get_text_delta(content, reasoning_content, extra, first=first)
+        first = False
+        if delta is not None:
+            yield [delta]
+
+
+def _get_text_delta(content: str, reasoning_content: Optional[str], extra: Optional[dict],
+                    first: bool) -> Optional[MessageDelta]:
+    if first:
+        msg = Message(role=ASSISTANT, content=content, reasoning_content=reasoning_content, extra=extra)
+        return MessageDelta(index=0, message=msg, replace=True)
+    if content or reasoning_content or (extra is not None):
+        return MessageDelta(index=0, content=content, reasoning_content=reasoning_content or '', extra=extra)
+    return None
+
+
+def _diff_message(index: int, prev: Optional[Message], msg: Message) -> Optional[MessageDelta]:
+    if prev is None:
+        return MessageDelta(index=index, message=msg, replace=True)
+    if (prev.role != msg.role) or (prev.name != msg.name) or (prev.function_call != msg.function_call):
+        return MessageDelta(index=index, message=msg, replace=True)
+
+    content = _get_appended_text(prev.content, msg.content)
+    reasoning_content = _get_appended_text(prev.reasoning_content or '', msg.reasoning_content or '')
+    if (content is None) or (reasoning_content is None):
+        return MessageDelta(index=index, message=msg, replace=True)
+    if content or reasoning_content or (prev.extra is not msg.extra):
+        return MessageDelta(index=index, message=msg, content=content, reasoning_content=reasoning_content)
+    return None
+
+
+def _get_appended_text(prev: Union[str, list], cur: Union[str, list]) -> Optional[str]:
+    """Return the appended text if `cur` extends `prev`, or None if `cur` is not an extension of `prev`."""
+    if isinstance(prev, str) and isinstance(cur, str):
+        if (len(cur) >= len(prev)) and cur.startswith(prev):
+            return cur[len(prev):]
+        return None
+    if prev == cur:
+        return ''
+    return None
+
+
+class MessageMemo:
+    """Apply a function to each message of the chunks of a stream, reusing the results of the messages unchanged
+    since the last chunk, i.e., the same message objects."""
+
+    def __init__(self, fn: Callable[[Message], Message]):
+        self._fn = fn
+        self._memo: Dict[int, Tuple[Message, Message]] = {}
+
+    def map(self, messages: List[Message]) -> List[Message]:
+        memo, results = {}, []
+        for msg in messages:
+            cached = self._memo.get(id(msg))
+            if (cached is not None) and (cached[0] is msg):
+                rsp = cached[1]
+            else:
+                rsp = self._fn(msg)
+            memo[id(msg)] = (msg, rsp)
+            results.append(rsp)
+        self._memo = memo
+        return results
+
+
+class MessageDumper:
+    """Convert the chunks of a stream to dicts, reusing the dicts of the messages unchanged since the last chunk.
+
+    The messages in a streamed response list are mostly unchanged from one chunk to the next. Dumping only the
+    changed ones makes the conversion cost proportional to the change rather than the whole response.
+    """
+
+    def __init__(self):
+        self._memo: Dict[int, Tuple[Message, tuple, dict]] = {}
+
+    def dump(self, messages: List[Union[Message, dict]]) -> List[dict]:
+        memo, results = {}, []
+        for msg in messages:
+            if isinstance(msg, dict):
+                results.append(msg)
+                continue
+            sig = _get_signature(msg)
+            cached = self._memo.get(id(msg))
+            if (cached is not None) and (cached[0] is msg) and (cached[1] == sig):
+                rsp = cached[2]
+            else:
+                rsp = msg.model_dump()
+            memo[id(msg)] = (msg, sig, rsp)
+            results.append(rsp)
+        self._memo = memo
+        return results
+
+
+def _get_signature(msg: Message) -> tuple:
+    # A cheap fingerprint to detect in-place modifications of a message.
+    content = msg.content
+    content_sig = len(content) if isinstance(content, str) else tuple((id(x), id(x.text)) for x in content)
+    return (msg.role, msg.name, content_sig, id(content), id(msg.reasoning_content), id(msg.function_call),
+            id(msg.extra))
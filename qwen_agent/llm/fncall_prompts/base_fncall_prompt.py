@@ -12,11 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Literal, Union
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Literal, Optional, Tuple, Union
 
-from qwen_agent.llm.schema import FUNCTION, Message
+from qwen_agent.llm.schema import FUNCTION, FunctionInfo, Message
 from qwen_agent.utils.utils import format_as_multimodal_message, format_as_text_message, has_chinese_messages
 
+# Max number of rendered tool prompts kept, which are shared by all the LLMs and agents in the process
+TOOL_SYSTEM_CACHE_SIZE = 64
+_tool_system_cache: 'OrderedDict[tuple, str]' = OrderedDict()
+_tool_system_cache_lock = threading.Lock()
+
 
 class BaseFnCallPrompt(object):
 
@@ -38,10 +47,14 @@ class BaseFnCallPrompt(object):
     def postprocess_fncall_messages(messages: List[Message],
                                     parallel_function_calls: bool = True,
                                     function_choice: Union[Literal['auto'], str] = 'auto',
+                                    stream_state: Optional[dict] = None,
                                     **kwargs) -> List[Message]:
         """
         Transform the plaintext model output into structured function call messages,
         return in the multimodal format for consistency.
+
+        When postprocessing the chunks of a streamed response, the same `stream_state` dict is passed for all chunks,
+        so that the function calls can be parsed incrementally with a FnCallStreamParser.
         """
         raise NotImplementedError
 
@@ -85,3 +98,107 @@ class BaseFnCallPrompt(object):
 
         messages = [format_as_text_message(msg, add_upload_info=False) for msg in messages]
         return messages
+
+
+def get_tool_system(render: Callable[[], str], prompt_type: str, functions: List[dict], lang: Literal['en', 'zh'],
+                    parallel_function_calls: bool) -> str:
+    """Returns the system prompt describing the functions, which is rendered by `render` only on a cache miss.
+
+    The cache is keyed by a hash of the functions and the other arguments, so that the repeated calls of an agent
+    with the same tools, e.g., the iterations of a tool-calling loop, do not re-render the schemas of all the tools.
+    The functions given by agents are FunctionInfo dicts, see `BaseTool.function`, whose hashes are computed once.
+    Other functions are serialized and hashed on every call.
+    """
+    if all(isinstance(f, FunctionInfo) for f in functions):
+        functions_key = tuple(f.digest for f in functions)
+    else:
+        functions_key = json.dumps(functions, ensure_ascii=False, sort_keys=True, default=str)
+        functions_key = hashlib.blake2b(functions_key.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+    key = (prompt_type, lang, bool(parallel_function_calls), functions_key)
+    with _tool_system_cache_lock:
+        tool_system = _tool_system_cache.get(key)
+        if tool_system is not None:
+            _tool_system_cache.move_to_end(key)
+            return tool_system
+    tool_system = render()
+    with _tool_system_cache_lock:
+        _tool_system_cache[key] = tool_system
+        while len(_tool_system_cache) > TOOL_SYSTEM_CACHE_SIZE:
+            _tool_system_cache.popitem(last=False)
+    return tool_system
+
+
+def copy_message_for_update(msg: Message) -> Message:
+    """Returns a shallow copy of the message, whose content list can be extended without changing the original.
+
+    The content items are shared with the original message, so they should be replaced rather than modified.
+    """
+    return msg.model_copy(update={'content': list(msg.content)})
+
+
+# A parsed segment is a plain text (str), a function call (a tuple of name and arguments), or a format-specific marker.
+Segment = Any
+
+
+class FnCallStreamParser(object):
+    """A resumable parser that extracts function calls from the growing text of a streamed response.
+
+    The text is split into segments, e.g., plain texts and function calls. A segment is closed once the text after it
+    can no longer change how it is parsed. Closed segments are parsed only once, and the marker searches resume where
+    the previous chunk stopped. The last segment, which is still open, is parsed again for each chunk, but subclasses
+    keep what they have found in it so far, e.g., where the arguments of a function call start, in `open_state`.
+
+    Subclasses implement the format by `_parse_closed_segment` and `_parse_open_segment`, and use `_find` to search
+    for markers.
+    """
+    initial_state: Any = None
+
+    def __init__(self):
+        self.segments: List[Segment] = []  # All the segments of the latest text
+        self.state = self.initial_state  # The parser state after the closed segments
+        self.open_state: Any = None  # What the subclass has found in the open segment, reset when the segment changes
+        self._closed: List[Segment] = []
+        self._closed_end = 0  # The closed segments are parsed from text[:self._closed_end]
+        self._scanned = 0  # The open segment has been searched for markers up to this position
+        self._text = ''
+
+    def feed(self, text: str):
+        """Parse the latest text of the stream, and update `segments`.
+
+        The text usually extends the previously fed one. Otherwise, the closed segments that are no longer a prefix
+        of the text are discarded and parsed again.
+        """
+        if not text.startswith(self._text):
+            if not text.startswith(self._text[:self._closed_end]):
+                self._closed, self._closed_end, self.state = [], 0, self.initial_state
+            self._scanned = self._closed_end
+            self.open_state = None
+        self._text = text
+
+        while True:
+            parsed = self._parse_closed_segment(text, self._closed_end, self.state)
+            if parsed is None:
+                break
+            segments, self._closed_end, self.state = parsed
+            self._closed.extend(segments)
+            self._scanned = self._closed_end
+            self.open_state = None
+        open_segments = self._parse_open_segment(text, self._closed_end, self.state)
+        self._scanned = len(text)
+        self.segments = self._closed + open_segments
+
+    def _parse_closed_segment(self, text: str, pos: int, state: Any) -> Optional[Tuple[List[Segment], int, Any]]:
+        """Parse the segment starting at `pos` if it is closed, and return the parsed segments, its end, and the
+        parser state after it. Return None if the segment is still open."""
+        raise NotImplementedError
+
+    def _parse_open_segment(self, text: str, pos: int, state: Any) -> List[Segment]:
+        """Parse the last segment, i.e., the one still open, starting at `pos`."""
+        raise NotImplementedError
+
+    def _find(self, text: str, marker: str, pos: int, resume: bool = True) -> int:
+        # Skip the part of the open segment already searched, except for a marker crossing the boundary.
+        # Set resume to False if the search did not start from `pos` for the previous chunk.
+        if resume:
+            pos = max(pos, self._scanned - len(marker) + 1)
+        return text.find(marker, pos)
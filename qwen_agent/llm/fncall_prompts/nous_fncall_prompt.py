@@ -12,14 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import json
 import os
-from typing import List, Literal, Union
+from typing import List, Literal, Optional, Union
 
 import json5
 
-from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt
+from qwen_agent.llm.fncall_prompts.base_fncall_prompt import (BaseFnCallPrompt, FnCallStreamParser,
+                                                              copy_message_for_update, get_tool_system)
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
 from qwen_agent.log import logger
 
@@ -41,19 +41,21 @@ class NousFnCallPrompt(BaseFnCallPrompt):
         ori_messages = messages
 
         # Change function_call responses to plaintext responses:
+        # The input messages are left intact. The messages to be extended are copied, while the content items are
+        # shared, since they are never modified.
         messages = []
-        for msg in copy.deepcopy(ori_messages):
+        for msg in ori_messages:
             role, content, reasoning_content = msg.role, msg.content, msg.reasoning_content
             if role in (SYSTEM, USER):
-                messages.append(msg)
+                messages.append(copy_message_for_update(msg))
             elif role == ASSISTANT:
-                content = (content or [])
+                content = list(content or [])
                 fn_call = msg.function_call
                 if fn_call:
                     if (not SPECIAL_CODE_MODE) or (CODE_TOOL_PATTERN not in fn_call.name):
                         arguments = fn_call.arguments
                         try:
-                            arguments = json5.loads(arguments)
+                            arguments = loads_json(arguments)
                         except Exception:
                             logger.warning('Invalid json tool-calling arguments')
                         fc = {'name': fn_call.name, 'arguments': arguments}
@@ -89,13 +91,11 @@ class NousFnCallPrompt(BaseFnCallPrompt):
             else:
                 raise TypeError
 
-        tool_descs = [{'type': 'function', 'function': f} for f in functions]
-        tool_names = [function.get('name_for_model', function.get('name', '')) for function in functions]
-        tool_descs = '\n'.join([json.dumps(f, ensure_ascii=False) for f in tool_descs])
-        if SPECIAL_CODE_MODE and any([CODE_TOOL_PATTERN in x for x in tool_names]):
-            tool_system = FN_CALL_TEMPLATE_WITH_CI.format(tool_descs=tool_descs)
-        else:
-            tool_system = FN_CALL_TEMPLATE.format(tool_descs=tool_descs)
+        tool_system = get_tool_system(lambda: _render_tool_system(functions),
+                                      prompt_type='nous',
+                                      functions=functions,
+                                      lang='en',
+                                      parallel_function_calls=True)
         if messages and messages[0].role == SYSTEM:
             messages[0].content.append(ContentItem(text='\n\n' + tool_system))
         else:
@@ -108,12 +108,13 @@ class NousFnCallPrompt(BaseFnCallPrompt):
         parallel_function_calls: bool = True,
         function_choice: Union[Literal['auto'], str] = 'auto',
         thought_in_content: bool = False,
+        stream_state: Optional[dict] = None,
     ) -> List[Message]:
         if function_choice != 'auto':
             raise NotImplementedError
         # Convert plaintext responses to function_call responses:
         new_messages = []
-        for msg in messages:
+        for msg_idx, msg in enumerate(messages):
             role, content, reasoning_content, extra = msg.role, msg.content, msg.reasoning_content, msg.extra
             assert isinstance(content, list)
 
@@ -127,7 +128,7 @@ class NousFnCallPrompt(BaseFnCallPrompt):
                 new_messages.append(Message(role=role, content='', reasoning_content=reasoning_content, extra=extra))
 
             new_content = []
-            for item in content:
+            for item_idx, item in enumerate(content):
                 item_type, item_text = item.get_type_and_value()
 
                 if item_type != 'text':  # multimodal
@@ -142,97 +143,36 @@ class NousFnCallPrompt(BaseFnCallPrompt):
                     new_content.append(ContentItem(text='</think>'.join(_item_text[:-1]) + '</think>'))
                     item_text = _item_text[-1]
 
-                i = item_text.find('<tool_call>')
-                # If no function call:
-                if i < 0:
-                    show_text = item_text
-                    if show_text:
-                        new_content.append(ContentItem(text=show_text))
-                    continue
-
-                # split tool-call to separate assistant msg
-                tool_call_list = item_text.split('<tool_call>')
-                pre_thought = tool_call_list[0]
-                if pre_thought.strip():
-                    new_content.append(ContentItem(text=pre_thought))
-                for txt in tool_call_list[1:]:
-                    if not txt.strip():
-                        continue
-
-                    if '</tool_call>' not in txt:
-                        # incomplete </tool_call>: This is to better represent incomplete tool calls in streaming output
-                        fn_name, fn_args = extract_fn(txt)
-                        if fn_name:  # need to call function
-                            if new_content:
-                                new_messages.append(Message(
-                                    role=role,
-                                    content=new_content,
-                                    extra=extra,
-                                ))  # split thought and function call
-                                new_content = []
-                            # TODO: process incomplete tool-call messages
-                            new_messages.append(
-                                Message(
-                                    role=ASSISTANT,
-                                    content=[],
-                                    function_call=FunctionCall(
-                                        name=fn_name,
-                                        arguments=fn_args,
-                                    ),
-                                    extra=extra,
-                                ))
+                parser = stream_state.get((msg_idx, item_idx)) if (stream_state is not None) else None
+                if parser is None:
+                    parser = NousFnCallStreamParser()
+                    if stream_state is not None:
+                        stream_state[(msg_idx, item_idx)] = parser
+                parser.feed(item_text)
+                for segment in parser.segments:
+                    if isinstance(segment, str):
+                        new_content.append(ContentItem(text=segment))
                         continue
-
-                    one_tool_call_txt = txt.split('</tool_call>')
-
-                    # The complete tool-call response
+                    # Split thought and function call
                     if new_content:
                         new_messages.append(Message(
                             role=role,
                             content=new_content,
                             extra=extra,
-                        ))  # split thought and function call
+                        ))
                         new_content = []
-                    fn = None
-                    if SPECIAL_CODE_MODE and '<code>' in one_tool_call_txt[0] and '</code>' in one_tool_call_txt[0]:
-                        _snips = one_tool_call_txt[0].split('<code>')
-                        for i, _s in enumerate(_snips):
-                            if i == 0:
-                                fn = json5.loads(_s)
-                            else:
-                                # TODO: support more flexible params
-                                code = _s.replace('</code>', '')
-                                fn['arguments']['code'] = code
-                    else:
-                        try:
-                            fn = json5.loads(one_tool_call_txt[0].strip())
-                        except Exception:
-                            logger.warning('Invalid json tool-calling arguments')
-                            fn_name, fn_args = extract_fn(one_tool_call_txt[0].strip())
-                            new_messages.append(
-                                Message(
-                                    role=ASSISTANT,
-                                    content=[],
-                                    function_call=FunctionCall(
-                                        name=fn_name,
-                                        arguments=fn_args,
-                                    ),
-                                    extra=extra,
-                                ))
-                    if fn:
+                    if segment is not None:
+                        fn_name, fn_args = segment
                         new_messages.append(
                             Message(
                                 role=ASSISTANT,
                                 content=[],
                                 function_call=FunctionCall(
-                                    name=fn['name'],
-                                    arguments=json.dumps(fn['arguments'], ensure_ascii=False),
+                                    name=fn_name,
+                                    arguments=fn_args,
                                 ),
                                 extra=extra,
                             ))
-                    # Expected not to output extra tails
-                    # if one_tool_call_txt[1].strip():
-                    #     new_content.append(ContentItem(text=one_tool_call_txt[1]))
 
             if new_content:
                 new_messages.append(Message(role=role, content=new_content, extra=extra))
@@ -277,6 +217,130 @@ Here is the code.
 </tool_call>"""
 
 
+def _render_tool_system(functions: List[dict]) -> str:
+    tool_descs = [{'type': 'function', 'function': f} for f in functions]
+    tool_names = [function.get('name_for_model', function.get('name', '')) for function in functions]
+    tool_descs = '\n'.join([json.dumps(f, ensure_ascii=False) for f in tool_descs])
+    if SPECIAL_CODE_MODE and any([CODE_TOOL_PATTERN in x for x in tool_names]):
+        return FN_CALL_TEMPLATE_WITH_CI.format(tool_descs=tool_descs)
+    else:
+        return FN_CALL_TEMPLATE.format(tool_descs=tool_descs)
+
+
+class NousFnCallStreamParser(FnCallStreamParser):
+    """Parse the tool calls within <tool_call></tool_call> incrementally.
+
+    The segments are the text before the first tool call, the tool calls as (name, arguments) tuples, and None for
+    a complete tool call that calls no function. The text after each </tool_call> is discarded.
+    """
+    initial_state = 'text'  # One of 'text' (before the first tool call), 'call', and 'gap' (after a </tool_call>)
+
+    def _parse_closed_segment(self, text: str, pos: int, state: str):
+        if state in ('text', 'gap'):
+            i = self._find(text, '<tool_call>', pos)
+            if i < 0:
+                return None
+            segments = []
+            if (state == 'text') and text[pos:i].strip():
+                segments.append(text[pos:i])
+            return segments, i + len('<tool_call>'), 'call'
+
+        i = self._find(text, '<tool_call>', pos)
+        j = self._find(text, '</tool_call>', pos)
+        if (j >= 0) and ((i < 0) or (j < i)):
+            # The complete tool-call response
+            return [_parse_tool_call(text[pos:j])], j + len('</tool_call>'), 'gap'
+        if i >= 0:
+            # The tool call is interrupted by another <tool_call> before it is complete
+            return _parse_incomplete_tool_call(text[pos:i]), i + len('<tool_call>'), 'call'
+        return None
+
+    def _parse_open_segment(self, text: str, pos: int, state: str):
+        if state == 'text':  # No tool call
+            return [text[pos:]] if text[pos:] else []
+        if state == 'call':
+            # incomplete </tool_call>: This is to better represent incomplete tool calls in streaming output
+            return self._parse_open_tool_call(text, pos)
+        return []
+
+    def _parse_open_tool_call(self, text: str, pos: int):
+        # The same as `_parse_incomplete_tool_call(text[pos:])`, except that the positions found by the previous chunks
+        # are kept in `open_state`, so that the tool call is not searched from its start for each chunk.
+        resume = self.open_state is not None
+        if not resume:
+            self.open_state = {'name_start': -1, 'name': None, 'args_start': -1}
+        st = self.open_state
+        fn_name_s, fn_name_e, fn_args_s = '"name": "', '", "', '"arguments": '
+
+        name_resume = resume
+        if st['name_start'] < 0:
+            st['name_start'] = self._find(text, fn_name_s, pos, resume=resume)
+            name_resume = False
+        if (st['name'] is None) and (st['name_start'] > pos):
+            name_start = st['name_start'] + len(fn_name_s)
+            j = self._find(text, fn_name_e, name_start, resume=name_resume)
+            if j > -1:
+                st['name'] = text[name_start:j]
+        if st['args_start'] == -1:
+            k = self._find(text, fn_args_s, pos, resume=resume)
+            if k > -1:
+                # No arguments if the marker is at the very start
+                st['args_start'] = (k + len(fn_args_s)) if (k > pos) else None
+        if not st['name']:
+            return []
+
+        i, j = st['args_start'], len(text)
+        if (i is None) or (i < 0):
+            return [(st['name'], '')]
+        # The arguments are stripped, and the last character (usually the closing brace) is removed.
+        while (i < j) and text[i].isspace():
+            i += 1
+        st['args_start'] = i
+        while (j > i) and text[j - 1].isspace():
+            j -= 1
+        return [(st['name'], text[i:j - 1] if (j - i > 2) else '')]
+
+
+def _parse_tool_call(txt: str):
+    fn = None
+    if SPECIAL_CODE_MODE and '<code>' in txt and '</code>' in txt:
+        _snips = txt.split('<code>')
+        for i, _s in enumerate(_snips):
+            if i == 0:
+                fn = loads_json(_s)
+            else:
+                # TODO: support more flexible params
+                code = _s.replace('</code>', '')
+                fn['arguments']['code'] = code
+    else:
+        try:
+            fn = loads_json(txt.strip())
+        except Exception:
+            logger.warning('Invalid json tool-calling arguments')
+            return extract_fn(txt.strip())
+    if fn:
+        return fn['name'], json.dumps(fn['arguments'], ensure_ascii=False)
+    return None
+
+
+def _parse_incomplete_tool_call(txt: str):
+    if not txt.strip():
+        return []
+    fn_name, fn_args = extract_fn(txt)
+    if fn_name:  # need to call function
+        # TODO: process incomplete tool-call messages
+        return [(fn_name, fn_args)]
+    return []
+
+
+def loads_json(text: str):
+    # Most tool calls are valid json, which the builtin parser handles much faster than json5.
+    try:
+        return json.loads(text)
+    except ValueError:
+        return json5.loads(text)
+
+
 # Mainly for removing incomplete special tokens when streaming the output
 # This assumes that '<tool_call>\n{"name": "' is the special token for the NousFnCallPrompt
 def remove_incomplete_special_tokens(text: str) -> str:
@@ -12,11 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import json
-from typing import Dict, List, Literal, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
-from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt
+from qwen_agent.llm.fncall_prompts.base_fncall_prompt import (BaseFnCallPrompt, FnCallStreamParser,
+                                                              copy_message_for_update, get_tool_system)
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
 from qwen_agent.utils.utils import extract_text_from_message
 
@@ -33,13 +33,15 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
         ori_messages = messages
 
         # Change function_call responses to plaintext responses:
+        # The input messages are left intact. The messages to be extended are copied, and the content items to be
+        # modified are replaced with new ones, while the other items are shared.
         messages = []
-        for msg in copy.deepcopy(ori_messages):
+        for msg in ori_messages:
             role, content = msg.role, msg.content
             if role in (SYSTEM, USER):
-                messages.append(msg)
+                messages.append(copy_message_for_update(msg))
             elif role == ASSISTANT:
-                content = (content or [])
+                content = list(content or [])
                 fn_call = msg.function_call
                 if fn_call:
                     f_name = fn_call.name
@@ -59,23 +61,24 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 assert isinstance(content, list)
                 assert all(isinstance(item, ContentItem) for item in content)
                 if content:
-                    f_result = copy.deepcopy(content)
+                    f_result = list(content)
                 else:
                     f_result = [ContentItem(text='')]
                 f_exit = f'\n{FN_EXIT}: '
                 last_text_content = messages[-1].content[-1].text
                 if last_text_content.endswith(f_exit):
-                    messages[-1].content[-1].text = last_text_content[:-len(f_exit)]
+                    messages[-1].content[-1] = ContentItem(text=last_text_content[:-len(f_exit)])
                 f_result = [ContentItem(text=f'\n{FN_RESULT}: ')] + f_result + [ContentItem(text=f_exit)]
                 messages[-1].content += f_result
             else:
                 raise TypeError
 
         # Add a system prompt for function calling:
-        tool_desc_template = FN_CALL_TEMPLATE[lang + ('_parallel' if parallel_function_calls else '')]
-        tool_descs = '\n\n'.join(get_function_description(function, lang=lang) for function in functions)
-        tool_names = ','.join(function.get('name_for_model', function.get('name', '')) for function in functions)
-        tool_system = tool_desc_template.format(tool_descs=tool_descs, tool_names=tool_names)
+        tool_system = get_tool_system(lambda: _render_tool_system(functions, lang, parallel_function_calls),
+                                      prompt_type='qwen',
+                                      functions=functions,
+                                      lang=lang,
+                                      parallel_function_calls=parallel_function_calls)
         if messages and messages[0].role == SYSTEM:
             messages[0].content.append(ContentItem(text='\n\n' + tool_system))
         else:
@@ -89,7 +92,7 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 item_type, item_text = last_msg[i].get_type_and_value()
                 if item_type == 'text':
                     if item_text.endswith(f'{FN_EXIT}: '):
-                        last_msg[i].text = item_text[:-2]
+                        last_msg[i] = ContentItem(text=item_text[:-2])
                     break
 
         # Add the function_choice prefix:
@@ -113,8 +116,10 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
     def postprocess_fncall_messages(messages: List[Message],
                                     parallel_function_calls: bool = True,
                                     function_choice: Union[Literal['auto'], str] = 'auto',
+                                    stream_state: Optional[dict] = None,
                                     **kwargs) -> List[Message]:
-        messages = copy.deepcopy(messages)
+        # The input messages are left intact. The modified items are replaced with new objects.
+        messages = list(messages)
 
         # Prepend a prefix for function_choice:
         if function_choice not in ('auto', 'none'):
@@ -123,7 +128,7 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 if output.lstrip().startswith(FN_ARGS):
                     # Prepend this prefix only if the model correctly completes it
                     output = f'{FN_NAME}: {function_choice}\n' + output
-                messages[0].content[0].text = output
+                messages[0] = _replace_item_text(messages[0], 0, output)
 
         # Remove ': ' brought by continued generation of function calling
         last_msg = messages[-1].content
@@ -131,14 +136,14 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
             item_type, item_text = last_msg[i].get_type_and_value()
             if item_type == 'text':
                 if item_text.startswith(': '):
-                    last_msg[i].text = item_text[2:]
+                    messages[-1] = _replace_item_text(messages[-1], i, item_text[2:])
                 elif item_text.startswith(':'):
-                    last_msg[i].text = item_text[1:]
+                    messages[-1] = _replace_item_text(messages[-1], i, item_text[1:])
                 break
 
         # Convert plaintext responses to function_call responses:
         new_messages = []
-        for msg in messages:
+        for msg_idx, msg in enumerate(messages):
             role, content, extra = msg.role, msg.content, msg.extra
             assert isinstance(content, list)
 
@@ -147,7 +152,7 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 continue
 
             new_content = []
-            for item in content:
+            for item_idx, item in enumerate(content):
                 item_type, item_text = item.get_type_and_value()
 
                 if item_type != 'text':  # multimodal
@@ -157,51 +162,35 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 for stop_word in FN_STOP_WORDS:
                     assert stop_word not in item_text, 'Something wrong, stop words are expected to be excluded.'
 
-                i = item_text.find(f'{FN_NAME}:')
+                parser = stream_state.get((msg_idx, item_idx)) if (stream_state is not None) else None
+                if parser is None:
+                    parser = QwenFnCallStreamParser()
+                    if stream_state is not None:
+                        stream_state[(msg_idx, item_idx)] = parser
+                parser.feed(item_text)
 
                 # If no function call:
-                if i < 0:
-                    show_text = remove_incomplete_special_tokens(item_text)
+                if parser.state == 'answer':
+                    show_text = parser.segments[0]
                     if show_text:
                         new_content.append(ContentItem(text=show_text))
                     continue
 
-                # If it says something before function call:
-                if i > 0:
-                    answer = item_text[:i].lstrip('\n').rstrip()
-                    if answer.endswith('\n'):
-                        answer = answer[:-1]
-                    show_text = remove_incomplete_special_tokens(answer)
-                    if show_text:
-                        new_content.append(ContentItem(text=show_text))
-                    if new_content:
-                        new_messages.append(Message(
-                            role=role,
-                            content=new_content,
-                            extra=extra,
-                        ))  # split thought and function call
-                        new_content = []
-                    item_text = item_text[i:]
-
-                # If has function call:
-                for part in item_text.split(f'{FN_NAME}:'):
-                    if not part:
-                        continue
-                    if part.endswith('\n'):
-                        part = part[:-1]
-
-                    arg_sep = f'{FN_ARGS}:'
-                    i = part.find(arg_sep)
-                    if i < 0:
-                        fn_name = part.strip()
-                        list_of_fn_args = ['']
+                for segment in parser.segments:
+                    if isinstance(segment, str):
+                        # If it says something before function call:
+                        if segment:
+                            new_content.append(ContentItem(text=segment))
+                    elif segment is None:
+                        if new_content:
+                            new_messages.append(Message(
+                                role=role,
+                                content=new_content,
+                                extra=extra,
+                            ))  # split thought and function call
+                            new_content = []
                     else:
-                        fn_name = part[:i].strip()
-                        list_of_fn_args = [_.strip() for _ in part[i + len(arg_sep):].split(arg_sep)]
-                    fn_name = remove_incomplete_special_tokens(fn_name)
-                    for fn_args in list_of_fn_args:
-                        fn_args = remove_incomplete_special_tokens(fn_args)
-                        fn_args = remove_trailing_comment_of_fn_args(fn_args)
+                        fn_name, fn_args = segment
                         new_messages.append(
                             Message(
                                 role=ASSISTANT,
@@ -230,6 +219,98 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
         return new_messages
 
 
+class QwenFnCallStreamParser(FnCallStreamParser):
+    """Parse the function calls following the ✿FUNCTION✿ and ✿ARGS✿ markers incrementally.
+
+    If there is no function call yet, the only segment is the text to show. Otherwise, the segments are the text said
+    before the first function call and None (which ends the message of that text) if any, followed by the function
+    calls as (name, arguments) tuples.
+    """
+    initial_state = 'answer'  # One of 'answer' (before the first function call) and 'call'
+
+    def _parse_closed_segment(self, text: str, pos: int, state: str):
+        i = self._find(text, f'{FN_NAME}:', pos)
+        if i < 0:
+            return None
+        if state == 'answer':
+            segments = []
+            # If it says something before function call:
+            if i > pos:
+                answer = text[pos:i].lstrip('\n').rstrip()
+                if answer.endswith('\n'):
+                    answer = answer[:-1]
+                segments = [remove_incomplete_special_tokens(answer), None]
+        else:
+            segments = _parse_fn_call(text[pos:i])
+        return segments, i + len(f'{FN_NAME}:'), 'call'
+
+    def _parse_open_segment(self, text: str, pos: int, state: str):
+        if state == 'answer':
+            return [remove_incomplete_special_tokens(text[pos:])]
+        return self._parse_open_fn_call(text, pos)
+
+    def _parse_open_fn_call(self, text: str, pos: int) -> List[Tuple[str, str]]:
+        # The same as `_parse_fn_call(text[pos:])`, except that the arguments separated by the previous chunks are kept
+        # in `open_state`, so that only the last arguments are parsed again for each chunk.
+        resume = self.open_state is not None
+        if not resume:
+            self.open_state = {'arg_seps': [], 'fn_name': '', 'list_of_fn_args': []}
+        st = self.open_state
+        if pos >= len(text):
+            return []
+
+        arg_sep = f'{FN_ARGS}:'
+        while True:
+            i = st['arg_seps'][-1] + len(arg_sep) if st['arg_seps'] else pos
+            j = self._find(text, arg_sep, i, resume=resume)
+            if j < 0:
+                break
+            if st['arg_seps']:
+                st['list_of_fn_args'].append(_clean_fn_args(text[i:j]))
+            else:
+                st['fn_name'] = remove_incomplete_special_tokens(text[pos:j].strip())
+            st['arg_seps'].append(j)
+            resume = False
+
+        end = (len(text) - 1) if text.endswith('\n') else len(text)
+        if not st['arg_seps']:
+            return [(remove_incomplete_special_tokens(text[pos:end].strip()), _clean_fn_args(''))]
+        last_fn_args = _clean_fn_args(text[st['arg_seps'][-1] + len(arg_sep):end])
+        return [(st['fn_name'], fn_args) for fn_args in st['list_of_fn_args'] + [last_fn_args]]
+
+
+def _parse_fn_call(part: str) -> List[Tuple[str, str]]:
+    if not part:
+        return []
+    if part.endswith('\n'):
+        part = part[:-1]
+
+    arg_sep = f'{FN_ARGS}:'
+    i = part.find(arg_sep)
+    if i < 0:
+        fn_name = part.strip()
+        list_of_fn_args = ['']
+    else:
+        fn_name = part[:i].strip()
+        list_of_fn_args = [_.strip() for _ in part[i + len(arg_sep):].split(arg_sep)]
+    fn_name = remove_incomplete_special_tokens(fn_name)
+    fn_calls = []
+    for fn_args in list_of_fn_args:
+        fn_calls.append((fn_name, _clean_fn_args(fn_args)))
+    return fn_calls
+
+
+def _clean_fn_args(fn_args: str) -> str:
+    fn_args = remove_incomplete_special_tokens(fn_args.strip())
+    return remove_trailing_comment_of_fn_args(fn_args)
+
+
+def _replace_item_text(msg: Message, index: int, text: str) -> Message:
+    content = list(msg.content)
+    content[index] = ContentItem(text=text)
+    return msg.model_copy(update={'content': content})
+
+
 FN_NAME = '✿FUNCTION✿'
 FN_ARGS = '✿ARGS✿'
 FN_RESULT = '✿RESULT✿'
@@ -332,6 +413,13 @@ FN_CALL_TEMPLATE = {
 }
 
 
+def _render_tool_system(functions: List[dict], lang: Literal['en', 'zh'], parallel_function_calls: bool) -> str:
+    tool_desc_template = FN_CALL_TEMPLATE[lang + ('_parallel' if parallel_function_calls else '')]
+    tool_descs = '\n\n'.join(get_function_description(function, lang=lang) for function in functions)
+    tool_names = ','.join(function.get('name_for_model', function.get('name', '')) for function in functions)
+    return tool_desc_template.format(tool_descs=tool_descs, tool_names=tool_names)
+
+
 def get_function_description(function: Dict, lang: Literal['en', 'zh']) -> str:
     """
     Text description of function
@@ -14,7 +14,7 @@
 
 import copy
 from abc import ABC
-from typing import Dict, Iterator, List, Literal, Optional, Union
+from typing import AsyncIterator, Dict, Iterator, List, Literal, Optional, Union
 
 from qwen_agent.llm.base import BaseChatModel
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, USER, ContentItem, Message
@@ -67,14 +67,19 @@ class BaseFnCallModel(BaseChatModel, ABC):
         messages: List[Message],
         fncall_mode: bool,
         generate_cfg: dict,
+        stream_state: Optional[dict] = None,
     ) -> List[Message]:
-        messages = super()._postprocess_messages(messages, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        messages = super()._postprocess_messages(messages,
+                                                 fncall_mode=fncall_mode,
+                                                 generate_cfg=generate_cfg,
+                                                 stream_state=stream_state)
         if fncall_mode:
             messages = self.fncall_prompt.postprocess_fncall_messages(
                 messages=messages,
                 parallel_function_calls=generate_cfg.get('parallel_function_calls', False),
                 function_choice=generate_cfg.get('function_choice', 'auto'),
                 thought_in_content=generate_cfg.get('thought_in_content', False),
+                stream_state=stream_state.setdefault('fncall', {}) if (stream_state is not None) else None,
             )
         return messages
 
@@ -141,6 +146,33 @@ class BaseFnCallModel(BaseChatModel, ABC):
         messages = simulate_response_completion_with_chat(messages)
         return self._chat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
 
+    async def _achat_with_functions(
+        self,
+        messages: List[Message],
+        functions: List[Dict],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        if delta_stream:
+            raise NotImplementedError('Please use stream=True with delta_stream=False, because delta_stream=True'
+                                      ' is not implemented for function calling due to some technical reasons.')
+        generate_cfg = copy.deepcopy(generate_cfg)
+        for k in ['parallel_function_calls', 'function_choice', 'thought_in_content']:
+            if k in generate_cfg:
+                del generate_cfg[k]
+        return await self._acontinue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
+
+    async def _acontinue_assistant_response(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+        stream: bool,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        messages = simulate_response_completion_with_chat(messages)
+        return await self._achat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
+
 
 def simulate_response_completion_with_chat(messages: List[Message]) -> List[Message]:
     if messages and (messages[-1].role == ASSISTANT):
@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import copy
 import logging
 import os
+import sys
+import threading
+import weakref
 from pprint import pformat
-from typing import Dict, Iterator, List, Optional
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
 import openai
 
@@ -26,10 +30,101 @@ else:
     from openai import OpenAIError
 
 from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.delta import AsyncDeltaStream, DeltaStream, aiter_text_deltas, iter_text_deltas
 from qwen_agent.llm.function_calling import BaseFnCallModel
 from qwen_agent.llm.schema import ASSISTANT, Message
 from qwen_agent.log import logger
 
+# The default connection pool settings of the shared http clients.
+# They can be overridden by `http_client_cfg` in the LLM config.
+DEFAULT_HTTP_CLIENT_CFG = {
+    'max_connections': 100,
+    'max_keepalive_connections': 20,
+    'keepalive_expiry': 60.0,
+    'http2': True,  # Only takes effect when the `h2` package is installed.
+}
+
+_OAI_CLIENTS: Dict[tuple, Any] = {}
+_OAI_CLIENTS_LOCK = threading.Lock()
+
+# Async clients are bound to the event loop that opens their connections, so they are shared per loop.
+_ASYNC_OAI_CLIENTS: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict]' = weakref.WeakKeyDictionary()
+
+
+def get_openai_client(client_cls: Optional[type] = None, http_client_cfg: Optional[Dict] = None, **api_kwargs) -> Any:
+    """Get a process-wide shared OpenAI client.
+
+    Clients are keyed by the client class, the api kwargs (base_url, api_key, timeout, etc.)
+    and the connection pool settings, so that all LLM instances and threads talking to the same
+    model service reuse one connection pool instead of paying for new TCP/TLS handshakes on every request.
+    """
+    client_cls = client_cls or openai.OpenAI
+    http_client_cfg = {**DEFAULT_HTTP_CLIENT_CFG, **(http_client_cfg or {})}
+    key = _get_client_key(client_cls, http_client_cfg, api_kwargs)
+    with _OAI_CLIENTS_LOCK:
+        client = _OAI_CLIENTS.get(key)
+        if client is None:
+            client = client_cls(http_client=_build_http_client(http_client_cfg), **api_kwargs)
+            _OAI_CLIENTS[key] = client
+    return client
+
+
+def get_async_openai_client(client_cls: Optional[type] = None,
+                            http_client_cfg: Optional[Dict] = None,
+                            **api_kwargs) -> Any:
+    """Get an AsyncOpenAI client shared by all coroutines running in the current event loop."""
+    client_cls = client_cls or openai.AsyncOpenAI
+    http_client_cfg = {**DEFAULT_HTTP_CLIENT_CFG, **(http_client_cfg or {})}
+    key = _get_client_key(client_cls, http_client_cfg, api_kwargs)
+    loop = asyncio.get_running_loop()
+    with _OAI_CLIENTS_LOCK:
+        clients = _ASYNC_OAI_CLIENTS.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = client_cls(http_client=_build_http_client(http_client_cfg, is_async=True), **api_kwargs)
+            clients[key] = client
+    return client
+
+
+def _get_client_key(client_cls: type, http_client_cfg: Dict, api_kwargs: Dict) -> tuple:
+    return (client_cls.__module__, client_cls.__qualname__, tuple(sorted(api_kwargs.items())),
+            tuple(sorted(http_client_cfg.items())))
+
+
+def _build_http_client(http_client_cfg: Dict, is_async: bool = False) -> Any:
+    # Use the http library that the installed openai sdk is built upon (httpx or its forks).
+    httpx = sys.modules[openai.DefaultHttpxClient.__bases__[0].__module__.split('.')[0]]
+
+    http2 = http_client_cfg.get('http2', False)
+    if http2:
+        try:
+            import h2  # noqa
+        except ImportError:
+            logger.debug('HTTP/2 disabled because h2 is not installed. Please `pip install httpx[http2]`.')
+            http2 = False
+    limits = httpx.Limits(
+        max_connections=http_client_cfg.get('max_connections'),
+        max_keepalive_connections=http_client_cfg.get('max_keepalive_connections'),
+        keepalive_expiry=http_client_cfg.get('keepalive_expiry'),
+    )
+    # DefaultHttpxClient keeps the default timeout and redirect settings of the openai sdk.
+    if is_async:
+        return openai.DefaultAsyncHttpxClient(limits=limits, http2=http2)
+    return openai.DefaultHttpxClient(limits=limits, http2=http2)
+
+
+def _convert_generate_cfg_to_v1_kwargs(kwargs: Dict) -> Dict:
+    # OpenAI API v1 does not allow the following args, must pass by extra_body
+    extra_params = ['top_k', 'repetition_penalty']
+    if any((k in kwargs) for k in extra_params):
+        kwargs['extra_body'] = copy.deepcopy(kwargs.get('extra_body', {}))
+        for k in extra_params:
+            if k in kwargs:
+                kwargs['extra_body'][k] = kwargs.pop(k)
+    if 'request_timeout' in kwargs:
+        kwargs['timeout'] = kwargs.pop('request_timeout')
+    return kwargs
+
 
 @register_llm('oai')
 class TextChatAtOAI(BaseFnCallModel):
@@ -55,43 +150,35 @@ class TextChatAtOAI(BaseFnCallModel):
                 openai.api_key = api_key
             self._complete_create = openai.Completion.create
             self._chat_complete_create = openai.ChatCompletion.create
+            self._achat_complete_create = None  # Fall back to the synchronous client in worker threads
         else:
             api_kwargs = {}
             if api_base:
                 api_kwargs['base_url'] = api_base
             if api_key:
                 api_kwargs['api_key'] = api_key
+            if cfg.get('timeout') is not None:
+                api_kwargs['timeout'] = cfg['timeout']
+            http_client_cfg = cfg.get('http_client_cfg')
 
             def _chat_complete_create(*args, **kwargs):
-                # OpenAI API v1 does not allow the following args, must pass by extra_body
-                extra_params = ['top_k', 'repetition_penalty']
-                if any((k in kwargs) for k in extra_params):
-                    kwargs['extra_body'] = copy.deepcopy(kwargs.get('extra_body', {}))
-                    for k in extra_params:
-                        if k in kwargs:
-                            kwargs['extra_body'][k] = kwargs.pop(k)
-                if 'request_timeout' in kwargs:
-                    kwargs['timeout'] = kwargs.pop('request_timeout')
-
-                client = openai.OpenAI(**api_kwargs)
+                kwargs = _convert_generate_cfg_to_v1_kwargs(kwargs)
+                client = get_openai_client(http_client_cfg=http_client_cfg, **api_kwargs)
                 return client.chat.completions.create(*args, **kwargs)
 
             def _complete_create(*args, **kwargs):
-                # OpenAI API v1 does not allow the following args, must pass by extra_body
-                extra_params = ['top_k', 'repetition_penalty']
-                if any((k in kwargs) for k in extra_params):
-                    kwargs['extra_body'] = copy.deepcopy(kwargs.get('extra_body', {}))
-                    for k in extra_params:
-                        if k in kwargs:
-                            kwargs['extra_body'][k] = kwargs.pop(k)
-                if 'request_timeout' in kwargs:
-                    kwargs['timeout'] = kwargs.pop('request_timeout')
-
-                client = openai.OpenAI(**api_kwargs)
+                kwargs = _convert_generate_cfg_to_v1_kwargs(kwargs)
+                client = get_openai_client(http_client_cfg=http_client_cfg, **api_kwargs)
                 return client.completions.create(*args, **kwargs)
 
+            async def _achat_complete_create(*args, **kwargs):
+                kwargs = _convert_generate_cfg_to_v1_kwargs(kwargs)
+                client = get_async_openai_client(http_client_cfg=http_client_cfg, **api_kwargs)
+                return await client.chat.completions.create(*args, **kwargs)
+
             self._complete_create = _complete_create
             self._chat_complete_create = _chat_complete_create
+            self._achat_complete_create = _achat_complete_create
 
     def _chat_stream(
         self,
@@ -99,32 +186,22 @@ class TextChatAtOAI(BaseFnCallModel):
         delta_stream: bool,
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
+        pieces = self._iter_stream_pieces(messages, generate_cfg=generate_cfg)
+        if delta_stream:
+            return _iter_delta_chunks(pieces)
+        return DeltaStream(iter_text_deltas(pieces))
+
+    def _iter_stream_pieces(self, messages: List[Message], generate_cfg: dict) -> Iterator[Tuple[str, str, None]]:
+        # Yield the (content, reasoning_content, extra) appended by each streamed chunk
         messages = self.convert_messages_to_dicts(messages)
         try:
             response = self._chat_complete_create(model=self.model, messages=messages, stream=True, **generate_cfg)
-            if delta_stream:
-                for chunk in response:
-                    if chunk.choices:
-                        if hasattr(chunk.choices[0].delta,
-                                   'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                            yield [
-                                Message(role=ASSISTANT,
-                                        content='',
-                                        reasoning_content=chunk.choices[0].delta.reasoning_content)
-                            ]
-                        if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
-                            yield [Message(role=ASSISTANT, content=chunk.choices[0].delta.content)]
-            else:
-                full_response = ''
-                full_reasoning_content = ''
-                for chunk in response:
-                    if chunk.choices:
-                        if hasattr(chunk.choices[0].delta,
-                                   'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                            full_reasoning_content += chunk.choices[0].delta.reasoning_content
-                        if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
-                            full_response += chunk.choices[0].delta.content
-                        yield [Message(role=ASSISTANT, content=full_response, reasoning_content=full_reasoning_content)]
+            for chunk in response:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    content = getattr(delta, 'content', None) or ''
+                    reasoning_content = getattr(delta, 'reasoning_content', None) or ''
+                    yield content, reasoning_content, None
         except OpenAIError as ex:
             raise ModelServiceError(exception=ex)
 
@@ -147,6 +224,61 @@ class TextChatAtOAI(BaseFnCallModel):
         except OpenAIError as ex:
             raise ModelServiceError(exception=ex)
 
+    def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        if self._achat_complete_create is None:
+            return super()._achat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+        pieces = self._aiter_stream_pieces(messages, generate_cfg=generate_cfg)
+        if delta_stream:
+            return _aiter_delta_chunks(pieces)
+        return AsyncDeltaStream(aiter_text_deltas(pieces))
+
+    async def _aiter_stream_pieces(self, messages: List[Message],
+                                   generate_cfg: dict) -> AsyncIterator[Tuple[str, str, None]]:
+        messages = self.convert_messages_to_dicts(messages)
+        try:
+            response = await self._achat_complete_create(model=self.model,
+                                                         messages=messages,
+                                                         stream=True,
+                                                         **generate_cfg)
+            async for chunk in response:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    content = getattr(delta, 'content', None) or ''
+                    reasoning_content = getattr(delta, 'reasoning_content', None) or ''
+                    yield content, reasoning_content, None
+        except OpenAIError as ex:
+            raise ModelServiceError(exception=ex)
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        if self._achat_complete_create is None:
+            return await super()._achat_no_stream(messages, generate_cfg=generate_cfg)
+
+        messages = self.convert_messages_to_dicts(messages)
+        try:
+            response = await self._achat_complete_create(model=self.model,
+                                                         messages=messages,
+                                                         stream=False,
+                                                         **generate_cfg)
+            if hasattr(response.choices[0].message, 'reasoning_content'):
+                return [
+                    Message(role=ASSISTANT,
+                            content=response.choices[0].message.content,
+                            reasoning_content=response.choices[0].message.reasoning_content)
+                ]
+            else:
+                return [Message(role=ASSISTANT, content=response.choices[0].message.content)]
+        except OpenAIError as ex:
+            raise ModelServiceError(exception=ex)
+
     @staticmethod
     def convert_messages_to_dicts(messages: List[Message]) -> List[dict]:
         # TODO: Change when the VLLM deployed model needs to pass reasoning_complete.
@@ -157,3 +289,19 @@ class TextChatAtOAI(BaseFnCallModel):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f'LLM Input:\n{pformat(messages, indent=2)}')
         return messages
+
+
+def _iter_delta_chunks(pieces: Iterator[Tuple[str, str, None]]) -> Iterator[List[Message]]:
+    for content, reasoning_content, _ in pieces:
+        if reasoning_content:
+            yield [Message(role=ASSISTANT, content='', reasoning_content=reasoning_content)]
+        if content:
+            yield [Message(role=ASSISTANT, content=content)]
+
+
+async def _aiter_delta_chunks(pieces: AsyncIterator[Tuple[str, str, None]]) -> AsyncIterator[List[Message]]:
+    async for content, reasoning_content, _ in pieces:
+        if reasoning_content:
+            yield [Message(role=ASSISTANT, content='', reasoning_content=reasoning_content)]
+        if content:
+            yield [Message(role=ASSISTANT, content=content)]
@@ -18,6 +18,7 @@ from threading import Thread
 from typing import Dict, Iterator, List, Optional
 
 from qwen_agent.llm.base import register_llm
+from qwen_agent.llm.delta import DeltaStream, iter_text_deltas
 from qwen_agent.llm.function_calling import BaseFnCallModel
 from qwen_agent.llm.schema import ASSISTANT, Message
 from qwen_agent.log import logger
@@ -111,6 +112,12 @@ class OpenVINO(BaseFnCallModel):
         delta_stream: bool,
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
+        texts = self._iter_stream_texts(messages, generate_cfg=generate_cfg)
+        if delta_stream:
+            return ([Message(ASSISTANT, new_text)] for new_text in texts)
+        return DeltaStream(iter_text_deltas((new_text, None, None) for new_text in texts))
+
+    def _iter_stream_texts(self, messages: List[Message], generate_cfg: dict) -> Iterator[str]:
         from transformers import TextIteratorStreamer
         generate_cfg = copy.deepcopy(generate_cfg)
         messages_plain = [message.model_dump() for message in messages]
@@ -131,13 +138,8 @@ class OpenVINO(BaseFnCallModel):
 
         t1 = Thread(target=generate_and_signal_complete)
         t1.start()
-        partial_text = ''
         for new_text in streamer:
-            partial_text += new_text
-            if delta_stream:
-                yield [Message(ASSISTANT, new_text)]
-            else:
-                yield [Message(ASSISTANT, partial_text)]
+            yield new_text
 
     def _chat_no_stream(
         self,
@@ -15,11 +15,12 @@
 import os
 from http import HTTPStatus
 from pprint import pformat
-from typing import Dict, Iterator, List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
 
 import dashscope
 
 from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.delta import AsyncDeltaStream, DeltaStream, aiter_text_deltas, iter_text_deltas
 from qwen_agent.llm.function_calling import BaseFnCallModel
 from qwen_agent.llm.schema import ASSISTANT, Message
 from qwen_agent.log import logger
@@ -52,7 +53,7 @@ class QwenChatAtDS(BaseFnCallModel):
         if delta_stream:
             return self._delta_stream_output(response)
         else:
-            return self._full_stream_output(response)
+            return DeltaStream(iter_text_deltas(self._iter_stream_pieces(response)))
 
     def _chat_no_stream(
         self,
@@ -81,6 +82,69 @@ class QwenChatAtDS(BaseFnCallModel):
                                     message=response.message,
                                     extra={'model_service_info': response})
 
+    def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        if not hasattr(dashscope, 'AioGeneration'):
+            # Older versions of dashscope have no asyncio api
+            return super()._achat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+        pieces = self._aiter_stream_pieces(messages, generate_cfg=generate_cfg)
+        if delta_stream:
+            return _aiter_delta_chunks(pieces)
+        return AsyncDeltaStream(aiter_text_deltas(pieces))
+
+    async def _aiter_stream_pieces(self, messages: List[Message],
+                                   generate_cfg: dict) -> AsyncIterator[Tuple[str, str, dict]]:
+        messages = [msg.model_dump() for msg in messages]
+        if messages[-1]['role'] == ASSISTANT:
+            messages[-1]['partial'] = True
+        logger.debug(f'LLM Input:\n{pformat(messages, indent=2)}')
+        response = await dashscope.AioGeneration.call(
+            self.model,
+            messages=messages,  # noqa
+            result_format='message',
+            stream=True,
+            **generate_cfg)
+        async for chunk in response:
+            if chunk.status_code != HTTPStatus.OK:
+                raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
+            content = chunk.output.choices[0].message.content or ''
+            reasoning_content = chunk.output.choices[0].message.get('reasoning_content', '') or ''
+            yield content, reasoning_content, {'model_service_info': chunk}
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        if not hasattr(dashscope, 'AioGeneration'):
+            return await super()._achat_no_stream(messages, generate_cfg=generate_cfg)
+
+        messages = [msg.model_dump() for msg in messages]
+        if messages[-1]['role'] == ASSISTANT:
+            messages[-1]['partial'] = True
+        logger.debug(f'LLM Input:\n{pformat(messages, indent=2)}')
+        response = await dashscope.AioGeneration.call(
+            self.model,
+            messages=messages,  # noqa
+            result_format='message',
+            stream=False,
+            **generate_cfg)
+        if response.status_code == HTTPStatus.OK:
+            return [
+                Message(role=ASSISTANT,
+                        content=response.output.choices[0].message.content,
+                        reasoning_content=response.output.choices[0].message.get('reasoning_content', ''),
+                        extra={'model_service_info': response})
+            ]
+        else:
+            raise ModelServiceError(code=response.code,
+                                    message=response.message,
+                                    extra={'model_service_info': response})
+
     def _continue_assistant_response(
         self,
         messages: List[Message],
@@ -89,6 +153,14 @@ class QwenChatAtDS(BaseFnCallModel):
     ) -> Iterator[List[Message]]:
         return self._chat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
 
+    async def _acontinue_assistant_response(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+        stream: bool,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        return await self._achat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
+
     @staticmethod
     def _delta_stream_output(response) -> Iterator[List[Message]]:
         for chunk in response:
@@ -103,25 +175,22 @@ class QwenChatAtDS(BaseFnCallModel):
                 raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
 
     @staticmethod
-    def _full_stream_output(response) -> Iterator[List[Message]]:
-        full_content = ''
-        full_reasoning_content = ''
+    def _iter_stream_pieces(response) -> Iterator[Tuple[str, str, dict]]:
+        # Yield the (content, reasoning_content, extra) appended by each streamed chunk
         for chunk in response:
             if chunk.status_code == HTTPStatus.OK:
-                if chunk.output.choices[0].message.get('reasoning_content', ''):
-                    full_reasoning_content += chunk.output.choices[0].message.reasoning_content
-                if chunk.output.choices[0].message.content:
-                    full_content += chunk.output.choices[0].message.content
-                yield [
-                    Message(role=ASSISTANT,
-                            content=full_content,
-                            reasoning_content=full_reasoning_content,
-                            extra={'model_service_info': chunk})
-                ]
+                content = chunk.output.choices[0].message.content or ''
+                reasoning_content = chunk.output.choices[0].message.get('reasoning_content', '') or ''
+                yield content, reasoning_content, {'model_service_info': chunk}
             else:
                 raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
 
 
+async def _aiter_delta_chunks(pieces: AsyncIterator[Tuple[str, str, dict]]) -> AsyncIterator[List[Message]]:
+    async for content, reasoning_content, extra in pieces:
+        yield [Message(role=ASSISTANT, content=content, reasoning_content=reasoning_content, extra=extra)]
+
+
 def initialize_dashscope(cfg: Optional[Dict] = None) -> None:
     cfg = cfg or {}
 
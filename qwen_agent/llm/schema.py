@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 from typing import List, Literal, Optional, Tuple, Union
 
 from pydantic import BaseModel, field_validator, model_validator
@@ -34,6 +36,23 @@ AUDIO = 'audio'
 VIDEO = 'video'
 
 
+class FunctionInfo(dict):
+    """The dict describing a function, i.e., its name, description and parameters, whose hash is memoized.
+
+    The hash lets the tool prompt rendered from the functions be looked up without serializing them again, see
+    `get_tool_system`. It must not be modified in place once hashed.
+    """
+
+    @property
+    def digest(self) -> bytes:
+        digest = self.__dict__.get('_digest')
+        if digest is None:
+            text = json.dumps(self, ensure_ascii=False, sort_keys=True, default=str)
+            digest = self._digest = hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'),
+                                                    digest_size=16).digest()
+        return digest
+
+
 class BaseModelCompatibleDict(BaseModel):
 
     def __getitem__(self, item):
@@ -22,8 +22,8 @@ from qwen_agent import Agent
 from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, USER, Message
 from qwen_agent.log import logger
-from qwen_agent.settings import (DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_KEYGEN_STRATEGY,
-                                 DEFAULT_RAG_SEARCHERS)
+from qwen_agent.settings import (DEFAULT_INGESTION_DEADLINE, DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE,
+                                 DEFAULT_RAG_KEYGEN_STRATEGY, DEFAULT_RAG_SEARCHERS)
 from qwen_agent.tools import BaseTool
 from qwen_agent.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
 from qwen_agent.utils.utils import extract_files_from_messages, extract_text_from_message, get_file_type
@@ -49,7 +49,8 @@ class Memory(Agent):
                 'max_ref_token': 4000,
                 'parser_page_size': 500,
                 'rag_keygen_strategy': 'SplitQueryThenGenKeyword',
-                'rag_searchers': ['keyword_search', 'front_page_search']
+                'rag_searchers': ['keyword_search', 'front_page_search'],
+                'ingestion_deadline': 0,  # Seconds to wait before searching the pages parsed so far, 0 to wait for all
               }
               And the above is the default settings.
         """
@@ -58,6 +59,7 @@ class Memory(Agent):
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
         self.rag_searchers = self.cfg.get('rag_searchers', DEFAULT_RAG_SEARCHERS)
         self.rag_keygen_strategy = self.cfg.get('rag_keygen_strategy', DEFAULT_RAG_KEYGEN_STRATEGY)
+        self.ingestion_deadline: float = self.cfg.get('ingestion_deadline', DEFAULT_INGESTION_DEADLINE)
         if not llm:
             # There is no suitable model available for keygen
             self.rag_keygen_strategy = 'none'
@@ -68,6 +70,7 @@ class Memory(Agent):
             'max_ref_token': self.max_ref_token,
             'parser_page_size': self.parser_page_size,
             'rag_searchers': self.rag_searchers,
+            'ingestion_deadline': self.ingestion_deadline,
         }, {
             'name': 'doc_parser',
             'max_ref_token': self.max_ref_token,
@@ -19,18 +19,51 @@ from typing import List, Literal
 # Settings for LLMs
 DEFAULT_MAX_INPUT_TOKENS: int = int(os.getenv(
     'QWEN_AGENT_DEFAULT_MAX_INPUT_TOKENS', 58000))  # The LLM will truncate the input messages if they exceed this limit
+TOKEN_COUNT_CACHE_SIZE: int = int(os.getenv('QWEN_AGENT_TOKEN_COUNT_CACHE_SIZE',
+                                            4096))  # Max number of texts whose token counts are memoized, 0 to disable
+TOKENIZER_CACHE_DIR: str = os.getenv('QWEN_AGENT_TOKENIZER_CACHE_DIR',
+                                     os.path.join(os.path.expanduser('~'), '.cache',
+                                                  'qwen_agent'))  # For the binary vocabulary cache, '' to disable
 
 # Settings for agents
 MAX_LLM_CALL_PER_RUN: int = int(os.getenv('QWEN_AGENT_MAX_LLM_CALL_PER_RUN', 20))
+MAX_TOOL_WORKERS: int = int(os.getenv('QWEN_AGENT_MAX_TOOL_WORKERS',
+                                      1))  # Max number of parallel function calls run concurrently, 1 for sequential
 
 # Settings for tools
 DEFAULT_WORKSPACE: str = os.getenv('QWEN_AGENT_DEFAULT_WORKSPACE', 'workspace')
+CODE_INTERPRETER_POOL_SIZE: int = int(os.getenv('QWEN_AGENT_CODE_INTERPRETER_POOL_SIZE',
+                                                0))  # Number of warm kernels kept for code_interpreter, 0 to disable
+CODE_INTERPRETER_POOL_MAX_IDLE: float = float(os.getenv(
+    'QWEN_AGENT_CODE_INTERPRETER_POOL_MAX_IDLE', 600))  # Seconds without use before the warm kernels are shut down
+DEFAULT_STORAGE_BACKEND: Literal['file', 'sqlite'] = os.getenv(
+    'QWEN_AGENT_DEFAULT_STORAGE_BACKEND', 'file')  # One file per key, or an SQLite database shared by processes
+DEFAULT_STORAGE_COMPRESSION: str = os.getenv('QWEN_AGENT_DEFAULT_STORAGE_COMPRESSION',
+                                             '')  # '', 'zlib' or 'zstd', for the values in the sqlite backend
+
+# Settings for MCP
+MCP_INIT_TIMEOUT: float = float(os.getenv('QWEN_AGENT_MCP_INIT_TIMEOUT',
+                                          60))  # Seconds to wait for connecting to each MCP server
+MCP_HEALTH_CHECK_INTERVAL: float = float(os.getenv('QWEN_AGENT_MCP_HEALTH_CHECK_INTERVAL',
+                                                   30))  # Min seconds between two pings to an MCP server, 0 to disable
+MCP_HEALTH_CHECK_MAX_INTERVAL: float = float(os.getenv(
+    'QWEN_AGENT_MCP_HEALTH_CHECK_MAX_INTERVAL', 300))  # The interval grows up to this while the server stays healthy
 
 # Settings for RAG
 DEFAULT_MAX_REF_TOKEN: int = int(os.getenv('QWEN_AGENT_DEFAULT_MAX_REF_TOKEN',
                                            20000))  # The window size reserved for RAG materials
 DEFAULT_PARSER_PAGE_SIZE: int = int(os.getenv('QWEN_AGENT_DEFAULT_PARSER_PAGE_SIZE',
                                               500))  # Max tokens per chunk when doing RAG
+DEFAULT_PARSER_WORKERS: int = int(os.getenv('QWEN_AGENT_DEFAULT_PARSER_WORKERS',
+                                            1))  # Processes for parsing the files of a query in parallel, 1 for serial
+DEFAULT_PDF_PARSER_WORKERS: int = int(os.getenv('QWEN_AGENT_DEFAULT_PDF_PARSER_WORKERS',
+                                                1))  # Processes for parsing the pages of a large pdf, 1 for serial
+DEFAULT_URL_CHECK_INTERVAL: float = float(os.getenv(
+    'QWEN_AGENT_DEFAULT_URL_CHECK_INTERVAL', 3600))  # Seconds before checking again if an online file has changed
+DEFAULT_PARSER_TIMEOUT: float = float(os.getenv('QWEN_AGENT_DEFAULT_PARSER_TIMEOUT',
+                                                600))  # Seconds allowed for parsing one file in parallel ingestion
+DEFAULT_INGESTION_DEADLINE: float = float(os.getenv(
+    'QWEN_AGENT_DEFAULT_INGESTION_DEADLINE', 0))  # Seconds to wait before searching the parsed pages, 0 to wait for all
 DEFAULT_RAG_KEYGEN_STRATEGY: Literal['None', 'GenKeyword', 'SplitQueryThenGenKeyword', 'GenKeywordWithKnowledge',
                                      'SplitQueryThenGenKeywordWithKnowledge'] = os.getenv(
                                          'QWEN_AGENT_DEFAULT_RAG_KEYGEN_STRATEGY', 'GenKeyword')
@@ -12,20 +12,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .amap_weather import AmapWeather
+import importlib
+
 from .base import TOOL_REGISTRY, BaseTool
-from .code_interpreter import CodeInterpreter
-from .doc_parser import DocParser
-from .extract_doc_vocabulary import ExtractDocVocabulary
-from .image_gen import ImageGen
-from .python_executor import PythonExecutor
-from .retrieval import Retrieval
-from .search_tools import FrontPageSearch, HybridSearch, KeywordSearch, VectorSearch
-from .simple_doc_parser import SimpleDocParser
-from .storage import Storage
-from .web_extractor import WebExtractor
-from .mcp_manager import MCPManager
-from .web_search import WebSearch
+
+# The tools are imported on first access, since some of them pull in heavy dependencies, e.g., pandas and mcp.
+_LAZY_IMPORTS = {
+    'AmapWeather': 'qwen_agent.tools.amap_weather',
+    'CodeInterpreter': 'qwen_agent.tools.code_interpreter',
+    'DocParser': 'qwen_agent.tools.doc_parser',
+    'ExtractDocVocabulary': 'qwen_agent.tools.extract_doc_vocabulary',
+    'ImageGen': 'qwen_agent.tools.image_gen',
+    'PythonExecutor': 'qwen_agent.tools.python_executor',
+    'Retrieval': 'qwen_agent.tools.retrieval',
+    'FrontPageSearch': 'qwen_agent.tools.search_tools',
+    'HybridSearch': 'qwen_agent.tools.search_tools',
+    'KeywordSearch': 'qwen_agent.tools.search_tools',
+    'VectorSearch': 'qwen_agent.tools.search_tools',
+    'SimpleDocParser': 'qwen_agent.tools.simple_doc_parser',
+    'Storage': 'qwen_agent.tools.storage',
+    'WebExtractor': 'qwen_agent.tools.web_extractor',
+    'MCPManager': 'qwen_agent.tools.mcp_manager',
+    'WebSearch': 'qwen_agent.tools.web_search',
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_IMPORTS:
+        value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 __all__ = [
     'BaseTool',
@@ -29,6 +29,8 @@ class AmapWeather(BaseTool):
         'description': '城市/区具体名称，如`北京市海淀区`请描述为`海淀区`',
         'required': True
     }]
+    idempotent = True
+    cache_ttl = 600  # The live weather changes slowly
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
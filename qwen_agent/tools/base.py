@@ -12,16 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import hashlib
 import json
 import os
+import threading
 from abc import ABC, abstractmethod
 from typing import Dict, List, Optional, Union
 
-from qwen_agent.llm.schema import ContentItem
+from qwen_agent.llm.cache import BaseLLMCache, LLMCache, get_cache_key
+from qwen_agent.llm.schema import ContentItem, FunctionInfo
 from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.utils.lazy_registry import LazyRegistry
 from qwen_agent.utils.utils import has_chinese_chars, json_loads, logger, print_traceback, save_url_to_local_work_dir
 
-TOOL_REGISTRY = {}
+# The built-in tools are imported on their first lookup, e.g., TOOL_REGISTRY['code_interpreter'].
+TOOL_REGISTRY = LazyRegistry({
+    'amap_weather': 'qwen_agent.tools.amap_weather',
+    'code_interpreter': 'qwen_agent.tools.code_interpreter',
+    'doc_parser': 'qwen_agent.tools.doc_parser',
+    'extract_doc_vocabulary': 'qwen_agent.tools.extract_doc_vocabulary',
+    'image_gen': 'qwen_agent.tools.image_gen',
+    'retrieval': 'qwen_agent.tools.retrieval',
+    'simple_doc_parser': 'qwen_agent.tools.simple_doc_parser',
+    'storage': 'qwen_agent.tools.storage',
+    'web_extractor': 'qwen_agent.tools.web_extractor',
+    'web_search': 'qwen_agent.tools.web_search',
+    'front_page_search': 'qwen_agent.tools.search_tools.front_page_search',
+    'hybrid_search': 'qwen_agent.tools.search_tools.hybrid_search',
+    'keyword_search': 'qwen_agent.tools.search_tools.keyword_search',
+    'vector_search': 'qwen_agent.tools.search_tools.vector_search',
+})
 
 
 class ToolServiceError(Exception):
@@ -44,7 +65,11 @@ class ToolServiceError(Exception):
 def register_tool(name, allow_overwrite=False):
 
     def decorator(cls):
-        if name in TOOL_REGISTRY:
+        if TOOL_REGISTRY.is_overridden(name, cls):
+            # A custom tool registered before the built-in one of the same name is imported takes precedence
+            cls.name = name
+            return cls
+        if TOOL_REGISTRY.is_taken(name, cls):
             if allow_overwrite:
                 logger.warning(f'Tool `{name}` already exists! Overwriting with class {cls}.')
             else:
@@ -98,21 +123,162 @@ def is_tool_schema(obj: dict) -> bool:
     except AssertionError:
         return False
     try:
-        jsonschema.validate(instance={}, schema=obj['parameters'])
+        get_json_schema_validator(obj['parameters'])
     except jsonschema.exceptions.SchemaError:
         return False
-    except jsonschema.exceptions.ValidationError:
-        pass
     return True
 
 
+# The types of the values that are certainly valid against a JSON schema type, used by the fast path of validation.
+# bool is excluded from integer and number, as JSON Schema does, and the other cases are left to jsonschema.
+_FLAT_TYPE_CHECKS = {
+    'string': lambda v: isinstance(v, str),
+    'integer': lambda v: type(v) is int,
+    'number': lambda v: type(v) in (int, float),
+    'boolean': lambda v: type(v) is bool,
+    'null': lambda v: v is None,
+    'array': lambda v: isinstance(v, list),
+    'object': lambda v: isinstance(v, dict),
+}
+_FLAT_PROPERTY_KEYWORDS = {'type', 'description', 'title', 'default', 'examples', 'enum'}
+_FLAT_SCHEMA_KEYWORDS = {'type', 'properties', 'required', 'title', 'description'}
+
+
+class JsonSchemaValidator:
+    """A compiled validator of a JSON schema, which raises the same errors as `jsonschema.validate`.
+
+    If the schema is a flat object, i.e., its properties only constrain their types and enums, the instances that
+    are certainly valid are accepted without jsonschema. The others, which are usually invalid, are checked by
+    jsonschema, so that the raised errors are the same.
+    """
+
+    def __init__(self, schema: dict):
+        import jsonschema
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        self.validator = cls(schema)
+        self.flat_checks = self._compile_flat_checks(schema)
+
+    @staticmethod
+    def _compile_flat_checks(schema: dict) -> Optional[Dict[str, tuple]]:
+        if (schema.get('type') != 'object') or (not set(schema).issubset(_FLAT_SCHEMA_KEYWORDS)):
+            return None
+        checks = {}
+        for name, prop in schema.get('properties', {}).items():
+            if (not isinstance(prop, dict)) or (not set(prop).issubset(_FLAT_PROPERTY_KEYWORDS)):
+                return None
+            type_check = None
+            if 'type' in prop:
+                if (not isinstance(prop['type'], str)) or (prop['type'] not in _FLAT_TYPE_CHECKS):
+                    return None
+                type_check = _FLAT_TYPE_CHECKS[prop['type']]
+            enum = prop.get('enum')
+            if (enum is not None) and (not all(isinstance(v, str) for v in enum)):
+                return None
+            checks[name] = (type_check, enum)
+        required = schema.get('required', [])
+        if not isinstance(required, list):
+            return None
+        return {'properties': checks, 'required': required}
+
+    def _is_certainly_valid(self, instance) -> bool:
+        if not isinstance(instance, dict):
+            return False
+        for name in self.flat_checks['required']:
+            if name not in instance:
+                return False
+        for name, (type_check, enum) in self.flat_checks['properties'].items():
+            if name not in instance:
+                continue
+            value = instance[name]
+            if (type_check is not None) and (not type_check(value)):
+                return False
+            # Only str values are compared with the enums, since JSON Schema tells apart 1, 1.0 and True
+            if (enum is not None) and ((not isinstance(value, str)) or (value not in enum)):
+                return False
+        return True
+
+    def validate(self, instance):
+        if (self.flat_checks is not None) and self._is_certainly_valid(instance):
+            return
+        from jsonschema.exceptions import best_match
+        error = best_match(self.validator.iter_errors(instance))
+        if error is not None:
+            raise error
+
+
+_json_schema_validators: Dict[bytes, JsonSchemaValidator] = {}
+_json_schema_validators_lock = threading.Lock()
+MAX_CACHED_JSON_SCHEMA_VALIDATORS = 1024
+
+
+def get_json_schema_validator(schema: dict) -> JsonSchemaValidator:
+    """Returns the compiled validator of the schema, which is cached by the hash of the schema.
+
+    Raises:
+        jsonschema.exceptions.SchemaError: If the schema is invalid.
+    """
+    key = json.dumps(schema, ensure_ascii=False, sort_keys=True, default=str)
+    key = hashlib.blake2b(key.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+    validator = _json_schema_validators.get(key)
+    if validator is None:
+        validator = JsonSchemaValidator(schema)
+        with _json_schema_validators_lock:
+            if len(_json_schema_validators) >= MAX_CACHED_JSON_SCHEMA_VALIDATORS:
+                _json_schema_validators.clear()
+            _json_schema_validators[key] = validator
+    return validator
+
+
+_tool_result_caches: Dict[str, LLMCache] = {}
+_tool_result_caches_lock = threading.Lock()
+
+# The keys of the tool cfg that do not affect the results of the tool
+_RESULT_IRRELEVANT_CFG_KEYS = {
+    'name', 'name_for_human', 'args_format', 'max_concurrency', 'idempotent', 'cache_dir', 'cache_cfg'
+}
+
+
+def get_tool_result_cache(tool_name: str,
+                          cfg_digest: str = '',
+                          cache_dir: Optional[str] = None,
+                          **cache_cfg) -> LLMCache:
+    """Returns the result cache of a tool, which is shared by the instances of the tool with the same cfg.
+
+    Sharing the cache lets the agents of a multi-agent session, e.g., GroupChat, reuse each other's tool results.
+
+    Args:
+        tool_name: The name of the tool.
+        cfg_digest: The digest of the tool cfg that may affect the results, e.g., an API token or an endpoint.
+        cache_dir, cache_cfg: The args of `LLMCache`.
+    """
+    key = get_cache_key(tool_name=tool_name, cfg_digest=cfg_digest, cache_dir=cache_dir, cache_cfg=cache_cfg)
+    with _tool_result_caches_lock:
+        cache = _tool_result_caches.get(key)
+        if cache is None:
+            cache = LLMCache(cache_dir=cache_dir, **cache_cfg)
+            _tool_result_caches[key] = cache
+    return cache
+
+
 class BaseTool(ABC):
     name: str = ''
     description: str = ''
     parameters: Union[List[dict], dict] = []
+    max_concurrency: Optional[int] = None  # Max number of concurrent calls to this tool, unlimited if None
+    idempotent: bool = False  # Whether the same arguments always give the same result, so that results can be cached
+    cache_ttl: Optional[float] = None  # Seconds before a cached result expires, never if None
+    result_cache: Optional[BaseLLMCache] = None  # The cache of the results, only used if the tool is idempotent
+    _params_validator: Optional[tuple] = None  # The parameters schema and its compiled validator
+    _result_cfg_digest: str = ''  # The digest of the cfg that may affect the results, a part of the result cache keys
+    _function_info: Optional[tuple] = None  # The name, description and parameters, and the function dict built of them
 
     def __init__(self, cfg: Optional[dict] = None):
         self.cfg = cfg or {}
+        if 'max_concurrency' in self.cfg:
+            self.max_concurrency = self.cfg['max_concurrency']
+        if 'idempotent' in self.cfg:
+            self.idempotent = self.cfg['idempotent']
         if not self.name:
             raise ValueError(
                 f'You must set {self.__class__.__name__}.name, either by @register_tool(name=...) or explicitly setting {self.__class__.__name__}.name'
@@ -122,6 +288,21 @@ class BaseTool(ABC):
                 raise ValueError(
                     'The parameters, when provided as a dict, must confirm to a valid openai-compatible JSON schema.')
 
+        # The results of idempotent tools are cached in memory, and also on disk if `cache_dir` is configured.
+        # A custom cache can be plugged in by assigning a BaseLLMCache object to `self.result_cache`.
+        if self.idempotent:
+            # The results given different cfg, e.g., another API token or endpoint, are cached under different keys
+            result_cfg = {k: v for k, v in self.cfg.items() if k not in _RESULT_IRRELEVANT_CFG_KEYS}
+            result_cfg = json.dumps(result_cfg, ensure_ascii=False, sort_keys=True, default=repr)
+            self._result_cfg_digest = hashlib.blake2b(result_cfg.encode('utf-8', errors='surrogatepass'),
+                                                      digest_size=16).hexdigest()
+            if self.result_cache is None:
+                cache_cfg = {'ttl': self.cache_ttl, **self.cfg.get('cache_cfg', {})}
+                self.result_cache = get_tool_result_cache(self.name,
+                                                          cfg_digest=self._result_cfg_digest,
+                                                          cache_dir=self.cfg.get('cache_dir'),
+                                                          **cache_cfg)
+
     @abstractmethod
     def call(self, params: Union[str, dict], **kwargs) -> Union[str, list, dict, List[ContentItem]]:
         """The interface for calling tools.
@@ -137,6 +318,44 @@ class BaseTool(ABC):
         """
         raise NotImplementedError
 
+    def call_with_cache(self, params: Union[str, dict], **kwargs) -> Union[str, list, dict, List[ContentItem]]:
+        """Call the tool, reusing the cached result of the same arguments if the tool is idempotent.
+
+        Failed calls are not cached. The hit and miss counts are reported by `self.result_cache.stats()`.
+        """
+        if (not self.idempotent) or (self.result_cache is None):
+            return self.call(params, **kwargs)
+        # The cfg digest keeps the entries apart also in a disk tier shared by the tools with different cfg
+        cache_key = get_cache_key(tool=self.name,
+                                  cfg=self._result_cfg_digest,
+                                  params=self._get_cache_key_params(params, **kwargs))
+        entry = self.result_cache.get(cache_key)
+        if entry is not None:
+            return _load_tool_result(entry)
+        result = self.call(params, **kwargs)
+        try:
+            self.result_cache.set(cache_key, _dump_tool_result(result))
+        except (TypeError, ValueError):
+            logger.warning(f'The result of tool `{self.name}` is not cached since it is not JSON serializable.')
+        return result
+
+    def _get_cache_key_params(self, params: Union[str, dict], **kwargs) -> dict:
+        """Normalize the arguments of a call into the params of its cache key.
+
+        The JSON params are parsed, so that the formatting and the order of the keys do not matter. The `files`
+        given to the call are included, while the other kwargs, e.g., `messages`, are not. A tool may override
+        this to further ignore the differences that do not affect its result.
+        """
+        if isinstance(params, str):
+            try:
+                params = json_loads(params)
+            except ValueError:
+                pass
+        key_params = {'params': params}
+        if kwargs.get('files'):
+            key_params['files'] = kwargs['files']
+        return key_params
+
     def _verify_json_format_args(self, params: Union[str, dict], strict_json: bool = False) -> dict:
         """Verify the parameters of the function call"""
         if isinstance(params, str):
@@ -155,21 +374,29 @@ class BaseTool(ABC):
                     if param['name'] not in params_json:
                         raise ValueError('Parameters %s is required!' % param['name'])
         elif isinstance(self.parameters, dict):
-            import jsonschema
-            jsonschema.validate(instance=params_json, schema=self.parameters)
+            # The validator is looked up again only if the parameters are replaced
+            if (self._params_validator is None) or (self._params_validator[0] is not self.parameters):
+                self._params_validator = (self.parameters, get_json_schema_validator(self.parameters))
+            self._params_validator[1].validate(params_json)
         else:
             raise ValueError
         return params_json
 
     @property
-    def function(self) -> dict:  # Bad naming. It should be `function_info`.
-        return {
-            # 'name_for_human': self.name_for_human,
-            'name': self.name,
-            'description': self.description,
-            'parameters': self.parameters,
-            # 'args_format': self.args_format
-        }
+    def function(self) -> FunctionInfo:  # Bad naming. It should be `function_info`.
+        # The same dict is returned until the attributes are replaced, so that its hash is computed only once when
+        # looking up the rendered tool prompt, see `get_tool_system`. Do not modify it in place.
+        info = (self.name, self.description, self.parameters)
+        if (self._function_info is None) or any(a is not b for a, b in zip(self._function_info[0], info)):
+            function = FunctionInfo({
+                # 'name_for_human': self.name_for_human,
+                'name': self.name,
+                'description': self.description,
+                'parameters': self.parameters,
+                # 'args_format': self.args_format
+            })
+            self._function_info = (info, function)
+        return self._function_info[1]
 
     @property
     def name_for_human(self) -> str:
@@ -190,6 +417,19 @@ class BaseTool(ABC):
         return False
 
 
+def _dump_tool_result(result: Union[str, list, dict, List[ContentItem]]) -> dict:
+    if isinstance(result, list) and result and all(isinstance(item, ContentItem) for item in result):
+        return {'content_items': [item.model_dump() for item in result]}
+    # Copy to keep the cached result intact if the caller modifies it
+    return {'result': copy.deepcopy(result)}
+
+
+def _load_tool_result(entry: dict) -> Union[str, list, dict, List[ContentItem]]:
+    if 'content_items' in entry:
+        return [ContentItem(**item) for item in entry['content_items']]
+    return copy.deepcopy(entry['result'])
+
+
 class BaseToolWithFileAccess(BaseTool, ABC):
 
     def __init__(self, cfg: Optional[Dict] = None):
@@ -30,11 +30,12 @@ import threading
 import time
 import uuid
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import json5
 
 from qwen_agent.log import logger
+from qwen_agent.settings import CODE_INTERPRETER_POOL_MAX_IDLE, CODE_INTERPRETER_POOL_SIZE
 from qwen_agent.tools.base import BaseToolWithFileAccess, register_tool
 from qwen_agent.utils.utils import append_signal_handler, extract_code, has_chinese_chars, print_traceback
 
@@ -46,11 +47,18 @@ app.launch_new_instance()
 INIT_CODE_FILE = str(Path(__file__).absolute().parent / 'resource' / 'code_interpreter_init_kernel.py')
 ALIB_FONT_FILE = str(Path(__file__).absolute().parent / 'resource' / 'AlibabaPuHuiTi-3-45-Light.ttf')
 
+Kernel = Tuple[object, subprocess.Popen]  # (kernel client, kernel process)
+
 _KERNEL_CLIENTS: dict = {}
 _MISC_SUBPROCESSES: Dict[str, subprocess.Popen] = {}
+_KERNEL_POOLS: Dict[str, 'KernelPool'] = {}  # Warm kernels shared by the instances with the same work_dir
+_KERNEL_POOLS_LOCK = threading.Lock()
 
 
 def _kill_kernels_and_subprocesses(_sig_num=None, _frame=None):
+    for k in list(_KERNEL_POOLS.keys()):
+        _KERNEL_POOLS.pop(k).close()
+
     for v in _KERNEL_CLIENTS.values():
         v.shutdown()
     for k in list(_KERNEL_CLIENTS.keys()):
@@ -71,10 +79,142 @@ if threading.current_thread() is threading.main_thread():
     append_signal_handler(signal.SIGINT, _kill_kernels_and_subprocesses)
 
 
+class KernelPool:
+    """A pool of started and initialized kernels, kept warm by a background thread.
+
+    Starting a kernel and running the init code takes seconds. The pool does it in advance, so that the first code
+    execution of a new instance does not have to wait. The kernels taken out of the pool are replenished in the
+    background. A released kernel is reset and put back into the pool if `reset_kernel` is provided, otherwise it is
+    shut down, since the states left in it should not be visible to the next user.
+
+    Args:
+        start_kernel: The function to start and initialize a kernel, given a kernel id.
+        reset_kernel: The function to reset a used kernel to the initial state. Used kernels are not reused if None.
+        size: The number of warm kernels to keep.
+        max_idle: Seconds without any acquisition before the warm kernels are shut down. Never shut down if None.
+    """
+
+    def __init__(self,
+                 start_kernel: Callable[[str], Kernel],
+                 reset_kernel: Optional[Callable[[object], None]] = None,
+                 size: int = 1,
+                 max_idle: Optional[float] = None):
+        self.start_kernel = start_kernel
+        self.reset_kernel = reset_kernel
+        self.size = size
+        self.max_idle = max_idle
+
+        self._idle: List[Kernel] = []
+        self._released: List[Kernel] = []
+        self._num_starting = 0
+        self._start_failed = False
+        self._last_acquired = time.time()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def acquire(self) -> Optional[Kernel]:
+        """Take a warm kernel, waiting for the one being started if any. Returns None if no kernel is available."""
+        kernel, dead = None, []
+        with self._cond:
+            self._last_acquired = time.time()
+            self._start_failed = False
+            self._cond.notify_all()
+            while True:
+                while self._idle and (kernel is None):
+                    kernel = self._idle.pop(0)
+                    if kernel[1].poll() is not None:
+                        dead.append(kernel)  # The kernel process has exited
+                        kernel = None
+                if (kernel is not None) or self._closed or self._start_failed or (self._num_starting == 0):
+                    break
+                self._cond.wait()
+        for k in dead:
+            _shutdown_kernel(k)
+        return kernel
+
+    def release(self, kernel: Kernel):
+        """Return a used kernel, which is recycled or shut down in the background."""
+        with self._cond:
+            if not self._closed:
+                self._released.append(kernel)
+                self._cond.notify_all()
+                return
+        _shutdown_kernel(kernel)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            kernels = self._idle + self._released
+            self._idle, self._released = [], []
+            self._cond.notify_all()
+        for kernel in kernels:
+            _shutdown_kernel(kernel)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                expired = (self.max_idle is not None) and (time.time() - self._last_acquired > self.max_idle)
+                if self._released:
+                    task, kernel = 'release', self._released.pop(0)
+                elif expired and self._idle:
+                    task, kernel = 'stop', self._idle.pop()
+                elif (not expired) and (not self._start_failed) and (len(self._idle) + self._num_starting < self.size):
+                    task, kernel = 'start', None
+                    self._num_starting += 1
+                else:
+                    timeout = None
+                    if (not expired) and (self.max_idle is not None):
+                        timeout = self._last_acquired + self.max_idle - time.time() + 0.1
+                    self._cond.wait(timeout)
+                    continue
+
+            if task == 'start':
+                try:
+                    kernel = self.start_kernel(f'pool_{uuid.uuid4()}_{os.getpid()}')
+                except Exception:
+                    print_traceback()
+                    kernel = None
+                with self._cond:
+                    self._num_starting -= 1
+                    if kernel is None:
+                        # Stop replenishing until the next acquisition, instead of retrying in a loop
+                        self._start_failed = True
+                    elif not self._closed:
+                        self._idle.append(kernel)
+                        kernel = None
+                    self._cond.notify_all()
+            elif (task == 'release') and self.reset_kernel and (kernel[1].poll() is None):
+                try:
+                    self.reset_kernel(kernel[0])
+                    with self._cond:
+                        if (not self._closed) and (len(self._idle) + self._num_starting < self.size):
+                            self._idle.append(kernel)
+                            kernel = None
+                            self._cond.notify_all()
+                except Exception:
+                    print_traceback()
+            if kernel is not None:
+                _shutdown_kernel(kernel)
+
+
+def _shutdown_kernel(kernel: Kernel):
+    kc, subproc = kernel
+    try:
+        kc.shutdown()
+    except Exception:
+        print_traceback(is_error=False)
+    subproc.terminate()
+
+
 @register_tool('code_interpreter')
 class CodeInterpreter(BaseToolWithFileAccess):
     description = 'Python code sandbox, which can be used to execute Python code.'
     parameters = [{'name': 'code', 'type': 'string', 'description': 'The python code.', 'required': True}]
+    max_concurrency = 1  # The calls share one kernel
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
@@ -83,6 +223,14 @@ class CodeInterpreter(BaseToolWithFileAccess):
         self.instance_id: str = str(uuid.uuid4())
         _check_deps_for_code_interpreter()
 
+        # Kernels can be started and initialized in advance, which are shared by the instances with the same work_dir.
+        # A kernel is taken from the pool on the first call, and recycled or shut down when the instance is deleted.
+        self.kernel_pool_size: int = self.cfg.get('kernel_pool_size', CODE_INTERPRETER_POOL_SIZE)
+        self.kernel_pool_max_idle: Optional[float] = self.cfg.get('kernel_pool_max_idle',
+                                                                  CODE_INTERPRETER_POOL_MAX_IDLE)
+        self.kernel_pool_recycle: bool = self.cfg.get('kernel_pool_recycle', False)
+        self._get_kernel_pool()  # Start warming up the kernels
+
     @property
     def args_format(self) -> str:
         fmt = self.cfg.get('args_format')
@@ -109,14 +257,13 @@ class CodeInterpreter(BaseToolWithFileAccess):
         if kernel_id in _KERNEL_CLIENTS:
             kc = _KERNEL_CLIENTS[kernel_id]
         else:
-            _fix_matplotlib_cjk_font_issue()
-            self._fix_secure_write_for_code_interpreter()
-            kc, subproc = self._start_kernel(kernel_id)
-            with open(INIT_CODE_FILE) as fin:
-                start_code = fin.read()
-                start_code = start_code.replace('{{M6_FONT_PATH}}', repr(ALIB_FONT_FILE)[1:-1])
-                start_code += '\n%xmode Minimal'
-            logger.info(self._execute_code(kc, start_code))
+            pool = self._get_kernel_pool()
+            kernel = pool.acquire() if pool else None
+            if kernel:
+                kc, subproc = kernel
+                logger.info(f'Acquired a warm kernel (PID = {subproc.pid}) for {kernel_id}.')
+            else:
+                kc, subproc = self._start_and_init_kernel(kernel_id)
             _KERNEL_CLIENTS[kernel_id] = kc
             _MISC_SUBPROCESSES[kernel_id] = subproc
 
@@ -140,6 +287,11 @@ class CodeInterpreter(BaseToolWithFileAccess):
     def __del__(self):
         # Recycle the jupyter subprocess:
         k: str = f'{self.instance_id}_{os.getpid()}'
+        if (k in _KERNEL_CLIENTS) and (k in _MISC_SUBPROCESSES):
+            pool = _KERNEL_POOLS.get(self._get_kernel_pool_key()) if getattr(self, 'kernel_pool_size', 0) > 0 else None
+            if pool:
+                pool.release((_KERNEL_CLIENTS.pop(k), _MISC_SUBPROCESSES.pop(k)))
+                return
         if k in _KERNEL_CLIENTS:
             _KERNEL_CLIENTS[k].shutdown()
             del _KERNEL_CLIENTS[k]
@@ -147,6 +299,43 @@ class CodeInterpreter(BaseToolWithFileAccess):
             _MISC_SUBPROCESSES[k].terminate()
             del _MISC_SUBPROCESSES[k]
 
+    def _get_kernel_pool_key(self) -> str:
+        return f'{os.path.abspath(self.work_dir)}_{os.getpid()}'
+
+    def _get_kernel_pool(self) -> Optional['KernelPool']:
+        if self.kernel_pool_size <= 0:
+            return None
+        key = self._get_kernel_pool_key()
+        with _KERNEL_POOLS_LOCK:
+            if key not in _KERNEL_POOLS:
+                # The kernels are started by a dedicated instance, since the pool outlives the instances using it.
+                starter = type(self)({**self.cfg, 'work_dir': self.work_dir, 'kernel_pool_size': 0})
+                _KERNEL_POOLS[key] = KernelPool(
+                    start_kernel=starter._start_and_init_kernel,
+                    reset_kernel=starter._reset_kernel if self.kernel_pool_recycle else None,
+                    size=self.kernel_pool_size,
+                    max_idle=self.kernel_pool_max_idle)
+            return _KERNEL_POOLS[key]
+
+    def _start_and_init_kernel(self, kernel_id: str):
+        _fix_matplotlib_cjk_font_issue()
+        self._fix_secure_write_for_code_interpreter()
+        kc, subproc = self._start_kernel(kernel_id)
+        self._init_kernel(kc)
+        return kc, subproc
+
+    def _init_kernel(self, kc):
+        with open(INIT_CODE_FILE) as fin:
+            start_code = fin.read()
+            start_code = start_code.replace('{{M6_FONT_PATH}}', repr(ALIB_FONT_FILE)[1:-1])
+            start_code += '\n%xmode Minimal'
+        logger.info(self._execute_code(kc, start_code))
+
+    def _reset_kernel(self, kc):
+        # Clear the variables left by the previous user, and then restore the initial state
+        self._execute_code(kc, '%reset -f')
+        self._init_kernel(kc)
+
     def _fix_secure_write_for_code_interpreter(self):
         if 'linux' in sys.platform.lower():
             os.makedirs(self.work_dir, exist_ok=True)
@@ -16,17 +16,19 @@ import json
 import os
 import re
 import time
-from typing import Dict, List, Optional, Union
+import unicodedata
+from typing import Dict, Iterator, List, Optional, Union
 
 from pydantic import BaseModel
 
 from qwen_agent.log import logger
 from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import BaseTool, register_tool
-from qwen_agent.tools.simple_doc_parser import PARAGRAPH_SPLIT_SYMBOL, SimpleDocParser, get_plain_doc
+from qwen_agent.tools.simple_doc_parser import (PARAGRAPH_SPLIT_SYMBOL, SimpleDocParser, get_parsed_doc_key,
+                                                get_plain_doc)
 from qwen_agent.tools.storage import KeyNotExistsError, Storage
 from qwen_agent.utils.tokenization_qwen import count_tokens, tokenizer
-from qwen_agent.utils.utils import get_basename_from_url, hash_sha256
+from qwen_agent.utils.utils import get_basename_from_url, print_traceback
 
 
 class Chunk(BaseModel):
@@ -52,6 +54,18 @@ class Record(BaseModel):
     def to_dict(self) -> dict:
         return {'url': self.url, 'raw': [x.to_dict() for x in self.raw], 'title': self.title}
 
+    @property
+    def is_partial(self) -> bool:
+        """Whether the record only has the chunks of the pages parsed so far, see `Retrieval.ingestion_deadline`."""
+        return any(chk.metadata.get('partial') for chk in self.raw)
+
+
+# The version of the chunking results. Bump it when the chunker changes, to invalidate the chunked docs in the cache.
+CHUNKER_VERSION = 1
+
+SENTENCE_SPLIT_PATTERN = re.compile(r'\. |。')
+PAGE_MARK_PATTERN = re.compile(r'^\[page: \d+\]$')
+
 
 @register_tool('doc_parser')
 class DocParser(BaseTool):
@@ -70,6 +84,8 @@ class DocParser(BaseTool):
 
         self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
         self.db = Storage({'storage_root_path': self.data_root})
+        # Build the keyword index at ingestion, so that keyword search does not need to re-index the doc per query
+        self.build_keyword_index: bool = self.cfg.get('build_keyword_index', True)
 
         self.doc_extractor = SimpleDocParser({'structured_doc': True})
 
@@ -99,16 +115,33 @@ class DocParser(BaseTool):
 
         url = params['url']
 
-        cached_name_chunking = f'{hash_sha256(url)}_{str(parser_page_size)}'
+        # The chunked doc is cached by the content of the file, see SimpleDocParser
+        content_hash = self.doc_extractor.get_content_hash(url)
+        cached_name_chunking = (f'{get_parsed_doc_key(url, content_hash)}.{CHUNKER_VERSION}'
+                                f'_{str(parser_page_size)}_{str(max_ref_token)}')
         try:
             # Directly load the chunked doc
             record = self.db.get(cached_name_chunking)
             record = json.loads(record)
             logger.info(f'Read chunked {url} from cache.')
+            if record['url'] != url:
+                # The same file under another path
+                record = _replace_record_url(record, url)
             return record
         except KeyNotExistsError:
-            doc = self.doc_extractor.call({'url': url})
+            doc = self.doc_extractor.call({'url': url}, content_hash=content_hash, on_pages=kwargs.get('on_pages'))
 
+        new_record = self.chunk_doc(doc, url, max_ref_token=max_ref_token, parser_page_size=parser_page_size)
+
+        # save the document data, together with its keyword index in one transaction if the backend supports it
+        kvs = self._build_keyword_index(new_record) if self.build_keyword_index else {}
+        new_record = new_record.to_dict()
+        kvs[cached_name_chunking] = json.dumps(new_record, ensure_ascii=False)
+        self.db.put_many(kvs)
+        return new_record
+
+    def chunk_doc(self, doc: List[dict], url: str, max_ref_token: int, parser_page_size: int) -> Record:
+        """Split the parsed doc into chunks, or keep it as one chunk if it fits in max_ref_token."""
         total_token = 0
         for page in doc:
             for para in page['content']:
@@ -132,18 +165,24 @@ class DocParser(BaseTool):
                       },
                       token=total_token)
             ]
-            cached_name_chunking = f'{hash_sha256(url)}_without_chunking'
         else:
             content = self.split_doc_to_chunk(doc, url, title=title, parser_page_size=parser_page_size)
 
         time2 = time.time()
         logger.info(f'Finished chunking {url} ({title}). Time spent: {time2 - time1} seconds.')
+        return Record(url=url, raw=content, title=title)
 
-        # save the document data
-        new_record = Record(url=url, raw=content, title=title).to_dict()
-        new_record_str = json.dumps(new_record, ensure_ascii=False)
-        self.db.put(cached_name_chunking, new_record_str)
-        return new_record
+    def _build_keyword_index(self, record: Record) -> Dict[str, str]:
+        """Build the keyword index of the record, and return it as the key-value pair to save."""
+        try:
+            from qwen_agent.tools.search_tools.keyword_search import get_keyword_index, get_keyword_index_key
+            key = get_keyword_index_key(record)
+            index = get_keyword_index(record, key=key)
+            return {key: json.dumps(index.to_dict(), ensure_ascii=False)}
+        except Exception:
+            print_traceback(is_error=False)
+            logger.warning(f'Failed to build the keyword index of {record.url}, it will be built when searching.')
+            return {}
 
     def split_doc_to_chunk(self,
                            doc: List[dict],
@@ -174,7 +213,7 @@ class DocParser(BaseTool):
                 else:
                     if has_para:
                         # Record one chunk
-                        if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
+                        if isinstance(chunk[-1], str) and PAGE_MARK_PATTERN.fullmatch(chunk[-1]) is not None:
                             chunk.pop()  # Redundant page information
                         res.append(
                             Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
@@ -199,21 +238,7 @@ class DocParser(BaseTool):
                     else:
                         # There are excessively long paragraphs present
                         # Split paragraph to sentences
-                        _sentences = re.split(r'\. |。', txt)
-                        sentences = []
-                        for s in _sentences:
-                            token = count_tokens(s)
-                            if not s.strip() or token == 0:
-                                continue
-                            if token <= available_token:
-                                sentences.append([s, token])
-                            else:
-                                # Limit the length of a sentence to chunk size
-                                token_list = tokenizer.tokenize(s)
-                                for si in range(0, len(token_list), available_token):
-                                    ss = tokenizer.convert_tokens_to_string(
-                                        token_list[si:min(len(token_list), si + available_token)])
-                                    sentences.append([ss, min(available_token, len(token_list) - si)])
+                        sentences = _split_to_sentences(txt, available_token)
                         sent_index = 0
                         while sent_index < len(sentences):
                             s = sentences[sent_index][0]
@@ -230,8 +255,7 @@ class DocParser(BaseTool):
                                 sent_index += 1
                             else:
                                 assert has_para
-                                if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$',
-                                                                               chunk[-1]) is not None:
+                                if isinstance(chunk[-1], str) and PAGE_MARK_PATTERN.fullmatch(chunk[-1]) is not None:
                                     chunk.pop()  # Redundant page information
                                 res.append(
                                     Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
@@ -255,7 +279,7 @@ class DocParser(BaseTool):
                         # Has split this paragraph by sentence
                         idx += 1
         if has_para:
-            if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
+            if isinstance(chunk[-1], str) and PAGE_MARK_PATTERN.fullmatch(chunk[-1]) is not None:
                 chunk.pop()  # Redundant page information
             res.append(
                 Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk]),
@@ -288,11 +312,9 @@ class DocParser(BaseTool):
             sentence_split_symbol = '. '
             if '。' in para:
                 sentence_split_symbol = '。'
-            sentences = re.split(r'\. |。', para)
-            sentences = [sentence.strip() for sentence in sentences if sentence]
-            for j in range(len(sentences) - 1, -1, -1):
-                sent = sentences[j]
-                if not sent.strip():
+            for sent in _iter_last_sentences(para):
+                sent = sent.strip()
+                if not sent:
                     continue
                 if len(sent) <= available_len:
                     if overlap:
@@ -303,3 +325,58 @@ class DocParser(BaseTool):
                 else:
                     return overlap
         return overlap
+
+
+def _split_to_sentences(text: str, max_token: int) -> List[list]:
+    """Split a paragraph into [sentence, token] pairs, and the sentences longer than max_token into pieces.
+
+    Each sentence is tokenized only once. The pieces of a long sentence are cut at the token offsets of that same
+    tokenization, rather than by tokenizing the sentence again.
+    """
+    sentences = []
+    for s in SENTENCE_SPLIT_PATTERN.split(text):
+        if not s.strip():
+            continue
+        ids = tokenizer.encode(s)
+        if len(ids) <= max_token:
+            sentences.append([s, len(ids)])
+        else:
+            # Limit the length of a sentence to chunk size
+            data = unicodedata.normalize('NFC', s).encode('utf-8')  # The text that has been tokenized
+            ends = tokenizer.get_token_offsets(ids)
+            for i in range(0, len(ends), max_token):
+                j = min(i + max_token, len(ends))
+                piece = data[ends[i - 1] if i else 0:ends[j - 1]].decode('utf-8', errors='replace')
+                sentences.append([piece, j - i])
+    return sentences
+
+
+def _iter_last_sentences(text: str) -> Iterator[str]:
+    """Yield the sentences of a paragraph from the last one, i.e., `SENTENCE_SPLIT_PATTERN.split(text)` reversed.
+
+    Only the part of the paragraph consumed by the caller is scanned.
+    """
+    end = len(text)
+    while True:
+        # The separators do not overlap, so they are the same as those found from the start.
+        i, j = text.rfind('. ', 0, end), text.rfind('。', 0, end)
+        if max(i, j) < 0:
+            yield text[:end]
+            return
+        if i > j:
+            yield text[i + 2:end]
+            end = i
+        else:
+            yield text[j + 1:end]
+            end = j
+
+
+def _replace_record_url(record: dict, url: str) -> dict:
+    old_url = record['url']
+    record['url'] = url
+    if record['title'] == get_basename_from_url(old_url):
+        record['title'] = get_basename_from_url(url)
+    for chunk in record['raw']:
+        chunk['metadata']['source'] = url
+        chunk['metadata']['title'] = record['title']
+    return record
@@ -25,6 +25,7 @@ from typing import Dict, Optional, Union
 from dotenv import load_dotenv
 
 from qwen_agent.log import logger
+from qwen_agent.settings import MCP_HEALTH_CHECK_INTERVAL, MCP_HEALTH_CHECK_MAX_INTERVAL, MCP_INIT_TIMEOUT
 from qwen_agent.tools.base import BaseTool
 
 
@@ -46,6 +47,7 @@ class MCPManager:
 
             load_dotenv()  # Load environment variables from .env file
             self.clients: dict = {}
+            self.health_check_task: Optional[asyncio.Task] = None
             self.loop = asyncio.new_event_loop()
             self.loop_thread = threading.Thread(target=self.start_loop, daemon=True)
             self.loop_thread.start()
@@ -133,6 +135,9 @@ class MCPManager:
             # If the "env" key exists, it must be a dictionary
             if 'env' in server and not isinstance(server['env'], dict):
                 return False
+            # If the "idempotent_tools" key exists, it must be a list of the names of the tools whose results are cached
+            if 'idempotent_tools' in server and not isinstance(server['idempotent_tools'], list):
+                return False
         return True
 
     def initConfig(self, config: Dict):
@@ -149,132 +154,205 @@ class MCPManager:
             raise e
 
     async def init_config_async(self, config: Dict):
-        tools: list = []
         mcp_servers = config['mcpServers']
-        for server_name in mcp_servers:
-            client = MCPClient()
-            server = mcp_servers[server_name]
-            await client.connection_server(mcp_server_name=server_name,
-                                           mcp_server=server)  # Attempt to connect to the server
-
-            client_id = server_name + '_' + str(
-                uuid.uuid4())  # To allow the same server name be used across different running agents
-            client.client_id = client_id  # Ensure client_id is set on the client instance
-            self.clients[client_id] = client  # Add to clients dict after successful connection
-            for tool in client.tools:
-                """MCP tool example:
-                {
-                "name": "read_query",
-                "description": "Execute a SELECT query on the SQLite database",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "query": {
-                        "type": "string",
-                        "description": "SELECT SQL query to execute"
-                        }
-                    },
-                    "required": ["query"]
-                }
-                """
-                parameters = tool.inputSchema
-                # The required field in inputSchema may be empty and needs to be initialized.
-                if 'required' not in parameters:
-                    parameters['required'] = []
-                # Remove keys from parameters that do not conform to the standard OpenAI schema
-                # Check if the required fields exist
-                required_fields = {'type', 'properties', 'required'}
-                missing_fields = required_fields - parameters.keys()
-                if missing_fields:
-                    raise ValueError(f'Missing required fields in schema: {missing_fields}')
-
-                # Keep only the necessary fields
-                cleaned_parameters = {
-                    'type': parameters['type'],
-                    'properties': parameters['properties'],
-                    'required': parameters['required']
-                }
-                register_name = server_name + '-' + tool.name
-                agent_tool = self.create_tool_class(register_name=register_name,
-                                                    register_client_id=client_id,
-                                                    tool_name=tool.name,
-                                                    tool_desc=tool.description,
-                                                    tool_parameters=cleaned_parameters)
-                tools.append(agent_tool)
-
-            if client.resources:
-                """MCP resource example:
-                {
-                    uri: string;           // Unique identifier for the resource
-                    name: string;          // Human-readable name
-                    description?: string;  // Optional description
-                    mimeType?: string;     // Optional MIME type
-                }
-                """
-                # List resources
-                list_resources_tool_name = server_name + '-' + 'list_resources'
-                list_resources_params = {'type': 'object', 'properties': {}, 'required': []}
-                list_resources_agent_tool = self.create_tool_class(
-                    register_name=list_resources_tool_name,
-                    register_client_id=client_id,
-                    tool_name='list_resources',
-                    tool_desc='Servers expose a list of concrete resources through this tool. '
-                    'By invoking it, you can discover the available resources and obtain resource templates, which help clients understand how to construct valid URIs. '
-                    'These URI formats will be used as input parameters for the read_resource function. ',
-                    tool_parameters=list_resources_params)
-                tools.append(list_resources_agent_tool)
-
-                # Read resource
-                resources_template_str = ''  # Check if there are resource templates
-                try:
-                    list_resource_templates = await client.session.list_resource_templates(
-                    )  # Check if the server has resources tesmplate
-                    if list_resource_templates.resourceTemplates:
-                        resources_template_str = '\n'.join(
-                            str(template) for template in list_resource_templates.resourceTemplates)
+        server_names = list(mcp_servers)
+        # Connect to the servers concurrently. A server that fails to connect does not affect the others.
+        results = await asyncio.gather(*[self.init_server_async(name, mcp_servers[name]) for name in server_names],
+                                       return_exceptions=True)
+        tools: list = []
+        errors = []
+        for server_name, result in zip(server_names, results):
+            if isinstance(result, BaseException):
+                logger.warning(f'Failed in initializing MCP server {server_name}: {result}')
+                errors.append(result)
+            else:
+                tools.extend(result)
+        if errors and (len(errors) == len(server_names)):
+            raise errors[0]
+        self.start_health_check()
+        return tools
 
-                except Exception as e:
-                    logger.info(f'Failed in listing MCP resource templates: {e}')
-
-                read_resource_tool_name = server_name + '-' + 'read_resource'
-                read_resource_params = {
-                    'type': 'object',
-                    'properties': {
-                        'uri': {
-                            'type': 'string',
-                            'description': 'The URI identifying the specific resource to access'
-                        }
-                    },
-                    'required': ['uri']
-                }
-                original_tool_desc = 'Request to access a resource provided by a connected MCP server. Resources represent data sources that can be used as context, such as files, API responses, or system information.'
-                if resources_template_str:
-                    tool_desc = original_tool_desc + '\nResource Templates:\n' + resources_template_str
-                else:
-                    tool_desc = original_tool_desc
-                read_resource_agent_tool = self.create_tool_class(register_name=read_resource_tool_name,
-                                                                  register_client_id=client_id,
-                                                                  tool_name='read_resource',
-                                                                  tool_desc=tool_desc,
-                                                                  tool_parameters=read_resource_params)
-                tools.append(read_resource_agent_tool)
+    async def init_server_async(self, server_name: str, server: dict) -> list:
+        tools: list = []
+        client = MCPClient()
+        timeout = server.get('init_timeout', MCP_INIT_TIMEOUT)
+        try:
+            await asyncio.wait_for(client.connection_server(mcp_server_name=server_name, mcp_server=server),
+                                   timeout=timeout or None)  # Attempt to connect to the server
+        except asyncio.TimeoutError:
+            try:
+                await client.cleanup()
+            except Exception:
+                pass
+            raise TimeoutError(f'Connecting to MCP server {server_name} timed out after {timeout} seconds')
+
+        client_id = server_name + '_' + str(
+            uuid.uuid4())  # To allow the same server name be used across different running agents
+        client.client_id = client_id  # Ensure client_id is set on the client instance
+        self.clients[client_id] = client  # Add to clients dict after successful connection
+        for tool in client.tools:
+            """MCP tool example:
+            {
+            "name": "read_query",
+            "description": "Execute a SELECT query on the SQLite database",
+            "inputSchema": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                    "type": "string",
+                    "description": "SELECT SQL query to execute"
+                    }
+                },
+                "required": ["query"]
+            }
+            """
+            parameters = tool.inputSchema
+            # The required field in inputSchema may be empty and needs to be initialized.
+            if 'required' not in parameters:
+                parameters['required'] = []
+            # Remove keys from parameters that do not conform to the standard OpenAI schema
+            # Check if the required fields exist
+            required_fields = {'type', 'properties', 'required'}
+            missing_fields = required_fields - parameters.keys()
+            if missing_fields:
+                raise ValueError(f'Missing required fields in schema: {missing_fields}')
+
+            # Keep only the necessary fields
+            cleaned_parameters = {
+                'type': parameters['type'],
+                'properties': parameters['properties'],
+                'required': parameters['required']
+            }
+            register_name = server_name + '-' + tool.name
+            agent_tool = self.create_tool_class(register_name=register_name,
+                                                register_client_id=client_id,
+                                                tool_name=tool.name,
+                                                tool_desc=tool.description,
+                                                tool_parameters=cleaned_parameters,
+                                                tool_idempotent=tool.name in server.get('idempotent_tools', []),
+                                                tool_cache_ttl=server.get('cache_ttl'))
+            tools.append(agent_tool)
+
+        if client.resources:
+            """MCP resource example:
+            {
+                uri: string;           // Unique identifier for the resource
+                name: string;          // Human-readable name
+                description?: string;  // Optional description
+                mimeType?: string;     // Optional MIME type
+            }
+            """
+            # List resources
+            list_resources_tool_name = server_name + '-' + 'list_resources'
+            list_resources_params = {'type': 'object', 'properties': {}, 'required': []}
+            list_resources_agent_tool = self.create_tool_class(
+                register_name=list_resources_tool_name,
+                register_client_id=client_id,
+                tool_name='list_resources',
+                tool_desc='Servers expose a list of concrete resources through this tool. '
+                'By invoking it, you can discover the available resources and obtain resource templates, which help clients understand how to construct valid URIs. '
+                'These URI formats will be used as input parameters for the read_resource function. ',
+                tool_parameters=list_resources_params)
+            tools.append(list_resources_agent_tool)
+
+            # Read resource
+            resources_template_str = ''  # Check if there are resource templates
+            try:
+                list_resource_templates = await client.session.list_resource_templates(
+                )  # Check if the server has resources tesmplate
+                if list_resource_templates.resourceTemplates:
+                    resources_template_str = '\n'.join(
+                        str(template) for template in list_resource_templates.resourceTemplates)
+
+            except Exception as e:
+                logger.info(f'Failed in listing MCP resource templates: {e}')
+
+            read_resource_tool_name = server_name + '-' + 'read_resource'
+            read_resource_params = {
+                'type': 'object',
+                'properties': {
+                    'uri': {
+                        'type': 'string',
+                        'description': 'The URI identifying the specific resource to access'
+                    }
+                },
+                'required': ['uri']
+            }
+            original_tool_desc = 'Request to access a resource provided by a connected MCP server. Resources represent data sources that can be used as context, such as files, API responses, or system information.'
+            if resources_template_str:
+                tool_desc = original_tool_desc + '\nResource Templates:\n' + resources_template_str
+            else:
+                tool_desc = original_tool_desc
+            read_resource_agent_tool = self.create_tool_class(register_name=read_resource_tool_name,
+                                                              register_client_id=client_id,
+                                                              tool_name='read_resource',
+                                                              tool_desc=tool_desc,
+                                                              tool_parameters=read_resource_params)
+            tools.append(read_resource_agent_tool)
 
         return tools
 
-    def create_tool_class(self, register_name, register_client_id, tool_name, tool_desc, tool_parameters):
+    def start_health_check(self):
+        if (MCP_HEALTH_CHECK_INTERVAL > 0) and (self.health_check_task is None or self.health_check_task.done()):
+            self.health_check_task = asyncio.get_running_loop().create_task(self.health_check_async())
+
+    async def health_check_async(self):
+        """Check the sessions in the background, and reconnect to the servers that are no longer alive.
+
+        The interval between two checks of a server doubles after each successful check, up to
+        MCP_HEALTH_CHECK_MAX_INTERVAL, and is reset after a failure. A successful tool call also counts as a check.
+        """
+        while self.clients:
+            now = time.monotonic()
+            due = [(client_id, client) for client_id, client in self.clients.items() if client.next_check_time <= now]
+            await asyncio.gather(*[self.check_client_async(client_id, client) for client_id, client in due])
+            if self.clients:
+                # Wake up at least every min interval, in case of new or reconnected clients
+                next_check_time = min(client.next_check_time for client in self.clients.values())
+                await asyncio.sleep(min(max(next_check_time - time.monotonic(), 1), MCP_HEALTH_CHECK_INTERVAL))
+
+    async def check_client_async(self, client_id: str, client: 'MCPClient'):
+        if time.monotonic() - client.last_active_time >= client.health_check_interval:
+            try:
+                await asyncio.wait_for(client.session.send_ping(), timeout=MCP_HEALTH_CHECK_INTERVAL)
+            except Exception as e:
+                logger.info(f'Session of MCP server {client.server_name} is not alive, try reconnect: {e!r}')
+                try:
+                    new_client = await asyncio.wait_for(client.reconnect(), timeout=MCP_INIT_TIMEOUT or None)
+                    if self.clients.get(client_id) is client:
+                        self.clients[client_id] = new_client
+                except Exception as e2:
+                    logger.info(f'Failed in reconnecting to MCP server {client.server_name}: {e2!r}')
+                    client.health_check_interval = MCP_HEALTH_CHECK_INTERVAL
+                    client.next_check_time = time.monotonic() + client.health_check_interval
+                return
+        client.health_check_interval = min(client.health_check_interval * 2, MCP_HEALTH_CHECK_MAX_INTERVAL)
+        client.mark_alive()
+
+    def create_tool_class(self,
+                          register_name,
+                          register_client_id,
+                          tool_name,
+                          tool_desc,
+                          tool_parameters,
+                          tool_idempotent=False,
+                          tool_cache_ttl=None):
 
         class ToolClass(BaseTool):
             name = register_name
             description = tool_desc
             parameters = tool_parameters
             client_id = register_client_id
+            idempotent = tool_idempotent
+            cache_ttl = tool_cache_ttl
 
             def call(self, params: Union[str, dict], **kwargs) -> str:
                 tool_args = json.loads(params)
                 # Submit coroutine to the event loop and wait for the result
                 manager = MCPManager()
                 client = manager.clients[self.client_id]
-                future = asyncio.run_coroutine_threadsafe(client.execute_function(tool_name, tool_args), manager.loop)
+                future = asyncio.run_coroutine_threadsafe(
+                    client.execute_function(tool_name, tool_args, idempotent=self.idempotent), manager.loop)
                 try:
                     result = future.result()
                     return result
@@ -286,6 +364,8 @@ class MCPManager:
         return ToolClass()
 
     def shutdown(self):
+        if self.health_check_task is not None:
+            self.loop.call_soon_threadsafe(self.health_check_task.cancel)
         futures = []
         for client_id in list(self.clients.keys()):
             client: MCPClient = self.clients[client_id]
@@ -321,6 +401,25 @@ class MCPClient:
         self._last_mcp_server = None
         self.client_id = None  # For replacing in MCPManager.clients
 
+        # States of the health check, see MCPManager.health_check_async
+        self.health_check_interval: float = MCP_HEALTH_CHECK_INTERVAL
+        self.next_check_time: float = 0.0
+        self.last_active_time: float = float('-inf')  # When the session was last known to be alive
+
+    @property
+    def server_name(self) -> Optional[str]:
+        return self._last_mcp_server_name
+
+    def mark_alive(self):
+        self.last_active_time = time.monotonic()
+        self.next_check_time = self.last_active_time + self.health_check_interval
+
+    def is_recently_alive(self) -> bool:
+        # The health check runs every health_check_interval seconds. Allow one more min interval for it to finish.
+        if MCP_HEALTH_CHECK_INTERVAL <= 0:
+            return False
+        return time.monotonic() - self.last_active_time < self.health_check_interval + MCP_HEALTH_CHECK_INTERVAL
+
     async def connection_server(self, mcp_server_name, mcp_server):
         from mcp import ClientSession, StdioServerParameters
         from mcp.client.sse import sse_client
@@ -381,6 +480,7 @@ class MCPClient:
             except Exception:
                 # logger.info(f"No list resources: {e}")
                 pass
+            self.mark_alive()
         except Exception as e:
             logger.warning(f'Failed in connecting to MCP server: {e}')
             raise e
@@ -396,27 +496,52 @@ class MCPClient:
         await new_client.connection_server(self._last_mcp_server_name, self._last_mcp_server)
         return new_client
 
-    async def execute_function(self, tool_name, tool_args: dict):
-        from mcp.types import TextResourceContents
+    async def execute_function(self, tool_name, tool_args: dict, idempotent: bool = False, retried: bool = False):
+        """Execute a tool, reconnecting at most once per call if the session is broken.
 
-        # Check if session is alive
+        The call is sent again on the new session only if it has surely not been sent (i.e., the ping fails), or if the
+        tool is idempotent. Otherwise, it may have already run on the server, and the error is returned instead.
+        """
+        # The session is checked by MCPManager in the background. Ping it only if it is not known to be alive recently.
         try:
-            await self.session.send_ping()
+            if not self.is_recently_alive():
+                await self.session.send_ping()
         except Exception as e:
-            logger.info(f"Session is not alive, please increase 'sse_read_timeout' in the config, try reconnect: {e}")
-            # Auto reconnect
-            try:
-                from qwen_agent.tools.mcp_manager import MCPManager
-                manager = MCPManager()
-                if self.client_id is not None:
-                    manager.clients[self.client_id] = await self.reconnect()
-                    return await manager.clients[self.client_id].execute_function(tool_name, tool_args)
-                else:
-                    logger.info('Reconnect failed: client_id is None')
-                    return 'Session reconnect (client creation) exception: client_id is None'
-            except Exception as e3:
-                logger.info(f'Reconnect (client creation) exception type: {type(e3)}, value: {repr(e3)}')
-                return f'Session reconnect (client creation) exception: {e3}'
+            if retried:
+                raise
+            return await self._reconnect_and_execute_function(tool_name, tool_args, e, resend=True)
+        try:
+            result = await self._execute_function(tool_name, tool_args)
+        except Exception as e:
+            if retried or (not _is_connection_error(e)):
+                raise
+            resend = idempotent or (tool_name in ('list_resources', 'read_resource'))
+            return await self._reconnect_and_execute_function(tool_name, tool_args, e, resend=resend)
+        self.mark_alive()
+        return result
+
+    async def _reconnect_and_execute_function(self, tool_name, tool_args: dict, e: Exception, resend: bool):
+        logger.info(f"Session is not alive, please increase 'sse_read_timeout' in the config, try reconnect: {e}")
+        # Auto reconnect
+        try:
+            from qwen_agent.tools.mcp_manager import MCPManager
+            manager = MCPManager()
+            if self.client_id is not None:
+                manager.clients[self.client_id] = await self.reconnect()
+                if not resend:
+                    # The request may have reached the server, and a non-idempotent tool must not run twice
+                    return f'Session reconnected, but the tool call is not retried since it may have run: {e}'
+                return await manager.clients[self.client_id].execute_function(tool_name, tool_args, retried=True)
+            else:
+                logger.info('Reconnect failed: client_id is None')
+                return 'Session reconnect (client creation) exception: client_id is None'
+        except Exception as e3:
+            logger.info(f'Reconnect (client creation) exception type: {type(e3)}, value: {repr(e3)}')
+            return f'Session reconnect (client creation) exception: {e3}'
+
+    async def _execute_function(self, tool_name, tool_args: dict):
+        from mcp.types import TextResourceContents
+
         if tool_name == 'list_resources':
             try:
                 list_resources = await self.session.list_resources()
@@ -462,6 +587,17 @@ class MCPClient:
         await self.exit_stack.aclose()
 
 
+def _is_connection_error(e: Exception) -> bool:
+    import anyio
+    if isinstance(e, (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream, ConnectionError)):
+        return True
+    try:
+        from mcp.types import CONNECTION_CLOSED
+    except ImportError:
+        return False
+    return getattr(getattr(e, 'error', None), 'code', None) == CONNECTION_CLOSED  # The McpError of a closed session
+
+
 def _cleanup_mcp(_sig_num=None, _frame=None):
     if MCPManager._instance is None:
         return
@@ -12,13 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import copy
 import datetime
 import io
 import os
 import pickle
+import threading
 import traceback
-from concurrent.futures import TimeoutError
+from concurrent.futures import Future, TimeoutError
 from contextlib import redirect_stdout
 from functools import partial
 from typing import Any, Dict, List, Optional, Union
@@ -92,6 +94,46 @@ def _check_deps_for_python_executor():
             'Please install the required dependencies by running: pip install "qwen-agent[python_executor]"') from e
 
 
+_PROCESS_POOLS: Dict[tuple, Any] = {}
+_PROCESS_POOLS_LOCK = threading.Lock()
+
+
+def _warm_up_worker():
+    # Import the commonly used modules in advance, so that the first snippet run by each worker does not pay for it.
+    import math  # noqa
+    for module in ['numpy', 'sympy']:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+
+def _get_process_pool(max_workers: int):
+    """Get the long-lived worker pool shared by the executors, which is created on first use.
+
+    The pool restarts a worker only when the task running in it times out or crashes.
+    """
+    from pebble import ProcessPool
+    key = (max_workers, os.getpid())
+    with _PROCESS_POOLS_LOCK:
+        pool = _PROCESS_POOLS.get(key)
+        if (pool is None) or (not pool.active):
+            if not _PROCESS_POOLS:
+                # Registered after importing pebble, so that it runs before the exit handler of multiprocessing
+                atexit.register(_stop_process_pools)
+            pool = ProcessPool(max_workers=max_workers, initializer=_warm_up_worker)
+            pool.schedule(int)  # The workers are started upon the first task
+            _PROCESS_POOLS[key] = pool
+        return pool
+
+
+def _stop_process_pools():
+    for key in list(_PROCESS_POOLS.keys()):
+        pool = _PROCESS_POOLS.pop(key)
+        pool.stop()
+        pool.join()
+
+
 # @register_tool('python_executor')  # Do not register this tool by default because it is dangerous.
 class PythonExecutor(BaseTool):
     name = 'python_executor'
@@ -100,8 +142,6 @@ class PythonExecutor(BaseTool):
 
     def __init__(self, cfg: Optional[Dict] = None):
         _check_deps_for_python_executor()
-        import multiprocess
-        from multiprocess import Pool
         super().__init__(cfg)
 
         runtime: Optional[Any] = self.cfg.get('runtime', None)
@@ -109,13 +149,20 @@ class PythonExecutor(BaseTool):
         get_answer_expr: Optional[str] = self.cfg.get('get_answer_expr', None)
         get_answer_from_stdout: bool = self.cfg.get('get_answer_from_stdout', True)
         timeout_length: int = self.cfg.get('timeout_length', 20)
+        max_workers: int = self.cfg.get('max_workers', os.cpu_count())
+        max_queue_size: int = self.cfg.get('max_queue_size', 4 * max_workers)
 
         self.runtime = runtime if runtime else GenericRuntime()
         self.answer_symbol = get_answer_symbol
         self.answer_expr = get_answer_expr
         self.get_answer_from_stdout = get_answer_from_stdout
-        self.pool = Pool(multiprocess.cpu_count())
         self.timeout_length = timeout_length
+        self.max_workers = max_workers
+        # Limit the number of pending snippets, so that a long stream of submissions does not pile up in memory
+        self._queue_slots = threading.BoundedSemaphore(max_queue_size)
+        if self.cfg.get('warm_up', True):
+            # The workers are started and warmed up in the background, while the agent is e.g. calling the LLM
+            _get_process_pool(self.max_workers)
 
     def call(self, params: Union[str, dict], **kwargs) -> list:
         try:
@@ -177,47 +224,58 @@ class PythonExecutor(BaseTool):
             s = s[:half] + '...' + s[-half:]
         return s
 
+    def submit(self, code_snippet: List[str]) -> Future:
+        """Schedule the lines of a snippet to run in the worker pool, blocking while the queue of this executor is full.
+
+        Returns:
+            A future of the (result, report) tuple, which raises TimeoutError if the execution times out.
+        """
+        executor = partial(
+            self.execute,
+            get_answer_from_stdout=self.get_answer_from_stdout,
+            runtime=self.runtime,
+            answer_symbol=self.answer_symbol,
+            answer_expr=self.answer_expr,
+            timeout_length=self.timeout_length,  # this timeout not work
+        )
+        self._queue_slots.acquire()
+        try:
+            pool = _get_process_pool(self.max_workers)
+            future = pool.schedule(executor, args=(code_snippet,), timeout=self.timeout_length)
+        except BaseException:
+            self._queue_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._queue_slots.release())
+        return future
+
     def batch_apply(self, batch_code: List[str]) -> list:
-        from pebble import ProcessPool
         all_code_snippets = self.process_generation_to_code(batch_code)
 
         timeout_cnt = 0
         all_exec_results = []
-        with ProcessPool(max_workers=min(len(all_code_snippets), os.cpu_count())) as pool:
-            executor = partial(
-                self.execute,
-                get_answer_from_stdout=self.get_answer_from_stdout,
-                runtime=self.runtime,
-                answer_symbol=self.answer_symbol,
-                answer_expr=self.answer_expr,
-                timeout_length=self.timeout_length,  # this timeout not work
-            )
-            future = pool.map(executor, all_code_snippets, timeout=self.timeout_length)
-            iterator = future.result()
-
-            if len(all_code_snippets) > 100:
-                progress_bar = tqdm(total=len(all_code_snippets), desc='Execute')
-            else:
-                progress_bar = None
-
-            while True:
-                try:
-                    result = next(iterator)
-                    all_exec_results.append(result)
-                except StopIteration:
-                    break
-                except TimeoutError as error:
-                    print(error)
-                    all_exec_results.append(('', 'Timeout Error'))
-                    timeout_cnt += 1
-                except Exception as error:
-                    print(error)
-                    exit()
-                if progress_bar is not None:
-                    progress_bar.update(1)
-
+        if len(all_code_snippets) > 100:
+            progress_bar = tqdm(total=len(all_code_snippets), desc='Execute')
+        else:
+            progress_bar = None
+
+        # Submitting blocks while the queue is full, until some of the previous snippets are finished
+        futures = [self.submit(code_snippet) for code_snippet in all_code_snippets]
+        for future in futures:
+            try:
+                result = future.result()
+                all_exec_results.append(result)
+            except TimeoutError as error:
+                print(error)
+                all_exec_results.append(('', 'Timeout Error'))
+                timeout_cnt += 1
+            except Exception as error:
+                print(error)
+                exit()
             if progress_bar is not None:
-                progress_bar.close()
+                progress_bar.update(1)
+
+        if progress_bar is not None:
+            progress_bar.close()
 
         batch_results = []
         for code, (res, report) in zip(all_code_snippets, all_exec_results):
@@ -12,11 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict, Optional, Union
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple, Union
 
 import json5
 
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_SEARCHERS
+from qwen_agent.log import logger
+from qwen_agent.settings import (DEFAULT_INGESTION_DEADLINE, DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE,
+                                 DEFAULT_PARSER_TIMEOUT, DEFAULT_PARSER_WORKERS, DEFAULT_RAG_SEARCHERS)
 from qwen_agent.tools.base import TOOL_REGISTRY, BaseTool, register_tool
 from qwen_agent.tools.doc_parser import DocParser, Record
 from qwen_agent.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
@@ -38,6 +49,147 @@ def _check_deps_for_rag():
                           'Please install the required dependencies by running: pip install "qwen-agent[rag]"') from e
 
 
+# A pool is shared by the calls with the same number of workers, and comes with a queue on which its workers report
+# when they start parsing a task, since a submitted task may wait in the pool for long.
+_PARSER_POOLS: Dict[int, Tuple[ProcessPoolExecutor, multiprocessing.Queue]] = {}
+_PARSER_POOLS_LOCK = threading.Lock()
+_KILLED_PARSER_POOLS = weakref.WeakSet()
+_PARSER_TASK_IDS = itertools.count()
+_PARSER_TASK_START_TIMES: Dict[int, float] = {}
+_WORKER_DOC_PARSERS: Dict[tuple, DocParser] = {}
+_WORKER_START_QUEUE: Optional[multiprocessing.Queue] = None
+
+
+def _reset_parser_pools_in_child():
+    # The pools of the parent process are unusable in a forked child, and the lock may be held by another thread
+    global _PARSER_POOLS_LOCK
+    _PARSER_POOLS_LOCK = threading.Lock()
+    _PARSER_POOLS.clear()
+    _PARSER_TASK_START_TIMES.clear()
+
+
+os.register_at_fork(after_in_child=_reset_parser_pools_in_child)
+
+
+def _get_parser_pool(max_workers: int) -> Tuple[ProcessPoolExecutor, multiprocessing.Queue]:
+    """Get the long-lived process pool for parsing files and its queue of start times, created on first use."""
+    with _PARSER_POOLS_LOCK:
+        pool, start_queue = _PARSER_POOLS.get(max_workers, (None, None))
+        if (pool is None) or getattr(pool, '_broken', False):
+            mp_context = multiprocessing.get_context()
+            start_queue = mp_context.Queue()
+            pool = ProcessPoolExecutor(max_workers=max_workers,
+                                       mp_context=mp_context,
+                                       initializer=_init_parser_worker,
+                                       initargs=(start_queue,))
+            _PARSER_POOLS[max_workers] = (pool, start_queue)
+        return pool, start_queue
+
+
+def _kill_parser_pool(pool: ProcessPoolExecutor):
+    # The only way to stop a parsing stuck in a worker process
+    with _PARSER_POOLS_LOCK:
+        for key in [k for k, v in _PARSER_POOLS.items() if v[0] is pool]:
+            del _PARSER_POOLS[key]
+        _KILLED_PARSER_POOLS.add(pool)
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for p in processes:
+        p.kill()
+
+
+def _poll_parser_start_times(start_queue: multiprocessing.Queue):
+    # The queue is drained by whichever call polls first, so the start times are kept for all the calls
+    with _PARSER_POOLS_LOCK:
+        while True:
+            try:
+                task_id, start_time = start_queue.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                break
+            _PARSER_TASK_START_TIMES[task_id] = start_time
+
+
+def _init_parser_worker(start_queue: multiprocessing.Queue):
+    global _WORKER_START_QUEUE
+    _WORKER_START_QUEUE = start_queue
+
+
+def _parse_file_in_worker(cfg: dict, params: dict, kwargs: dict, task_id: Optional[int] = None) -> dict:
+    if (_WORKER_START_QUEUE is not None) and (task_id is not None):
+        _WORKER_START_QUEUE.put((task_id, time.time()))
+    key = tuple(sorted(cfg.items()))
+    if key not in _WORKER_DOC_PARSERS:
+        _WORKER_DOC_PARSERS[key] = DocParser(cfg)
+    return _WORKER_DOC_PARSERS[key].call(params=params, **kwargs)
+
+
+class Ingestion:
+    """The parsing of a file in a background thread, whose parsed pages can be searched before it finishes.
+
+    The parsing is completed and cached even if nobody waits for it, but the thread is a daemon, so that it does
+    not hold the exit of the interpreter.
+    """
+
+    def __init__(self, doc_parser: DocParser, url: str, kwargs: dict):
+        self.doc_parser = doc_parser
+        self.url = url
+        self.kwargs = kwargs
+        self.record: Optional[dict] = None
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+        self._pages = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            self.record = self.doc_parser.call(params={'url': self.url}, on_pages=self._add_pages, **self.kwargs)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.done.set()
+            with _INGESTIONS_LOCK:
+                _INGESTIONS.pop(_get_ingestion_key(self.doc_parser, self.url, self.kwargs), None)
+
+    def _add_pages(self, pages: List[dict]):
+        with self._lock:
+            self._pages.extend(pages)
+
+    def get_partial_record(self) -> Optional[dict]:
+        """Chunk the pages parsed so far, or return None if there is none yet."""
+        with self._lock:
+            pages = list(self._pages)
+        if not pages:
+            return None
+        max_ref_token = self.kwargs.get('max_ref_token', self.doc_parser.max_ref_token)
+        parser_page_size = self.kwargs.get('parser_page_size', self.doc_parser.parser_page_size)
+        record = self.doc_parser.chunk_doc(pages,
+                                           self.url,
+                                           max_ref_token=max_ref_token,
+                                           parser_page_size=parser_page_size)
+        for chk in record.raw:
+            chk.metadata['partial'] = True  # Not to persist the indexes of the incomplete doc
+        return record.to_dict()
+
+
+_INGESTIONS: Dict[tuple, Ingestion] = {}
+_INGESTIONS_LOCK = threading.Lock()
+
+
+def _get_ingestion_key(doc_parser: DocParser, url: str, kwargs: dict) -> tuple:
+    return (doc_parser.data_root, url, kwargs.get('max_ref_token', doc_parser.max_ref_token),
+            kwargs.get('parser_page_size', doc_parser.parser_page_size))
+
+
+def get_ingestion(doc_parser: DocParser, url: str, kwargs: dict) -> Ingestion:
+    """Start parsing a file in the background, or join the parsing of it already in progress."""
+    key = _get_ingestion_key(doc_parser, url, kwargs)
+    with _INGESTIONS_LOCK:
+        if key not in _INGESTIONS:
+            _INGESTIONS[key] = Ingestion(doc_parser, url, kwargs)
+        return _INGESTIONS[key]
+
+
 @register_tool('retrieval')
 class Retrieval(BaseTool):
     description = f'从给定文件列表中检索出和问题相关的内容，支持文件类型包括：{"/".join(PARSER_SUPPORTED_FILE_TYPES)}'
@@ -61,6 +213,9 @@ class Retrieval(BaseTool):
         self.max_ref_token: int = self.cfg.get('max_ref_token', DEFAULT_MAX_REF_TOKEN)
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
         self.doc_parse = DocParser({'max_ref_token': self.max_ref_token, 'parser_page_size': self.parser_page_size})
+        self.parser_workers: int = self.cfg.get('parser_workers', min(DEFAULT_PARSER_WORKERS, os.cpu_count() or 1))
+        self.parser_timeout: float = self.cfg.get('parser_timeout', DEFAULT_PARSER_TIMEOUT)
+        self.ingestion_deadline: float = self.cfg.get('ingestion_deadline', DEFAULT_INGESTION_DEADLINE)
 
         self.rag_searchers = self.cfg.get('rag_searchers', DEFAULT_RAG_SEARCHERS)
         if len(self.rag_searchers) == 1:
@@ -88,13 +243,124 @@ class Retrieval(BaseTool):
         files = params.get('files', [])
         if isinstance(files, str):
             files = json5.loads(files)
-        records = []
-        for file in files:
-            _record = self.doc_parse.call(params={'url': file}, **kwargs)
-            records.append(_record)
+        records = self._parse_files(files, **kwargs)
 
         query = params.get('query', '')
         if records:
             return self.search.call(params={'query': query}, docs=[Record(**rec) for rec in records], **kwargs)
         else:
             return []
+
+    def _parse_files(self, files: List[str], **kwargs) -> List[dict]:
+        """Parse the files, in parallel processes if there are several of them.
+
+        A file that fails to parse is skipped, unless all the files fail. The records are in the order of the files.
+        """
+        if self.ingestion_deadline > 0:
+            parser_kwargs = {k: kwargs[k] for k in ['max_ref_token', 'parser_page_size'] if k in kwargs}
+            results = self._parse_files_progressively(files, parser_kwargs)
+        elif (len(files) > 1) and (self.parser_workers > 1):
+            # Only the kwargs used by DocParser are passed to the worker processes, since others may not be picklable
+            parser_kwargs = {k: kwargs[k] for k in ['max_ref_token', 'parser_page_size'] if k in kwargs}
+            results = self._parse_files_in_parallel(files, parser_kwargs)
+        else:
+            results = []
+            for file in files:
+                try:
+                    results.append(self.doc_parse.call(params={'url': file}, **kwargs))
+                except Exception as ex:
+                    results.append(ex)
+
+        records = []
+        for file, result in zip(files, results):
+            if result is None:
+                continue  # Nothing parsed yet
+            if isinstance(result, Exception):
+                logger.error(f'Failed to parse {file}: {type(result).__name__}: {result}')
+            else:
+                records.append(result)
+        if files and all(isinstance(result, Exception) for result in results):
+            raise results[0]
+        return records
+
+    def _parse_files_progressively(self, files: List[str], kwargs: dict) -> List[Union[dict, Exception, None]]:
+        """Parse the files in background threads, and return what has been parsed by the deadline.
+
+        The unfinished files are represented by the chunks of their parsed pages, or None if no page is parsed yet.
+        Their parsing continues in the background, and the complete records are cached for the later calls.
+        """
+        deadline = time.time() + self.ingestion_deadline
+        ingestions = [get_ingestion(self.doc_parse, file, kwargs) for file in files]
+        results = []
+        for ingestion in ingestions:
+            if ingestion.done.wait(timeout=max(deadline - time.time(), 0)):
+                results.append(ingestion.error or ingestion.record)
+            else:
+                record = ingestion.get_partial_record()
+                if record:
+                    logger.info(f'Searching the first {len(record["raw"])} chunks of {ingestion.url}, '
+                                'while the rest of it is being parsed.')
+                results.append(record)
+        return results
+
+    def _parse_files_in_parallel(self, files: List[str], kwargs: dict) -> List[Union[dict, Exception]]:
+        results: List[Union[dict, Exception, None]] = [None] * len(files)
+        num_attempts = [0] * len(files)
+        pending = list(range(len(files)))
+        crashed = False
+        while pending:
+            if crashed:
+                # Retry the files one by one after a crash, so that the crashing file does not fail the others again
+                batch, pending = pending[:1], pending[1:]
+            else:
+                batch, pending = pending, []
+            pool, start_queue = _get_parser_pool(self.parser_workers)
+            running = {}  # future -> (index, task id)
+            for i in batch:
+                num_attempts[i] += 1
+                task_id = next(_PARSER_TASK_IDS)
+                future = pool.submit(_parse_file_in_worker, self.doc_parse.cfg, {'url': files[i]}, kwargs, task_id)
+                running[future] = (i, task_id)
+            while running:
+                done, _ = wait(running, timeout=min(1.0, self.parser_timeout), return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, task_id = running.pop(future)
+                    _PARSER_TASK_START_TIMES.pop(task_id, None)
+                    try:
+                        results[i] = future.result()
+                    except (CancelledError, BrokenProcessPool) as ex:
+                        if isinstance(ex, CancelledError) or (pool in _KILLED_PARSER_POOLS):
+                            # Another call killed the shared pool to stop its own stuck file. Resubmit this file.
+                            pending.append(i)
+                            num_attempts[i] -= 1
+                            continue
+                        # A worker crashed, failing all the files in the pool. Retry them once in a new pool.
+                        crashed = True
+                        if num_attempts[i] < 2:
+                            pending.append(i)
+                        else:
+                            results[i] = ex
+                    except Exception as ex:
+                        results[i] = ex
+
+                # The timeout counts from when a worker starts parsing the file, not from the submission
+                _poll_parser_start_times(start_queue)
+                now = time.time()
+                timed_out = []
+                for future, (_, task_id) in running.items():
+                    if now - _PARSER_TASK_START_TIMES.get(task_id, now) > self.parser_timeout:
+                        timed_out.append(future)
+                if timed_out:
+                    for future in timed_out:
+                        i, _ = running.pop(future)
+                        results[i] = TimeoutError(f'Parsing timed out after {self.parser_timeout} seconds.')
+                    # Kill the stuck workers, and resubmit the unfinished files to a new pool
+                    for i, _ in running.values():
+                        pending.append(i)
+                        num_attempts[i] -= 1  # Not their fault
+                    for _, task_id in running.values():
+                        _PARSER_TASK_START_TIMES.pop(task_id, None)
+                    running = {}
+                    _kill_parser_pool(pool)
+            pending.sort()
+        return results
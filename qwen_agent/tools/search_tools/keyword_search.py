@@ -12,25 +12,68 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import heapq
+import json
+import math
+import os
 import re
 import string
-from typing import List, Tuple
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 import json5
 
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN
+from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import register_tool
 from qwen_agent.tools.doc_parser import Record
 from qwen_agent.tools.search_tools.base_search import BaseSearch
-from qwen_agent.utils.utils import has_chinese_chars
+from qwen_agent.tools.storage import KeyNotExistsError, Storage
+from qwen_agent.utils.utils import has_chinese_chars, hash_sha256
 
 
 @register_tool('keyword_search')
 class KeywordSearch(BaseSearch):
 
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        # The keyword indexes are stored alongside the chunk cache of DocParser by default, where they are built.
+        self.index_path = self.cfg.get('index_path', os.path.join(DEFAULT_WORKSPACE, 'tools', 'doc_parser'))
+        self._corpus_cache: 'OrderedDict[tuple, BM25Corpus]' = OrderedDict()
+
     def search(self, query: str, docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
-        chunk_and_score = self.sort_by_scores(query=query, docs=docs)
+        wordlist = parse_keyword(query)
+        logger.debug('wordlist: ' + ','.join(wordlist))
+        if not wordlist:
+            # This represents the queries that do not use retrieval: summarize, etc.
+            return self._get_the_front_part(docs, max_ref_token)
+
+        # Only the top chunks that fill up the window are needed. Increase k until enough chunks are retrieved.
+        corpus = self._get_corpus(docs)
+        chunks = [chk for doc in docs for chk in doc.raw]
+        k = 16
+        while True:
+            top = corpus.top_k(wordlist, k)
+            if top is None:
+                # The dynamic pruning is not applicable, so rank all the chunks.
+                chunk_and_score = self._rank(corpus, chunks, wordlist)
+                break
+            if (len(top) < k) or (sum(chunks[i].token for i, _ in top) >= max_ref_token):
+                # Either the window is filled by the top k chunks, or all the chunks with positive scores are found.
+                # Chunks with zero scores follow in the original order, as sorted by a stable sort.
+                top_ids = set(i for i, _ in top)
+                chunk_and_score = [
+                    (chunks[i].metadata['source'], chunks[i].metadata['chunk_id'], score) for i, score in top
+                ]
+                if len(top) < k:
+                    chunk_and_score.extend((chk.metadata['source'], chk.metadata['chunk_id'], 0.0)
+                                           for i, chk in enumerate(chunks)
+                                           if i not in top_ids)
+                break
+            k *= 4
+
         if not chunk_and_score:
             return self._get_the_front_part(docs, max_ref_token)
 
@@ -54,17 +97,260 @@ class KeywordSearch(BaseSearch):
             all_chunks.extend(doc.raw)
 
         # Using bm25 retrieval
-        from rank_bm25 import BM25Okapi
-        bm25 = BM25Okapi([split_text_into_keywords(x.content) for x in all_chunks])
-        doc_scores = bm25.get_scores(wordlist)
+        chunk_and_score = self._rank(self._get_corpus(docs), all_chunks, wordlist)
+        assert len(chunk_and_score) > 0
+
+        return chunk_and_score
+
+    @staticmethod
+    def _rank(corpus: 'BM25Corpus', chunks: list, wordlist: List[str]) -> List[Tuple[str, int, float]]:
+        doc_scores = corpus.get_scores(wordlist)
         chunk_and_score = [
-            (chk.metadata['source'], chk.metadata['chunk_id'], score) for chk, score in zip(all_chunks, doc_scores)
+            (chk.metadata['source'], chk.metadata['chunk_id'], score) for chk, score in zip(chunks, doc_scores)
         ]
         chunk_and_score.sort(key=lambda item: item[2], reverse=True)
-        assert len(chunk_and_score) > 0
-
         return chunk_and_score
 
+    def _get_corpus(self, docs: List[Record]) -> 'BM25Corpus':
+        keys = tuple(get_keyword_index_key(doc) for doc in docs)
+        corpus = self._corpus_cache.get(keys)
+        if corpus is None:
+            db = Storage({'storage_root_path': self.index_path})
+            corpus = BM25Corpus([get_keyword_index(doc, db=db, key=key) for doc, key in zip(docs, keys)])
+            self._corpus_cache[keys] = corpus
+            while len(self._corpus_cache) > 8:
+                self._corpus_cache.popitem(last=False)
+        self._corpus_cache.move_to_end(keys)
+        return corpus
+
+
+class KeywordIndex:
+    """An inverted index of the chunks of one document, i.e., the statistics needed for BM25 retrieval.
+
+    The index of a document is built once, e.g., when it is parsed by DocParser, and persisted. The statistics that
+    depend on the whole corpus, e.g., the IDF, are derived from the indexes of the documents at query time, so that
+    adding a document to the corpus only requires indexing the new document.
+
+    Attributes:
+        doc_len: The number of keywords in each chunk.
+        postings: Each keyword maps to the ids of the chunks containing it and its frequencies in these chunks.
+    """
+    version = 1
+
+    def __init__(self, doc_len: List[int], postings: Dict[str, Tuple[List[int], List[int]]]):
+        self.doc_len = doc_len
+        self.postings = postings
+
+    @classmethod
+    def build(cls, texts: List[str]) -> 'KeywordIndex':
+        doc_len, postings = [], {}
+        for chunk_id, text in enumerate(texts):
+            keywords = split_text_into_keywords(text)
+            doc_len.append(len(keywords))
+            for word, freq in Counter(keywords).items():
+                chunk_ids, freqs = postings.setdefault(word, ([], []))
+                chunk_ids.append(chunk_id)
+                freqs.append(freq)
+        return cls(doc_len=doc_len, postings=postings)
+
+    def to_dict(self) -> dict:
+        return {'version': self.version, 'doc_len': self.doc_len, 'postings': self.postings}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'KeywordIndex':
+        if data.get('version') != cls.version:
+            raise ValueError(f'Unsupported keyword index version: {data.get("version")}')
+        return cls(doc_len=data['doc_len'], postings={k: tuple(v) for k, v in data['postings'].items()})
+
+
+_KEYWORD_INDEX_CACHE: 'OrderedDict[str, KeywordIndex]' = OrderedDict()
+_KEYWORD_INDEX_CACHE_LOCK = threading.Lock()
+_KEYWORD_INDEX_CACHE_SIZE = 64
+
+
+def get_keyword_index_key(doc: Record) -> str:
+    """The storage key of the keyword index of a document, which is derived from the contents of its chunks."""
+    contents = json.dumps([chk.content for chk in doc.raw], ensure_ascii=False)
+    return f'keyword_index_v{KeywordIndex.version}_{hash_sha256(contents)}'
+
+
+def get_keyword_index(doc: Record, db: Optional[Storage] = None, key: Optional[str] = None) -> KeywordIndex:
+    """Get the keyword index of a document from the memory or the storage, or build and save it if not found.
+
+    The index of a partial record, which is being parsed, is kept in memory only.
+    """
+    key = key or get_keyword_index_key(doc)
+    with _KEYWORD_INDEX_CACHE_LOCK:
+        index = _KEYWORD_INDEX_CACHE.get(key)
+        if index is not None:
+            _KEYWORD_INDEX_CACHE.move_to_end(key)
+            return index
+
+    index = None
+    if db is not None:
+        try:
+            index = KeywordIndex.from_dict(json.loads(db.get(key)))
+        except KeyNotExistsError:
+            pass
+        except Exception:
+            logger.warning(f'Failed to load the keyword index of {doc.url}, rebuilding it.')
+    if index is None:
+        index = KeywordIndex.build([chk.content for chk in doc.raw])
+        if (db is not None) and (not doc.is_partial):
+            db.put(key, json.dumps(index.to_dict(), ensure_ascii=False))
+
+    with _KEYWORD_INDEX_CACHE_LOCK:
+        _KEYWORD_INDEX_CACHE[key] = index
+        while len(_KEYWORD_INDEX_CACHE) > _KEYWORD_INDEX_CACHE_SIZE:
+            _KEYWORD_INDEX_CACHE.popitem(last=False)
+    return index
+
+
+class BM25Corpus:
+    """BM25 (Okapi) retrieval over the chunks of several documents, given their keyword indexes.
+
+    The scores are identical to those of `rank_bm25.BM25Okapi` built from all the chunks.
+    """
+
+    def __init__(self, indexes: List[KeywordIndex], k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.indexes = indexes
+        self.offsets = []
+        self.doc_len = []
+        for index in indexes:
+            self.offsets.append(len(self.doc_len))
+            self.doc_len.extend(index.doc_len)
+        self.corpus_size = len(self.doc_len)
+        self.avgdl = (sum(self.doc_len) / self.corpus_size) if self.corpus_size else 0.0
+
+        # The words are iterated in the order of their first appearances in the corpus, same as BM25Okapi.
+        nd = {}
+        for index in indexes:
+            for word, (chunk_ids, _) in index.postings.items():
+                nd[word] = nd.get(word, 0) + len(chunk_ids)
+        self.idf = {}
+        idf_sum = 0
+        negative_idfs = []
+        for word, freq in nd.items():
+            idf = math.log(self.corpus_size - freq + 0.5) - math.log(freq + 0.5)
+            self.idf[word] = idf
+            idf_sum += float(idf)
+            if idf < 0:
+                negative_idfs.append(word)
+        self.average_idf = (idf_sum / len(self.idf)) if self.idf else 0.0
+        eps = epsilon * self.average_idf
+        for word in negative_idfs:
+            self.idf[word] = eps
+
+    def get_scores(self, query: List[str]) -> List[float]:
+        """The BM25 scores of all the chunks."""
+        scores = [0.0] * self.corpus_size
+        term_freqs = self._get_term_freqs(query)
+        for i in sorted(set(i for freqs in term_freqs.values() for i in freqs)):
+            scores[i] = self._score(i, query, term_freqs)
+        return scores
+
+    def top_k(self, query: List[str], k: int) -> Optional[List[Tuple[int, float]]]:
+        """The top k chunks with positive scores, as (chunk index in the corpus, score) tuples sorted by score.
+
+        The candidates are traversed document-at-a-time with MaxScore pruning, i.e., the chunks that only contain
+        the keywords with low upper bounds are skipped once they can no longer enter the top k.
+        Returns None if a keyword has a non-positive weight, in which case the pruning does not hold.
+        """
+        weights = {}
+        for word in query:
+            if word in self.idf:
+                weights[word] = weights.get(word, 0) + self.idf[word]
+        if any(w <= 0 for w in weights.values()):
+            return None
+
+        # The posting list and the upper bound of the score contribution of each keyword
+        terms = []
+        for word, weight in weights.items():
+            ids, freqs, max_freq, min_len = [], [], 0, None
+            for offset, index in zip(self.offsets, self.indexes):
+                if word in index.postings:
+                    chunk_ids, chunk_freqs = index.postings[word]
+                    ids.extend(offset + i for i in chunk_ids)
+                    freqs.extend(chunk_freqs)
+                    max_freq = max(max_freq, max(chunk_freqs))
+                    min_len = min(min_len or math.inf, min(index.doc_len[i] for i in chunk_ids))
+            # Add some slack to the bound to tolerate rounding errors.
+            upper_bound = weight * self._tf_norm(max_freq, min_len) * (1 + 1e-9)
+            terms.append((upper_bound, ids, freqs))
+        terms.sort(key=lambda x: x[0])
+        cum_bounds = []
+        for upper_bound, _, _ in terms:
+            cum_bounds.append(upper_bound + (cum_bounds[-1] if cum_bounds else 0.0))
+
+        term_freqs = self._get_term_freqs(query)
+        pointers = [0] * len(terms)
+        heap: List[Tuple[float, int]] = []  # (score, -chunk index)
+        threshold = 0.0
+        first_essential = 0  # A chunk must contain one of terms[first_essential:] to enter the top k
+        while True:
+            candidates = [
+                terms[j][1][pointers[j]] for j in range(first_essential, len(terms)) if pointers[j] < len(terms[j][1])
+            ]
+            if not candidates:
+                break
+            i = min(candidates)
+
+            bound = 0.0
+            for j in range(first_essential, len(terms)):
+                upper_bound, ids, freqs = terms[j]
+                if pointers[j] < len(ids) and ids[pointers[j]] == i:
+                    bound += upper_bound
+                    pointers[j] += 1
+            pruned = False
+            for j in range(first_essential - 1, -1, -1):
+                if bound + cum_bounds[j] < threshold:
+                    pruned = True
+                    break
+                _, ids, _ = terms[j]
+                pointers[j] = bisect.bisect_left(ids, i, pointers[j])
+                if pointers[j] < len(ids) and ids[pointers[j]] == i:
+                    bound += terms[j][0]
+            if pruned or (bound < threshold):
+                continue
+
+            score = self._score(i, query, term_freqs)
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -i))
+            else:
+                heapq.heappushpop(heap, (score, -i))
+            if len(heap) == k:
+                threshold = heap[0][0]
+                while (first_essential < len(terms)) and (cum_bounds[first_essential] < threshold):
+                    first_essential += 1
+
+        return [(-neg_i, score) for score, neg_i in sorted(heap, reverse=True)]
+
+    def _get_term_freqs(self, query: List[str]) -> Dict[str, Dict[int, int]]:
+        term_freqs = {}
+        for word in set(query):
+            freqs = {}
+            for offset, index in zip(self.offsets, self.indexes):
+                if word in index.postings:
+                    chunk_ids, chunk_freqs = index.postings[word]
+                    freqs.update(zip((offset + i for i in chunk_ids), chunk_freqs))
+            if freqs:
+                term_freqs[word] = freqs
+        return term_freqs
+
+    def _tf_norm(self, freq: int, doc_len: int) -> float:
+        return freq * (self.k1 + 1) / (freq + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl))
+
+    def _score(self, i: int, query: List[str], term_freqs: Dict[str, Dict[int, int]]) -> float:
+        # Summed up in the order of the query words to get exactly the same results as BM25Okapi.
+        score = 0.0
+        for word in query:
+            freq = term_freqs.get(word, {}).get(i, 0)
+            if freq:
+                score += (self.idf.get(word) or 0) * self._tf_norm(freq, self.doc_len[i])
+        return score
+
 
 WORDS_TO_IGNORE = [
     'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your',
@@ -12,50 +12,284 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import hashlib
 import json
 import os
-from typing import List, Tuple
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
+from qwen_agent.log import logger
+from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import register_tool
 from qwen_agent.tools.doc_parser import Record
 from qwen_agent.tools.search_tools.base_search import BaseSearch
+from qwen_agent.tools.storage import KeyNotExistsError, Storage
+from qwen_agent.utils.utils import hash_sha256, print_traceback
+
+MAX_CHUNK_CHARS = 2000  # Chunks are truncated to this length before embedding
 
 
 @register_tool('vector_search')
 class VectorSearch(BaseSearch):
     # TODO: Optimize the accuracy of the embedding retriever.
 
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        # The embeddings are stored alongside the chunk cache of DocParser by default
+        self.index_path = self.cfg.get('index_path', os.path.join(DEFAULT_WORKSPACE, 'tools', 'doc_parser'))
+        # Use an approximate index (HNSW) instead of the exact one when there are this many chunks and faiss is installed
+        self.ann_threshold: int = self.cfg.get('ann_threshold', 50000)
+        self._embedder = None
+        self._corpus_cache: 'OrderedDict[tuple, VectorIndex]' = OrderedDict()
+
+    def search(self, query: str, docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
+        query = _extract_raw_query(query)
+        index = self._get_index(docs)
+        chunks = [chk for doc in docs for chk in doc.raw]
+        query_embedding = self.embedder.embed_query(query)
+
+        # Only the nearest chunks that fill up the window are needed. Increase k until enough chunks are retrieved.
+        k = 16
+        while True:
+            ids, distances = index.search(query_embedding, k)
+            if (len(ids) == len(chunks)) or (sum(chunks[i].token for i in ids) >= max_ref_token):
+                break
+            k *= 4
+        chunk_and_score = [
+            (chunks[i].metadata['source'], chunks[i].metadata['chunk_id'], dist) for i, dist in zip(ids, distances)
+        ]
+        return self.get_topk(chunk_and_score=chunk_and_score, docs=docs, max_ref_token=max_ref_token)
+
     def sort_by_scores(self, query: str, docs: List[Record], **kwargs) -> List[Tuple[str, int, float]]:
+        query = _extract_raw_query(query)
+        index = self._get_index(docs)
+        chunks = [chk for doc in docs for chk in doc.raw]
+        ids, distances = index.search(self.embedder.embed_query(query), len(chunks))
+        return [(chunks[i].metadata['source'], chunks[i].metadata['chunk_id'], dist) for i, dist in zip(ids, distances)]
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            self._embedder = get_embedder(self.cfg.get('embedding', 'dashscope'), self.cfg.get('embedding_model'))
+        return self._embedder
+
+    def _get_index(self, docs: List[Record]) -> 'VectorIndex':
+        keys = tuple(get_embeddings_key(doc, self.embedder.model_id) for doc in docs)
+        index = self._corpus_cache.pop(keys, None)
+        if index is None:
+            db = Storage({'storage_root_path': self.index_path})
+            # When documents are added to a corpus searched before, only the new ones are added to its index
+            prefix = max((k for k in self._corpus_cache if keys[:len(k)] == k), key=len, default=())
+            index = self._corpus_cache.pop(prefix) if prefix else VectorIndex(ann_threshold=self.ann_threshold)
+            for doc, key in zip(docs[len(prefix):], keys[len(prefix):]):
+                index.add(get_embeddings(doc, self.embedder, db=db, key=key))
+            # The ANN index of the corpus, if built, is persisted alongside the embeddings, unless a doc is partial
+            index.db = None if any(doc.is_partial for doc in docs) else db
+            index.key = get_vector_index_key(keys)
+        self._corpus_cache[keys] = index
+        while len(self._corpus_cache) > 8:
+            self._corpus_cache.popitem(last=False)
+        return index
+
+
+class HashEmbedding:
+    """A deterministic local embedder, which hashes the keywords of a text into a fixed-size vector.
+
+    It needs no model or network access, and is mainly meant for offline tests.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.model_id = f'hash-{dim}'
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        from qwen_agent.tools.search_tools.keyword_search import split_text_into_keywords
+
+        vec = [0.0] * self.dim
+        for word in split_text_into_keywords(text):
+            h = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:8], 'little')
+            vec[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = sum(x * x for x in vec)**0.5
+        return [x / norm for x in vec] if norm else vec
+
+
+def get_embedder(embedding: str = 'dashscope', model: Optional[str] = None):
+    """Get an embedder with the `embed_documents` and `embed_query` methods, and a `model_id` naming the model."""
+    if embedding == 'hash':
+        return HashEmbedding(dim=int(model or 256))
+    if embedding == 'dashscope':
         # TODO: More types of embedding can be configured
-        try:
-            from langchain.schema import Document
-        except ModuleNotFoundError:
-            raise ModuleNotFoundError('Please install langchain by: `pip install langchain`')
         try:
             from langchain_community.embeddings import DashScopeEmbeddings
-            from langchain_community.vectorstores import FAISS
         except ModuleNotFoundError:
-            raise ModuleNotFoundError(
-                'Please install langchain_community by: `pip install langchain_community`, '
-                'and install faiss by: `pip install faiss-cpu` or `pip install faiss-gpu` (for CUDA supported GPU)')
-        # Extract raw query
+            raise ModuleNotFoundError('Please install langchain_community by: `pip install langchain_community`')
+        model = model or 'text-embedding-v1'
+        embedder = DashScopeEmbeddings(model=model, dashscope_api_key=os.getenv('DASHSCOPE_API_KEY', ''))
+        embedder.model_id = f'dashscope-{model}'
+        return embedder
+    raise ValueError(f'Unsupported embedding: {embedding}')
+
+
+class VectorIndex:
+    """The vectors of the chunks in a corpus, searched by the squared L2 distance.
+
+    The search is exact, unless the corpus is large and faiss is installed, in which case an HNSW index is built.
+    The HNSW index is saved to `db` under `key` if provided, so that it is loaded rather than rebuilt next time.
+    """
+
+    def __init__(self, ann_threshold: int = 50000, db: Optional[Storage] = None, key: Optional[str] = None):
+        self.ann_threshold = ann_threshold
+        self.db = db
+        self.key = key
+        self._parts = []
+        self._vectors = None
+        self._ann_index = None
+        self._ann_index_key = None  # The key that the HNSW index is loaded from or saved to
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self._parts)
+
+    def add(self, vectors):
+        if len(vectors):
+            self._parts.append(vectors)
+            self._vectors = None
+            if self._ann_index is not None:
+                self._ann_index.add(vectors)
+
+    def search(self, query: List[float], k: int) -> Tuple[List[int], List[float]]:
+        """The ids of the k nearest vectors and their distances, sorted by the distances."""
+        import numpy as np
+
+        num_vectors = len(self)
+        k = min(k, num_vectors)
+        if k <= 0:
+            return [], []
+        query = np.asarray(query, dtype=np.float32)
+
+        if (k < num_vectors) and (num_vectors >= self.ann_threshold):
+            ann_index = self._get_ann_index()
+            if ann_index is not None:
+                ann_index.hnsw.efSearch = max(64, k)
+                distances, ids = ann_index.search(query[None, :], k)
+                found = ids[0] >= 0
+                return ids[0][found].tolist(), distances[0][found].tolist()
+
+        if self._vectors is None:
+            self._vectors = np.concatenate(self._parts) if len(self._parts) > 1 else self._parts[0]
+        distances = ((self._vectors - query)**2).sum(axis=1)
+        if k < num_vectors:
+            ids = np.argpartition(distances, k - 1)[:k]
+            ids = ids[np.argsort(distances[ids], kind='stable')]
+        else:
+            ids = np.argsort(distances, kind='stable')
+        return ids.tolist(), distances[ids].tolist()
+
+    def _get_ann_index(self):
+        try:
+            import faiss
+        except ImportError:
+            return None
+        if self._ann_index is None:
+            self._ann_index = self._load_ann_index()
+        if self._ann_index is None:
+            self._ann_index = faiss.IndexHNSWFlat(self._parts[0].shape[1], 32)
+            for vectors in self._parts:
+                self._ann_index.add(vectors)
+        if (self.db is not None) and self.key and (self._ann_index_key != self.key):
+            data = base64.b64encode(faiss.serialize_index(self._ann_index).tobytes()).decode('ascii')
+            self.db.put(self.key, data)
+            self._ann_index_key = self.key
+        return self._ann_index
+
+    def _load_ann_index(self):
+        import faiss
+        import numpy as np
+
+        if (self.db is None) or (not self.key):
+            return None
+        try:
+            data = np.frombuffer(base64.b64decode(self.db.get(self.key)), dtype=np.uint8)
+            ann_index = faiss.deserialize_index(data)
+        except KeyNotExistsError:
+            return None
+        except Exception:
+            print_traceback(is_error=False)
+            logger.warning('Failed to load the vector index, rebuilding it.')
+            return None
+        if ann_index.ntotal != len(self):
+            return None
+        self._ann_index_key = self.key
+        return ann_index
+
+
+_EMBEDDINGS_CACHE: 'OrderedDict[str, object]' = OrderedDict()
+_EMBEDDINGS_CACHE_LOCK = threading.Lock()
+_EMBEDDINGS_CACHE_SIZE = 64
+
+
+def get_embeddings_key(doc: Record, model_id: str) -> str:
+    """The storage key of the chunk embeddings of a document, derived from the embedding model and the contents."""
+    contents = json.dumps([chk.content[:MAX_CHUNK_CHARS] for chk in doc.raw], ensure_ascii=False)
+    return f'embeddings_{hash_sha256(model_id)[:16]}_{hash_sha256(contents)}'
+
+
+def get_vector_index_key(embeddings_keys: Tuple[str, ...]) -> str:
+    """The storage key of the HNSW index of a corpus, derived from the embeddings keys of its documents."""
+    return f'vector_index_hnsw_{hash_sha256(json.dumps(embeddings_keys))}'
+
+
+def get_embeddings(doc: Record, embedder, db: Optional[Storage] = None, key: Optional[str] = None):
+    """Get the chunk embeddings of a document from the memory or the storage, or embed and save them if not found.
+
+    The embeddings of a partial record, which is being parsed, are kept in memory only.
+
+    Returns:
+        A float32 numpy array of shape (number of chunks, embedding dim).
+    """
+    import numpy as np
+
+    key = key or get_embeddings_key(doc, embedder.model_id)
+    with _EMBEDDINGS_CACHE_LOCK:
+        vectors = _EMBEDDINGS_CACHE.get(key)
+        if vectors is not None:
+            _EMBEDDINGS_CACHE.move_to_end(key)
+            return vectors
+
+    vectors = None
+    if db is not None:
         try:
-            query_json = json.loads(query)
-            # This assumes that the user's input will not contain json str with the 'text' attribute
-            if 'text' in query_json:
-                query = query_json['text']
-        except json.decoder.JSONDecodeError:
+            data = json.loads(db.get(key))
+            vectors = np.frombuffer(base64.b64decode(data['vectors']), dtype=np.float32).reshape(data['shape'])
+        except KeyNotExistsError:
             pass
+        except Exception:
+            print_traceback(is_error=False)
+            logger.warning(f'Failed to load the embeddings of {doc.url}, re-embedding it.')
+    if vectors is None:
+        texts = [chk.content[:MAX_CHUNK_CHARS] for chk in doc.raw]
+        vectors = np.asarray(embedder.embed_documents(texts) if texts else [], dtype=np.float32)
+        if (db is not None) and (not doc.is_partial):
+            data = {'shape': list(vectors.shape), 'vectors': base64.b64encode(vectors.tobytes()).decode('ascii')}
+            db.put(key, json.dumps(data))
 
-        # Plain all chunks from all docs
-        all_chunks = []
-        for doc in docs:
-            for chk in doc.raw:
-                all_chunks.append(Document(page_content=chk.content[:2000], metadata=chk.metadata))
+    with _EMBEDDINGS_CACHE_LOCK:
+        _EMBEDDINGS_CACHE[key] = vectors
+        while len(_EMBEDDINGS_CACHE) > _EMBEDDINGS_CACHE_SIZE:
+            _EMBEDDINGS_CACHE.popitem(last=False)
+    return vectors
 
-        embeddings = DashScopeEmbeddings(model='text-embedding-v1',
-                                         dashscope_api_key=os.getenv('DASHSCOPE_API_KEY', ''))
-        db = FAISS.from_documents(all_chunks, embeddings)
-        chunk_and_score = db.similarity_search_with_score(query, k=len(all_chunks))
 
-        return [(chk.metadata['source'], chk.metadata['chunk_id'], score) for chk, score in chunk_and_score]
+def _extract_raw_query(query: str) -> str:
+    try:
+        query_json = json.loads(query)
+        # This assumes that the user's input will not contain json str with the 'text' attribute
+        if 'text' in query_json:
+            query = query_json['text']
+    except json.decoder.JSONDecodeError:
+        pass
+    return query
@@ -13,20 +13,26 @@
 # limitations under the License.
 
 import json
+import math
+import multiprocessing
 import os
 import re
 import time
 from collections import Counter
-from typing import Dict, List, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Union
+
+import requests
 
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.settings import DEFAULT_PDF_PARSER_WORKERS, DEFAULT_URL_CHECK_INTERVAL, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import BaseTool, register_tool
 from qwen_agent.tools.storage import KeyNotExistsError, Storage
 from qwen_agent.utils.str_processing import rm_cid, rm_continuous_placeholders, rm_hexadecimal
-from qwen_agent.utils.tokenization_qwen import count_tokens
-from qwen_agent.utils.utils import (get_file_type, hash_sha256, is_http_url, read_text_from_file,
-                                    sanitize_chrome_file_path, save_url_to_local_work_dir)
+from qwen_agent.utils.tokenization_qwen import count_tokens_batch
+from qwen_agent.utils.utils import (get_basename_from_url, get_file_type, hash_file_sha256, hash_sha256, is_http_url,
+                                    print_traceback, read_text_from_file, sanitize_chrome_file_path,
+                                    save_url_to_local_work_dir)
 
 
 def clean_paragraph(text):
@@ -237,7 +243,47 @@ def parse_html_bs(path: str, extract_image: bool = False):
     return [{'page_num': 1, 'content': content, 'title': title}]
 
 
-def parse_pdf(pdf_path: str, extract_image: bool = False) -> List[dict]:
+# A pdf is parsed in parallel only if each worker process gets at least this many pages
+PDF_MIN_PAGES_PER_WORKER = 16
+
+
+def parse_pdf(pdf_path: str,
+              extract_image: bool = False,
+              max_workers: int = 1,
+              on_pages: Optional[Callable[[List[dict]], None]] = None) -> List[dict]:
+    """Parse a pdf page by page. Large pdfs are split into page ranges, which are parsed in parallel processes.
+
+    If `on_pages` is provided, it is called with the newly parsed pages in order, before the whole pdf is parsed.
+    """
+    import pdfplumber
+    with pdfplumber.open(pdf_path) as pdf:
+        num_pages = len(pdf.pages)
+
+    # Already in a worker process (e.g., of the Retrieval tool), where more processes would only oversubscribe the CPUs
+    if multiprocessing.parent_process() is not None:
+        max_workers = 1
+    num_workers = max(1, min(max_workers, num_pages // PDF_MIN_PAGES_PER_WORKER))
+    if num_workers == 1:
+        return parse_pdf_pages(pdf_path, extract_image, on_pages=on_pages)
+
+    range_size = math.ceil(num_pages / num_workers)
+    page_ranges = [list(range(start, min(start + range_size, num_pages))) for start in range(0, num_pages, range_size)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(parse_pdf_pages, [pdf_path] * len(page_ranges), [extract_image] * len(page_ranges),
+                               page_ranges)
+        doc = []
+        for pages in results:
+            if on_pages:
+                on_pages(pages)
+            doc.extend(pages)
+        return doc
+
+
+def parse_pdf_pages(pdf_path: str,
+                    extract_image: bool = False,
+                    page_numbers: Optional[List[int]] = None,
+                    on_pages: Optional[Callable[[List[dict]], None]] = None) -> List[dict]:
+    """Parse the pages of a pdf, or all the pages if `page_numbers` (zero-based) is not specified."""
     # Todo: header and footer
     from pdfminer.high_level import extract_pages
     from pdfminer.layout import LTImage, LTRect, LTTextContainer
@@ -245,8 +291,10 @@ def parse_pdf(pdf_path: str, extract_image: bool = False) -> List[dict]:
     doc = []
     import pdfplumber
     pdf = pdfplumber.open(pdf_path)
-    for i, page_layout in enumerate(extract_pages(pdf_path)):
-        page = {'page_num': page_layout.pageid, 'content': []}
+    page_layouts = extract_pages(pdf_path, page_numbers=page_numbers)
+    for i, page_layout in zip(page_numbers or range(len(pdf.pages)), page_layouts):
+        # The pageid of pdfminer counts from the first page extracted, rather than the first page of the pdf
+        page = {'page_num': i + 1, 'content': []}
 
         elements = []
         for element in page_layout:
@@ -285,6 +333,9 @@ def parse_pdf(pdf_path: str, extract_image: bool = False) -> List[dict]:
         # merge elements
         page['content'] = postprocess_page_content(page['content'])
         doc.append(page)
+        if on_pages:
+            on_pages([page])
+    pdf.close()
 
     return doc
 
@@ -377,6 +428,28 @@ def get_plain_doc(doc: list):
     return PARAGRAPH_SPLIT_SYMBOL.join(paras)
 
 
+# The version of the parsing results. Bump it when the parsers change, to invalidate the parsed docs in the cache.
+PARSER_VERSION = 1
+
+
+def get_parsed_doc_key(path: str, content_hash: str) -> str:
+    """The cache key of a parsed doc, which depends on the content rather than the path of the file."""
+    # For the file types not specified by the extension, the type is detected from the content
+    f_type = get_basename_from_url(path).split('.')[-1].lower()
+    if f_type not in ['pdf', 'docx', 'pptx', 'csv', 'tsv', 'xlsx', 'xls']:
+        f_type = 'auto'
+    return f'{content_hash}_{f_type}_v{PARSER_VERSION}'
+
+
+def _count_page_tokens(pages: List[dict]) -> List[dict]:
+    paras = [para for page in pages for para in page['content'] if 'token' not in para]
+    # Todo: More attribute types
+    counts = count_tokens_batch([para.get('text', para.get('table')) for para in paras])
+    for para, count in zip(paras, counts):
+        para['token'] = count
+    return pages
+
+
 @register_tool('simple_doc_parser')
 class SimpleDocParser(BaseTool):
     description = f'提取出一个文档的内容，支持类型包括：{"/".join(PARSER_SUPPORTED_FILE_TYPES)}'
@@ -391,7 +464,9 @@ class SimpleDocParser(BaseTool):
         super().__init__(cfg)
         self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
         self.extract_image = self.cfg.get('extract_image', False)
+        self.pdf_workers = self.cfg.get('pdf_workers', min(DEFAULT_PDF_PARSER_WORKERS, os.cpu_count() or 1))
         self.structured_doc = self.cfg.get('structured_doc', False)
+        self.url_check_interval: float = self.cfg.get('url_check_interval', DEFAULT_URL_CHECK_INTERVAL)
 
         self.db = Storage({'storage_root_path': self.data_root})
 
@@ -417,7 +492,10 @@ class SimpleDocParser(BaseTool):
 
         params = self._verify_json_format_args(params)
         path = params['url']
-        cached_name_ori = f'{hash_sha256(path)}_ori'
+        # The parsed doc is cached by the content, so that it is invalidated if the file changes,
+        # and shared by the same file under different paths.
+        content_hash = kwargs.get('content_hash') or self.get_content_hash(path)
+        cached_name_ori = f'{get_parsed_doc_key(path, content_hash)}_ori'
         try:
             # Directly load the parsed doc
             parsed_file = self.db.get(cached_name_ori)
@@ -437,13 +515,23 @@ class SimpleDocParser(BaseTool):
 
             os.makedirs(self.data_root, exist_ok=True)
             if is_http_url(path):
-                # download online url
-                tmp_file_root = os.path.join(self.data_root, hash_sha256(path))
-                os.makedirs(tmp_file_root, exist_ok=True)
-                path = save_url_to_local_work_dir(path, tmp_file_root)
+                # Reuse the file downloaded when computing the content hash, if any
+                downloaded = self._get_fingerprint(path).get('local_path', '')
+                if os.path.isfile(downloaded) and hash_file_sha256(downloaded) == content_hash:
+                    path = downloaded
+                else:
+                    path = self._download(path)
+
+            def on_pages(pages: List[dict]):
+                # Report the pages parsed so far, currently supported for pdf only
+                kwargs['on_pages'](_count_page_tokens(pages))
+
             try:
                 if f_type == 'pdf':
-                    parsed_file = parse_pdf(path, self.extract_image)
+                    parsed_file = parse_pdf(path,
+                                            self.extract_image,
+                                            max_workers=self.pdf_workers,
+                                            on_pages=on_pages if kwargs.get('on_pages') else None)
                 elif f_type == 'docx':
                     parsed_file = parse_word(path, self.extract_image)
                 elif f_type == 'pptx':
@@ -467,16 +555,80 @@ class SimpleDocParser(BaseTool):
                 exception_message = str(ex)
                 raise DocParserError(code=exception_type, message=exception_message)
 
-            for page in parsed_file:
-                for para in page['content']:
-                    # Todo: More attribute types
-                    para['token'] = count_tokens(para.get('text', para.get('table')))
+            _count_page_tokens(parsed_file)
             time2 = time.time()
             logger.info(f'Finished parsing {path}. Time spent: {time2 - time1} seconds.')
             # Cache the parsing doc
-            self.db.put(cached_name_ori, json.dumps(parsed_file, ensure_ascii=False, indent=2))
+            self.db.put(cached_name_ori, json.dumps(parsed_file, ensure_ascii=False))
 
         if not self.structured_doc:
             return get_plain_doc(parsed_file)
         else:
             return parsed_file
+
+    def get_content_hash(self, path: str) -> str:
+        """The SHA256 of the file content, without reading the file if it seems unchanged since the last time.
+
+        A local file is considered unchanged if its size and modification time are unchanged.
+        An online file is considered unchanged within `url_check_interval` seconds since it was last checked. After
+        that, it is downloaded again only if its ETag or Last-Modified header has changed. If the server sends neither
+        header, the file is assumed unchanged, as with a cache keyed by the url.
+        Otherwise, the file is read (or downloaded) and hashed.
+        """
+        fingerprint = self._get_fingerprint(path)
+        if is_http_url(path):
+            content_hash = fingerprint.get('content_hash')
+            if content_hash and (time.time() - fingerprint.get('checked_at', 0) < self.url_check_interval):
+                return content_hash
+            try:
+                headers = requests.head(path, timeout=5, allow_redirects=True).headers
+                validators = {'etag': headers.get('ETag', ''), 'last_modified': headers.get('Last-Modified', '')}
+            except requests.RequestException:
+                if content_hash:
+                    # Use the last known version when offline
+                    return content_hash
+                validators = {}
+            changed = any(
+                validators.get(k) and fingerprint.get(k) and (validators[k] != fingerprint[k])
+                for k in ['etag', 'last_modified'])
+            if content_hash and not changed:
+                new_fingerprint = {**fingerprint, **{k: v for k, v in validators.items() if v}}
+            else:
+                local_path = self._download(path)
+                new_fingerprint = {**validators, 'local_path': local_path, 'content_hash': hash_file_sha256(local_path)}
+            new_fingerprint['checked_at'] = time.time()
+        else:
+            local_path = sanitize_chrome_file_path(path)
+            try:
+                stat = os.stat(local_path)
+            except OSError as ex:
+                raise DocParserError(code=type(ex).__name__, message=str(ex))
+            if (fingerprint.get('content_hash') and fingerprint.get('size') == stat.st_size and
+                    fingerprint.get('mtime_ns') == stat.st_mtime_ns):
+                return fingerprint['content_hash']
+            new_fingerprint = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'content_hash': hash_file_sha256(local_path)
+            }
+        self.db.put(self._get_fingerprint_key(path), json.dumps(new_fingerprint, ensure_ascii=False))
+        return new_fingerprint['content_hash']
+
+    @staticmethod
+    def _get_fingerprint_key(path: str) -> str:
+        return f'{hash_sha256(path)}_fingerprint'
+
+    def _get_fingerprint(self, path: str) -> dict:
+        try:
+            return json.loads(self.db.get(self._get_fingerprint_key(path)))
+        except KeyNotExistsError:
+            return {}
+        except Exception:
+            print_traceback(is_error=False)
+            return {}
+
+    def _download(self, url: str) -> str:
+        # download online url
+        tmp_file_root = os.path.join(self.data_root, hash_sha256(url))
+        os.makedirs(tmp_file_root, exist_ok=True)
+        return save_url_to_local_work_dir(url, tmp_file_root)
@@ -13,17 +13,257 @@
 # limitations under the License.
 
 import os
-from typing import Dict, Optional, Union
+import sqlite3
+import tempfile
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple, Union
 
-from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.log import logger
+from qwen_agent.settings import DEFAULT_STORAGE_BACKEND, DEFAULT_STORAGE_COMPRESSION, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import BaseTool, register_tool
-from qwen_agent.utils.utils import read_text_from_file, save_text_to_file
+from qwen_agent.utils.utils import print_traceback, read_text_from_file
+
+SQLITE_FILE_NAME = 'storage.sqlite3'
 
 
 class KeyNotExistsError(ValueError):
     pass
 
 
+class BaseStorageBackend(ABC):
+    """The key-value store behind the Storage tool. Keys are slash-separated paths like `a/b/c`."""
+
+    @abstractmethod
+    def get(self, key: str) -> str:
+        """Get the value of a key, or raise KeyNotExistsError."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    def put_many(self, kvs: Dict[str, str]) -> None:
+        for key, value in kvs.items():
+            self.put(key, value)
+
+    @abstractmethod
+    def delete(self, key: str) -> bool:
+        """Delete a key, and return False if it does not exist."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan(self, prefix: str) -> Iterator[Tuple[str, str]]:
+        """Iterate over the key-value pairs whose keys start with the prefix."""
+        raise NotImplementedError
+
+
+class FileStorageBackend(BaseStorageBackend):
+    """One file for one key-value pair, which is easy to inspect but slow for many small values.
+
+    Each value is written to a temporary file and then renamed, so that a reader never sees a partially written
+    value. There is no locking beyond that, and batched writes are not atomic as a whole.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def get(self, key: str) -> str:
+        path = os.path.join(self.root, key)
+        if not os.path.isfile(path):
+            raise KeyNotExistsError(f'Get Failed: {key} does not exist')
+        return read_text_from_file(path)
+
+    def put(self, key: str, value: str) -> None:
+        path = os.path.join(self.root, key)
+        path_dir = os.path.dirname(path)
+        if path_dir:
+            os.makedirs(path_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path_dir or None, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+                fp.write(value)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, key: str) -> bool:
+        path = os.path.join(self.root, key)
+        if os.path.isfile(path):
+            os.remove(path)
+            return True
+        return False
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(os.path.join(self.root, key))
+
+    def scan(self, prefix: str) -> Iterator[Tuple[str, str]]:
+        # Only whole folders are supported, i.e., the prefix is empty or ends with a slash
+        path = os.path.join(self.root, prefix)
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                if file.startswith('.') and file.endswith('.tmp'):
+                    continue  # Being written
+                k = os.path.relpath(os.path.join(root, file), self.root).replace(os.sep, '/')
+                if k.startswith(SQLITE_FILE_NAME):
+                    continue  # The database of SQLiteStorageBackend
+                yield k, read_text_from_file(os.path.join(root, file))
+
+
+class SQLiteStorageBackend(BaseStorageBackend):
+    """All key-value pairs in one SQLite database under the root folder.
+
+    Writes are transactional, concurrent processes are serialized by the database lock, and prefix scans are
+    range queries on the primary key. The values can be compressed with zlib or zstd (requires `zstandard`).
+    On first use, the files in the root folder written by FileStorageBackend are imported into the database. Only
+    the top-level text files are imported, since the subfolders of a data root may hold downloaded files, e.g., the
+    pdfs cached by SimpleDocParser.
+    """
+
+    def __init__(self, root: str, compression: str = '', min_compress_size: int = 1024, timeout: float = 60):
+        self.root = root
+        self.db_path = os.path.join(root, SQLITE_FILE_NAME)
+        self.min_compress_size = min_compress_size
+        self.timeout = timeout
+        self.compression = compression
+        if self.compression == 'zstd':
+            try:
+                import zstandard  # noqa
+            except ImportError:
+                print_traceback(is_error=False)
+                logger.warning('Falling back to zlib compression because zstandard is not installed. '
+                               'Please `pip install zstandard`.')
+                self.compression = 'zlib'
+        elif self.compression not in ('', 'zlib'):
+            raise ValueError(f'Unsupported storage compression: {compression}')
+
+        os.makedirs(self.root, exist_ok=True)
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, codec TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() is None:
+                self._migrate_from_files(conn)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('migrated', '1')")
+
+    def get(self, key: str) -> str:
+        row = self._get_conn().execute('SELECT value, codec FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyNotExistsError(f'Get Failed: {key} does not exist')
+        return _decode(*row)
+
+    def put(self, key: str, value: str) -> None:
+        self.put_many({key: value})
+
+    def put_many(self, kvs: Dict[str, str]) -> None:
+        rows = [(k, *self._encode(v)) for k, v in kvs.items()]
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO kv (key, value, codec) VALUES (?, ?, ?)', rows)
+
+    def delete(self, key: str) -> bool:
+        with self._transaction() as conn:
+            return conn.execute('DELETE FROM kv WHERE key = ?', (key,)).rowcount > 0
+
+    def exists(self, key: str) -> bool:
+        return self._get_conn().execute('SELECT 1 FROM kv WHERE key = ?', (key,)).fetchone() is not None
+
+    def scan(self, prefix: str) -> Iterator[Tuple[str, str]]:
+        if prefix:
+            # The keys in [prefix, next_prefix) are exactly those starting with prefix
+            next_prefix = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            rows = self._get_conn().execute('SELECT key, value, codec FROM kv WHERE key >= ? AND key < ? ORDER BY key',
+                                            (prefix, next_prefix)).fetchall()
+        else:
+            rows = self._get_conn().execute('SELECT key, value, codec FROM kv ORDER BY key').fetchall()
+        for k, v, codec in rows:
+            yield k, _decode(v, codec)
+
+    def _get_conn(self) -> sqlite3.Connection:
+        # One connection per thread, and a new one in a forked child process
+        conn = getattr(self._local, 'conn', None)
+        if (conn is None) or (self._local.pid != os.getpid()):
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._get_conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _encode(self, value: str) -> Tuple[bytes, str]:
+        data = value.encode('utf-8')
+        if (not self.compression) or (len(data) < self.min_compress_size):
+            return data, ''
+        if self.compression == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor().compress(data), 'zstd'
+        return zlib.compress(data), 'zlib'
+
+    def _migrate_from_files(self, conn: sqlite3.Connection) -> None:
+        rows = []
+        for entry in os.scandir(self.root):
+            # Skip the subfolders, the temporary files being written, and the database itself
+            if (not entry.is_file(follow_symlinks=False)) or entry.name.startswith(('.', SQLITE_FILE_NAME)):
+                continue
+            try:
+                with open(entry.path, 'rb') as fp:
+                    v = fp.read().decode('utf-8')
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning(f'Skipped migrating {entry.path}: {e}')
+                continue
+            rows.append((entry.name, *self._encode(v)))
+        if rows:
+            # Keep the values already in the database, which are newer
+            conn.executemany('INSERT OR IGNORE INTO kv (key, value, codec) VALUES (?, ?, ?)', rows)
+            logger.info(f'Migrated {len(rows)} files in {self.root} to {self.db_path}.')
+
+
+def _decode(data: bytes, codec: str) -> str:
+    if codec == 'zstd':
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'zlib':
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
+
+
+_STORAGE_BACKENDS: Dict[tuple, BaseStorageBackend] = {}
+_STORAGE_BACKENDS_LOCK = threading.Lock()
+
+
+def get_storage_backend(root: str, backend: str = 'file', compression: str = '') -> BaseStorageBackend:
+    """Get the storage backend of a root folder, which is shared by the Storage instances in this process."""
+    key = (os.path.abspath(root), backend, compression)
+    with _STORAGE_BACKENDS_LOCK:
+        if key not in _STORAGE_BACKENDS:
+            if backend == 'file':
+                _STORAGE_BACKENDS[key] = FileStorageBackend(root)
+            elif backend == 'sqlite':
+                _STORAGE_BACKENDS[key] = SQLiteStorageBackend(root, compression=compression)
+            else:
+                raise ValueError(f'Unsupported storage backend: {backend}')
+        return _STORAGE_BACKENDS[key]
+
+
 @register_tool('storage')
 class Storage(BaseTool):
     """
@@ -49,7 +289,9 @@ class Storage(BaseTool):
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
         self.root = self.cfg.get('storage_root_path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
-        os.makedirs(self.root, exist_ok=True)
+        self.backend = self.cfg.get('backend', DEFAULT_STORAGE_BACKEND)
+        self.compression = self.cfg.get('compression', DEFAULT_STORAGE_COMPRESSION)
+        self._get_backend()
 
     def call(self, params: Union[str, dict], **kwargs) -> str:
         params = self._verify_json_format_args(params)
@@ -69,48 +311,34 @@ class Storage(BaseTool):
             return self.scan(key)
 
     def put(self, key: str, value: str, path: Optional[str] = None) -> str:
-        path = path or self.root
-
-        # one file for one key value pair
-        path = os.path.join(path, key)
-
-        path_dir = path[:path.rfind('/') + 1]
-        if path_dir:
-            os.makedirs(path_dir, exist_ok=True)
-
-        save_text_to_file(path, value)
+        self._get_backend(path).put(key, value)
         return f'Successfully saved {key}.'
 
+    def put_many(self, kvs: Dict[str, str], path: Optional[str] = None) -> str:
+        """Save several key-value pairs at once, in a single transaction if supported by the backend."""
+        self._get_backend(path).put_many(kvs)
+        return f'Successfully saved {len(kvs)} items.'
+
     def get(self, key: str, path: Optional[str] = None) -> str:
-        path = path or self.root
-        if not os.path.exists(os.path.join(path, key)):
-            raise KeyNotExistsError(f'Get Failed: {key} does not exist')
-        return read_text_from_file(os.path.join(path, key))
+        return self._get_backend(path).get(key)
 
     def delete(self, key, path: Optional[str] = None) -> str:
-        path = path or self.root
-        path = os.path.join(path, key)
-        if os.path.exists(path):
-            os.remove(path)
+        if self._get_backend(path).delete(key):
             return f'Successfully deleted {key}'
         else:
             return f'Delete Failed: {key} does not exist'
 
     def scan(self, key: str, path: Optional[str] = None) -> str:
-        path = path or self.root
-        path = os.path.join(path, key)
-        if os.path.exists(path):
-            if not os.path.isdir(path):
-                return 'Scan Failed: The scan operation requires passing in a folder path as the key.'
-            # All key-value pairs
-            kvs = {}
-            for root, dirs, files in os.walk(path):
-                for file in files:
-                    k = os.path.join(root, file)[len(path):]
-                    if not k.startswith('/'):
-                        k = '/' + k
-                    v = read_text_from_file(os.path.join(root, file))
-                    kvs[k] = v
-            return '\n'.join([f'{k}: {v}' for k, v in kvs.items()])
-        else:
+        db = self._get_backend(path)
+        folder = key.strip('/')
+        if folder and db.exists(folder):
+            return 'Scan Failed: The scan operation requires passing in a folder path as the key.'
+        prefix = f'{folder}/' if folder else ''
+        # All key-value pairs
+        kvs = {'/' + k[len(prefix):]: v for k, v in db.scan(prefix)}
+        if not kvs and folder:
             return f'Scan Failed: {key} does not exist.'
+        return '\n'.join([f'{k}: {v}' for k, v in kvs.items()])
+
+    def _get_backend(self, path: Optional[str] = None) -> BaseStorageBackend:
+        return get_storage_backend(path or self.root, backend=self.backend, compression=self.compression)
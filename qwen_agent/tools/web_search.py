@@ -36,6 +36,8 @@ class WebSearch(BaseTool):
         },
         'required': ['query'],
     }
+    idempotent = True
+    cache_ttl = 3600
 
     def call(self, params: Union[str, dict], **kwargs) -> str:
         params = self._verify_json_format_args(params)
@@ -45,6 +47,13 @@ class WebSearch(BaseTool):
         formatted_results = self._format_results(search_results)
         return formatted_results
 
+    def _get_cache_key_params(self, params: Union[str, dict], **kwargs) -> dict:
+        key_params = super()._get_cache_key_params(params, **kwargs)
+        query = key_params['params'].get('query') if isinstance(key_params['params'], dict) else None
+        if isinstance(query, str):
+            key_params['params'] = {**key_params['params'], 'query': ' '.join(query.split())}
+        return key_params
+
     @staticmethod
     def search(query: str) -> List[Any]:
         if not SERPER_API_KEY:
@@ -0,0 +1,93 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import threading
+from typing import Dict, Iterator, List, Optional
+
+
+class LazyRegistry(dict):
+    """A registry from names to classes, where the built-in classes are imported on their first lookup.
+
+    The built-in entries are given as a mapping from names to the modules that register them, so that a
+    module is imported only when one of its names is looked up, e.g., `registry['oai']`. Classes registered
+    at runtime, e.g., by third-party code, are stored as usual. Membership tests and `keys()` cover both kinds
+    of entries without importing any module, while `values()` and `items()` import all the built-in modules.
+    """
+
+    def __init__(self, builtin_modules: Optional[Dict[str, str]] = None):
+        super().__init__()
+        self.builtin_modules: Dict[str, str] = dict(builtin_modules or {})
+        self._import_lock = threading.RLock()
+
+    def __missing__(self, name: str):
+        module = self.builtin_modules.get(name)
+        if module is None:
+            raise KeyError(name)
+        with self._import_lock:
+            importlib.import_module(module)
+        return dict.__getitem__(self, name)
+
+    def __contains__(self, name) -> bool:
+        return dict.__contains__(self, name) or (name in self.builtin_modules)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from dict.__iter__(self)
+        for name in self.builtin_modules:
+            if not dict.__contains__(self, name):
+                yield name
+
+    def __len__(self) -> int:
+        return dict.__len__(self) + sum(1 for name in self.builtin_modules if not dict.__contains__(self, name))
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.keys()})'
+
+    def get(self, name: str, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        return [name for name in self]
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    def load_all(self):
+        for name in self.builtin_modules:
+            self[name]  # noqa
+
+    def is_loaded(self, name: str) -> bool:
+        return dict.__contains__(self, name)
+
+    def is_taken(self, name: str, cls: type) -> bool:
+        """Whether registering `cls` under `name` would replace another class, loaded or not."""
+        return self.is_loaded(name) or (self.builtin_modules.get(name, cls.__module__) != cls.__module__)
+
+    def is_overridden(self, name: str, cls: type) -> bool:
+        """Whether `cls` is the built-in class of `name`, but another class has been registered under `name`.
+
+        This happens when a custom class overwrites a built-in one before the built-in module is imported.
+        The custom class takes precedence as if the built-in one were registered first.
+        """
+        if (self.builtin_modules.get(name) != cls.__module__) or (not self.is_loaded(name)):
+            return False
+        return dict.__getitem__(self, name).__module__ != cls.__module__
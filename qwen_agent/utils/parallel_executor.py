@@ -12,10 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import random
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Any, Callable, List, Optional
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
 
 def parallel_exec(
@@ -54,6 +56,64 @@ def parallel_exec(
     return results
 
 
+def parallel_exec_in_order(
+    fn: Callable,
+    list_of_kwargs: List[dict],
+    max_workers: Optional[int] = None,
+    groups: Optional[List[str]] = None,
+    max_workers_per_group: Optional[Dict[str, int]] = None,
+) -> Iterator[Any]:
+    """
+    Executes a given function `fn` in parallel using multiple threads, and yields the results in the order of
+    `list_of_kwargs`. Each result is yielded as soon as it and all the results before it are ready.
+
+    Args:
+    - fn (Callable): The function to execute in parallel.
+    - list_of_kwargs (list): A list of dicts, where each dict contains arguments for a single call to `fn`.
+    - max_workers (int, optional): The maximum number of threads that can be used to execute the tasks
+      concurrently.
+    - groups (list, optional): The group of each task, e.g., the name of the tool called by the task.
+    - max_workers_per_group (dict, optional): The maximum number of concurrent tasks of a group. A task is not
+      started until its group is below the limit, so that it never occupies a thread while waiting.
+
+    Yields:
+    - The results of the function calls, in the same order as `list_of_kwargs`.
+    """
+    groups = groups or [''] * len(list_of_kwargs)
+    max_workers_per_group = max_workers_per_group or {}
+    results, next_to_yield = {}, 0
+    pending = list(range(len(list_of_kwargs)))
+    running = {}  # future -> index
+    num_running_per_group = Counter()
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)  # The default of ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start the tasks in order, skipping those whose groups are busy
+            for i in list(pending):
+                if len(running) >= max_workers:
+                    break
+                limit = max_workers_per_group.get(groups[i])
+                if (limit is not None) and (num_running_per_group[groups[i]] >= max(limit, 1)):
+                    continue
+                pending.remove(i)
+                running[executor.submit(fn, **list_of_kwargs[i])] = i
+                num_running_per_group[groups[i]] += 1
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                num_running_per_group[groups[i]] -= 1
+                try:
+                    results[i] = future.result()
+                except BaseException:
+                    for f in running:
+                        f.cancel()
+                    raise
+            while next_to_yield in results:
+                yield results.pop(next_to_yield)
+                next_to_yield += 1
+
+
 # for debug
 def serial_exec(fn: Callable, list_of_kwargs: List[dict]) -> List[Any]:
     results = []
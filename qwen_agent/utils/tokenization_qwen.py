@@ -15,13 +15,23 @@
 """Tokenization classes for QWen."""
 
 import base64
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import threading
 import unicodedata
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
 from pathlib import Path
-from typing import Collection, Dict, List, Set, Union
+from typing import Collection, Dict, List, Optional, Set, Union
 
 import tiktoken
 
 from qwen_agent.log import logger
+from qwen_agent.settings import TOKEN_COUNT_CACHE_SIZE, TOKENIZER_CACHE_DIR
 
 VOCAB_FILES_NAMES = {'vocab_file': 'qwen.tiktoken'}
 
@@ -44,14 +54,84 @@ SPECIAL_TOKENS = tuple(enumerate(
     start=SPECIAL_START_ID,
 ))
 SPECIAL_TOKENS_SET = set(t for i, t in SPECIAL_TOKENS)
+# Shorter texts are counted directly, which is about as fast as looking up the memo
+MIN_MEMO_TEXT_LEN = 256
 
 
-def _load_tiktoken_bpe(tiktoken_bpe_file: str) -> Dict[bytes, int]:
+# The binary cache of a vocabulary file: the header, the ranks (uint32), the token lengths (uint16), and the tokens
+BPE_CACHE_HEADER = struct.Struct('<8sI')
+BPE_CACHE_MAGIC = b'QWBPE\x00\x00\x01'
+
+
+def _load_tiktoken_bpe(tiktoken_bpe_file: str, cache_dir: Optional[str] = TOKENIZER_CACHE_DIR) -> Dict[bytes, int]:
     with open(tiktoken_bpe_file, 'rb') as f:
         contents = f.read()
-    return {
+
+    # Base64-decoding every line is slow, hence the binary cache, keyed by the digest of the file contents
+    cache_file = None
+    if cache_dir:
+        digest = hashlib.blake2b(contents, digest_size=16).hexdigest()
+        cache_file = os.path.join(cache_dir, f'{Path(tiktoken_bpe_file).name}.{digest}.bin')
+        mergeable_ranks = _read_bpe_cache(cache_file)
+        if mergeable_ranks is not None:
+            return mergeable_ranks
+
+    mergeable_ranks = {
         base64.b64decode(token): int(rank) for token, rank in (line.split() for line in contents.splitlines() if line)
     }
+    if cache_file:
+        _write_bpe_cache(cache_file, mergeable_ranks)
+    return mergeable_ranks
+
+
+def _read_bpe_cache(cache_file: str) -> Optional[Dict[bytes, int]]:
+    try:
+        with open(cache_file, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        magic, n = BPE_CACHE_HEADER.unpack_from(data)
+        if magic != BPE_CACHE_MAGIC:
+            return None
+        ranks, lens = array('I'), array('H')
+        pos = BPE_CACHE_HEADER.size
+        ranks.frombytes(data[pos:pos + n * ranks.itemsize])
+        pos += n * ranks.itemsize
+        lens.frombytes(data[pos:pos + n * lens.itemsize])
+        pos += n * lens.itemsize
+    except (struct.error, ValueError):
+        return None
+    if sys.byteorder != 'little':
+        ranks.byteswap()
+        lens.byteswap()
+    offsets = list(accumulate(lens, initial=pos))
+    if (len(ranks) != n) or (len(lens) != n) or (offsets[-1] != len(data)):
+        logger.warning(f'Ignoring the corrupted tokenizer cache {cache_file}')
+        return None
+    return dict(zip(map(data.__getitem__, map(slice, offsets[:-1], offsets[1:])), ranks))
+
+
+def _write_bpe_cache(cache_file: str, mergeable_ranks: Dict[bytes, int]):
+    tmp_path = None
+    try:
+        ranks, lens = array('I', mergeable_ranks.values()), array('H', map(len, mergeable_ranks))
+        if sys.byteorder != 'little':
+            ranks.byteswap()
+            lens.byteswap()
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), prefix='.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(BPE_CACHE_HEADER.pack(BPE_CACHE_MAGIC, len(mergeable_ranks)))
+            f.write(ranks.tobytes())
+            f.write(lens.tobytes())
+            f.write(b''.join(mergeable_ranks))
+        os.replace(tmp_path, cache_file)
+    except (OSError, OverflowError) as e:
+        # Read-only home directories, tokens longer than 64KB, etc. only cost the speedup
+        logger.warning(f'Failed to write the tokenizer cache {cache_file}: {e}')
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 class QWenTokenizer:
@@ -64,67 +144,90 @@ class QWenTokenizer:
         vocab_file=None,
         errors='replace',
         extra_vocab_file=None,
+        count_cache_size: int = TOKEN_COUNT_CACHE_SIZE,
     ):
         if not vocab_file:
             vocab_file = VOCAB_FILES_NAMES['vocab_file']
+        self.vocab_file = vocab_file
+        self.extra_vocab_file = extra_vocab_file
         self._decode_use_source_tokenizer = False
 
         # how to handle errors in decoding UTF-8 byte sequences
         # use ignore if you are in streaming inference
         self.errors = errors
 
-        self.mergeable_ranks = _load_tiktoken_bpe(vocab_file)  # type: Dict[bytes, int]
         self.special_tokens = {token: index for index, token in SPECIAL_TOKENS}
-
-        # try load extra vocab from file
-        if extra_vocab_file is not None:
-            used_ids = set(self.mergeable_ranks.values()) | set(self.special_tokens.values())
-            extra_mergeable_ranks = _load_tiktoken_bpe(extra_vocab_file)
-            for token, index in extra_mergeable_ranks.items():
-                if token in self.mergeable_ranks:
-                    logger.info(f'extra token {token} exists, skipping')
-                    continue
-                if index in used_ids:
-                    logger.info(f'the index {index} for extra token {token} exists, skipping')
-                    continue
-                self.mergeable_ranks[token] = index
-            # the index may be sparse after this, but don't worry tiktoken.Encoding will handle this
-
-        enc = tiktoken.Encoding(
-            'Qwen',
-            pat_str=PAT_STR,
-            mergeable_ranks=self.mergeable_ranks,
-            special_tokens=self.special_tokens,
-        )
-        assert len(self.mergeable_ranks) + len(
-            self.special_tokens
-        ) == enc.n_vocab, f'{len(self.mergeable_ranks) + len(self.special_tokens)} != {enc.n_vocab} in encoding'
-
-        self.decoder = {v: k for k, v in self.mergeable_ranks.items()}  # type: dict[int, bytes|str]
-        self.decoder.update({v: k for k, v in self.special_tokens.items()})
-
-        self.tokenizer = enc  # type: tiktoken.Encoding
-
-        self.eod_id = self.tokenizer.eot_token
+        self.special_ids = {index: token for token, index in self.special_tokens.items()}
+        self.eod_id = self.special_tokens[ENDOFTEXT]
         self.im_start_id = self.special_tokens[IMSTART]
         self.im_end_id = self.special_tokens[IMEND]
 
+        # The vocabulary is loaded on first use, so that importing this module costs nothing
+        self._load_lock = threading.Lock()
+
+        # The memo of token counts, keyed by the digests of the texts
+        self.count_cache_size = count_cache_size
+        self._count_cache: 'OrderedDict[bytes, int]' = OrderedDict()
+        self._count_cache_lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        # Only called for the attributes not set yet, i.e., before the vocabulary is loaded
+        if name in ('tokenizer', 'mergeable_ranks'):
+            self._load()
+            return self.__dict__[name]
+        raise AttributeError(f'{self.__class__.__name__!r} object has no attribute {name!r}')
+
+    def _load(self):
+        with self._load_lock:
+            if 'tokenizer' in self.__dict__:
+                return
+            mergeable_ranks = _load_tiktoken_bpe(self.vocab_file)  # type: Dict[bytes, int]
+
+            # try load extra vocab from file
+            if self.extra_vocab_file is not None:
+                used_ids = set(mergeable_ranks.values()) | set(self.special_tokens.values())
+                extra_mergeable_ranks = _load_tiktoken_bpe(self.extra_vocab_file)
+                for token, index in extra_mergeable_ranks.items():
+                    if token in mergeable_ranks:
+                        logger.info(f'extra token {token} exists, skipping')
+                        continue
+                    if index in used_ids:
+                        logger.info(f'the index {index} for extra token {token} exists, skipping')
+                        continue
+                    mergeable_ranks[token] = index
+                # the index may be sparse after this, but don't worry tiktoken.Encoding will handle this
+
+            enc = tiktoken.Encoding(
+                'Qwen',
+                pat_str=PAT_STR,
+                mergeable_ranks=mergeable_ranks,
+                special_tokens=self.special_tokens,
+            )
+            assert len(mergeable_ranks) + len(
+                self.special_tokens
+            ) == enc.n_vocab, f'{len(mergeable_ranks) + len(self.special_tokens)} != {enc.n_vocab} in encoding'
+            assert enc.eot_token == self.eod_id
+
+            # The ranks are shared with tiktoken, which also serves the id-to-bytes view,
+            # so that no other copy of the vocabulary is kept.
+            self.mergeable_ranks = mergeable_ranks
+            self.tokenizer = enc  # type: tiktoken.Encoding
+
     def __getstate__(self):
         # for pickle lovers
+        # Only the configuration is pickled, and the vocabulary is loaded again on first use after unpickling
         state = self.__dict__.copy()
-        del state['tokenizer']
+        state.pop('tokenizer', None)
+        state.pop('mergeable_ranks', None)
+        del state['_load_lock']
+        del state['_count_cache_lock']
+        state['_count_cache'] = OrderedDict()
         return state
 
     def __setstate__(self, state):
-        # tokenizer is not python native; don't pass it; rebuild it
         self.__dict__.update(state)
-        enc = tiktoken.Encoding(
-            'Qwen',
-            pat_str=PAT_STR,
-            mergeable_ranks=self.mergeable_ranks,
-            special_tokens=self.special_tokens,
-        )
-        self.tokenizer = enc
+        self._load_lock = threading.Lock()
+        self._count_cache_lock = threading.Lock()
 
     def __len__(self) -> int:
         return self.tokenizer.n_vocab
@@ -168,13 +271,19 @@ class QWenTokenizer:
         Returns:
             `List[bytes|str]`: The list of tokens.
         """
-        tokens = []
         text = unicodedata.normalize('NFC', text)
 
         # this implementation takes a detour: text -> token id -> token surface forms
-        for t in self.tokenizer.encode(text, allowed_special=allowed_special, disallowed_special=disallowed_special):
-            tokens.append(self.decoder[t])
-        return tokens
+        ids = self.tokenizer.encode(text, allowed_special=allowed_special, disallowed_special=disallowed_special)
+        tokens = self.tokenizer.decode_tokens_bytes(ids)
+        # The special tokens are in their str forms
+        return [self.special_ids.get(i, t) for i, t in zip(ids, tokens)]
+
+    def get_token_offsets(self, ids: List[int]) -> List[int]:
+        """
+        Returns the end offset of each token in the UTF-8 bytes of the text encoded to the token ids, see `encode`.
+        """
+        return list(accumulate(map(len, self.tokenizer.decode_tokens_bytes(ids))))
 
     def convert_tokens_to_string(self, tokens: List[Union[bytes, str]]) -> str:
         """
@@ -213,10 +322,56 @@ class QWenTokenizer:
         return self.tokenizer.decode(token_ids, errors=errors or self.errors)
 
     def encode(self, text: str) -> List[int]:
-        return self.convert_tokens_to_ids(self.tokenize(text))
+        # The same as convert_tokens_to_ids(tokenize(text)), without the detour through the token surface forms
+        return self.tokenizer.encode(unicodedata.normalize('NFC', text), allowed_special='all', disallowed_special=())
 
     def count_tokens(self, text: str) -> int:
-        return len(self.tokenize(text))
+        key = self._get_count_cache_key(text)
+        if key is not None:
+            with self._count_cache_lock:
+                count = self._count_cache.get(key)
+                if count is not None:
+                    self._count_cache.move_to_end(key)
+                    return count
+        count = len(self.encode(text))
+        if key is not None:
+            self._set_count_cache(key, count)
+        return count
+
+    def count_tokens_batch(self, texts: List[str], num_threads: int = 8) -> List[int]:
+        """
+        Counts the tokens of many texts at once, encoding those not memoized in parallel threads.
+        """
+        counts: List[Optional[int]] = [None] * len(texts)
+        keys = [self._get_count_cache_key(text) for text in texts]
+        with self._count_cache_lock:
+            for i, key in enumerate(keys):
+                if key is not None and key in self._count_cache:
+                    self._count_cache.move_to_end(key)
+                    counts[i] = self._count_cache[key]
+        todo = [i for i, count in enumerate(counts) if count is None]
+        if todo:
+            ids_list = self.tokenizer.encode_batch([unicodedata.normalize('NFC', texts[i]) for i in todo],
+                                                   num_threads=num_threads,
+                                                   allowed_special='all',
+                                                   disallowed_special=())
+            for i, ids in zip(todo, ids_list):
+                counts[i] = len(ids)
+                if keys[i] is not None:
+                    self._set_count_cache(keys[i], counts[i])
+        return counts
+
+    def _get_count_cache_key(self, text: str) -> Optional[bytes]:
+        if self.count_cache_size <= 0 or len(text) < MIN_MEMO_TEXT_LEN:
+            return None
+        return hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+
+    def _set_count_cache(self, key: bytes, count: int):
+        with self._count_cache_lock:
+            self._count_cache[key] = count
+            self._count_cache.move_to_end(key)
+            while len(self._count_cache) > self.count_cache_size:
+                self._count_cache.popitem(last=False)
 
     def truncate(self, text: str, max_token: int, start_token: int = 0, keep_both_sides: bool = False) -> str:
         token_list = self.tokenize(text)[start_token:]
@@ -244,3 +399,7 @@ tokenizer = QWenTokenizer(Path(__file__).resolve().parent / 'qwen.tiktoken')
 
 def count_tokens(text: str) -> int:
     return tokenizer.count_tokens(text)
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    return tokenizer.count_tokens_batch(texts)
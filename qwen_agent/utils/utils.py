@@ -81,6 +81,14 @@ def hash_sha256(text: str) -> str:
     return key
 
 
+def hash_file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    hash_object = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hash_object.update(block)
+    return hash_object.hexdigest()
+
+
 def print_traceback(is_error: bool = True):
     tb = ''.join(traceback.format_exception(*sys.exc_info(), limit=3))
     if is_error:
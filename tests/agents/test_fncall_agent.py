@@ -0,0 +1,60 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from qwen_agent.agents import FnCallAgent
+from qwen_agent.tools.base import BaseTool
+
+
+class SleepTool(BaseTool):
+    name = 'sleep'
+    description = 'Sleep for a while and return the seconds slept.'
+    parameters = {'type': 'object', 'properties': {'seconds': {'type': 'number'}}, 'required': ['seconds']}
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg)
+        self.lock = threading.Lock()
+        self.num_running = 0
+        self.max_num_running = 0
+
+    def call(self, params, **kwargs) -> str:
+        seconds = self._verify_json_format_args(params)['seconds']
+        with self.lock:
+            self.num_running += 1
+            self.max_num_running = max(self.max_num_running, self.num_running)
+        time.sleep(seconds)
+        with self.lock:
+            self.num_running -= 1
+        return str(seconds)
+
+
+def test_fncall_agent_concurrent_tool_calls():
+    tool = SleepTool()
+    llm_cfg = {'model': 'qwen-max', 'model_server': 'http://127.0.0.1:8000/v1', 'api_key': 'EMPTY'}
+    bot = FnCallAgent(function_list=[tool], llm=llm_cfg, max_tool_workers=4)
+    tool_calls = [('sleep', '{"seconds": 0.3}'), ('sleep', '{"seconds": 0.1}'), ('sleep', '{"seconds": 0.2}')]
+
+    t = time.time()
+    results = [m.content for m in bot._call_tools(tool_calls, messages=[])]
+    assert results == ['0.3', '0.1', '0.2']  # in the order of the calls
+    assert time.time() - t < 0.5
+    assert tool.max_num_running == 3
+
+    tool.max_num_running = 0
+    tool.max_concurrency = 1
+    results = [m.content for m in bot._call_tools(tool_calls, messages=[])]
+    assert results == ['0.3', '0.1', '0.2']
+    assert tool.max_num_running == 1
@@ -0,0 +1,66 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from qwen_agent.llm.cache import LLMCache, StreamRecorder, replay_cache_entry
+from qwen_agent.llm.schema import Message
+
+
+def test_llm_cache_lru_and_ttl(tmp_path):
+    cache = LLMCache(cache_dir=str(tmp_path), ttl=0.5, max_memory_items=2)
+    for i in range(3):
+        cache.set(f'key{i}', {'output': [{'role': 'assistant', 'content': str(i)}], 'chunks': None})
+    assert cache.stats()['evictions'] == 1
+    assert cache.get('key0')['output'][0]['content'] == '0'  # Served by the disk tier
+    assert cache.stats()['disk_hits'] == 1
+    time.sleep(0.6)
+    assert cache.get('key1') is None
+    assert cache.stats()['misses'] == 1
+
+    # An entry loaded from the disk tier expires as it does on disk, rather than a full ttl after loading
+    cache = LLMCache(cache_dir=str(tmp_path), ttl=0.5)
+    cache.set('key', {'output': None, 'chunks': []})
+    time.sleep(0.3)
+    cache._memory.clear()
+    assert cache.get('key') is not None
+    time.sleep(0.3)
+    assert cache.get('key') is None
+
+
+def test_llm_cache_memory_bytes():
+    cache = LLMCache(max_memory_bytes=100)
+    for i in range(4):
+        cache.set(f'key{i}', {'output': 'x' * 30})
+    assert cache.stats()['memory_bytes'] <= 100
+    assert cache.get('key0') is None
+    assert cache.get('key3') is not None
+    cache.set('large', {'output': 'x' * 100})
+    assert cache.get('large') is None
+    assert cache.get('key3') is not None
+
+
+def test_stream_recorder_replay():
+    recorder = StreamRecorder(delta_stream=False, max_chunks=8)
+    for i in range(1, 101):
+        recorder.add([Message('assistant', 'x' * i)])
+    chunks = list(replay_cache_entry(recorder.to_entry()))
+    assert len(chunks) <= 9
+    assert chunks[-1][0]['content'] == 'x' * 100
+
+    recorder = StreamRecorder(delta_stream=True, max_chunks=8)
+    for i in range(100):
+        recorder.add([Message('assistant', 'x')])
+    chunks = list(replay_cache_entry(recorder.to_entry()))
+    assert ''.join(c[0]['content'] for c in chunks) == 'x' * 100
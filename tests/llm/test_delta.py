@@ -0,0 +1,103 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from qwen_agent.llm import base
+from qwen_agent.llm.base import ModelServiceError
+from qwen_agent.llm.delta import DeltaStream, MessageDelta, MessageDumper, iter_message_deltas, iter_text_deltas
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import FunctionCall, Message
+
+
+class _StubLLM(BaseFnCallModel):
+
+    def __init__(self, streams):
+        super().__init__({'model': 'stub', 'generate_cfg': {'max_retries': 1}})
+        self.streams = streams
+
+    def _chat_stream(self, messages, delta_stream, generate_cfg):
+        return self.streams.pop(0)
+
+    def _chat_no_stream(self, messages, generate_cfg):
+        raise NotImplementedError
+
+
+def test_iter_message_deltas():
+    fn_msg = Message('assistant', '', function_call=FunctionCall('my_tool', '{}'))
+    stream = [
+        [Message('assistant', 'He')],
+        [Message('assistant', 'Hello')],
+        [Message('assistant', 'Hello')],
+        [Message('assistant', 'Hello'), fn_msg],
+        [Message('assistant', 'Hi')],
+    ]
+    chunks = list(iter_message_deltas(iter(stream)))
+    assert len(chunks) == 4
+    assert chunks[1][1][0].content == 'llo'
+    assert chunks[2][1][0].index == 1 and chunks[2][1][0].replace
+    assert chunks[3][1][0].replace and chunks[3][1][0].message.content == 'Hi'
+
+
+def test_delta_stream():
+    fn_msg = Message('assistant', '', function_call=FunctionCall('my_tool', '{}'))
+    stream = DeltaStream([
+        [MessageDelta(index=0, message=Message('assistant', 'He'), replace=True)],
+        [MessageDelta(index=0, content='llo'),
+         MessageDelta(index=1, message=fn_msg, replace=True)],
+        [MessageDelta(index=1, extra={'k': 'v'})],
+    ])
+    chunks = list(iter_message_deltas(stream))
+    assert [[m.content for m in messages] for messages, _ in chunks] == [['He'], ['Hello', ''], ['Hello', '']]
+    assert chunks[1][1][0].message.content == 'Hello'
+    assert chunks[2][0][0] is chunks[1][0][0]  # The unchanged message is not rebuilt
+    assert chunks[2][0][1].extra == {'k': 'v'} and chunks[2][0][1].function_call.name == 'my_tool'
+
+    # Iterating a DeltaStream yields the full message lists
+    stream = DeltaStream(iter_text_deltas(iter([('', None, None), ('Hel', None, None), ('lo', 'think', None)])))
+    assert [m.model_dump() for m in list(stream)[-1]] == [{
+        'role': 'assistant',
+        'content': 'Hello',
+        'reasoning_content': 'think'
+    }]
+
+
+def test_stream_retry_restarts_deltas(monkeypatch):
+    monkeypatch.setattr(base.time, 'sleep', lambda _: None)
+
+    def _failing_stream():
+        yield [Message('assistant', 'Partial')]
+        yield [Message('assistant', 'Partial answer'), Message('assistant', 'More')]
+        raise ModelServiceError(code='500', message='Broken stream')
+
+    llm = _StubLLM([
+        _failing_stream(),
+        DeltaStream(iter_text_deltas(iter([('Fu', None, None), ('ll', None, None)]))),
+    ])
+    chunks = [[m.content for m in rsp] for rsp in llm.chat([Message('user', 'hi')])]
+    assert chunks == [['Partial'], ['Partial answer', 'More'], ['Fu'], ['Full']]
+
+
+def test_delta_stream_chunks_are_not_merged():
+    llm = _StubLLM([iter([[Message('assistant', 'a')], [Message('assistant', 'a')], []])])
+    chunks = [[m.content for m in rsp] for rsp in llm.chat([Message('user', 'hi')], delta_stream=True)]
+    assert chunks == [['a'], ['a']]
+
+
+def test_message_dumper():
+    dumper = MessageDumper()
+    msg = Message('assistant', 'Hello')
+    first = dumper.dump([msg])
+    second = dumper.dump([msg, Message('function', 'result', name='my_tool')])
+    assert second[0] is first[0]
+    msg.name = 'bot'
+    assert dumper.dump([msg])[0]['name'] == 'bot'
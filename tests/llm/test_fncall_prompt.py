@@ -0,0 +1,117 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import json
+
+import pytest
+
+from qwen_agent.llm.fncall_prompts import nous_fncall_prompt, qwen_fncall_prompt
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
+from qwen_agent.tools.base import BaseTool
+
+FUNCTIONS = [{
+    'name': 'get_weather',
+    'description': 'Get the weather of a city',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'location': {
+                'type': 'string'
+            }
+        },
+        'required': ['location'],
+    },
+}]
+
+
+def _build_messages():
+    return [
+        Message(role=SYSTEM, content=[ContentItem(text='You are a helpful assistant.')]),
+        Message(role=USER, content=[ContentItem(text='How is the weather in Hangzhou?')]),
+        Message(role=ASSISTANT,
+                content=[],
+                function_call=FunctionCall(name='get_weather', arguments='{"location": "Hangzhou"}')),
+        Message(role=FUNCTION, name='get_weather', content=[ContentItem(text='Sunny')]),
+        Message(role=ASSISTANT, content=[ContentItem(text='It is sunny.')]),
+        Message(role=USER, content=[ContentItem(text='And tomorrow?')]),
+    ]
+
+
+@pytest.mark.parametrize('module,prompt_cls', [
+    (nous_fncall_prompt, nous_fncall_prompt.NousFnCallPrompt),
+    (qwen_fncall_prompt, qwen_fncall_prompt.QwenFnCallPrompt),
+])
+def test_preprocess_fncall_messages_cache(module, prompt_cls, monkeypatch):
+    num_renders = []
+    render_tool_system = module._render_tool_system
+
+    def _render_tool_system(*args, **kwargs):
+        num_renders.append(1)
+        return render_tool_system(*args, **kwargs)
+
+    monkeypatch.setattr(module, '_render_tool_system', _render_tool_system)
+
+    messages = _build_messages()
+    functions = copy.deepcopy(FUNCTIONS)
+    functions[0]['description'] += f' ({prompt_cls.__name__})'  # Not rendered by the other tests
+    outputs = []
+    for _ in range(3):
+        outputs.append(prompt_cls().preprocess_fncall_messages(messages, functions=functions, lang='en'))
+
+    # The input messages are left intact
+    assert messages == _build_messages()
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert 'get_weather' in outputs[0][0].content[-1].text
+    assert len(num_renders) == 1
+
+    # A different function list is rendered again
+    functions[0]['description'] += '.'
+    prompt_cls().preprocess_fncall_messages(messages, functions=functions, lang='en')
+    assert len(num_renders) == 2
+
+
+def test_tool_function_hashed_once(monkeypatch):
+
+    class WeatherTool(BaseTool):
+        name = FUNCTIONS[0]['name']
+        description = FUNCTIONS[0]['description'] + ' (hashed once)'
+        parameters = FUNCTIONS[0]['parameters']
+
+        def call(self, params, **kwargs):
+            return ''
+
+    tool = WeatherTool()
+    assert tool.function is tool.function
+    assert tool.function == {'name': tool.name, 'description': tool.description, 'parameters': tool.parameters}
+
+    messages = _build_messages()
+    prompt = nous_fncall_prompt.NousFnCallPrompt()
+    output = prompt.preprocess_fncall_messages(messages, functions=[tool.function], lang='en')
+
+    num_dumps = []
+    dumps = json.dumps
+
+    def _dumps(obj, *args, **kwargs):
+        if (obj == tool.function) or (obj == [tool.function]):
+            num_dumps.append(1)
+        return dumps(obj, *args, **kwargs)
+
+    monkeypatch.setattr(json, 'dumps', _dumps)
+    assert prompt.preprocess_fncall_messages(messages, functions=[tool.function], lang='en') == output
+    assert not num_dumps
+
+    # Replacing an attribute builds a new function dict
+    tool.description += '.'
+    assert tool.function['description'] == tool.description
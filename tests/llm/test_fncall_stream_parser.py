@@ -0,0 +1,70 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from qwen_agent.llm.fncall_prompts.nous_fncall_prompt import NousFnCallPrompt, NousFnCallStreamParser
+from qwen_agent.llm.fncall_prompts.qwen_fncall_prompt import QwenFnCallPrompt, QwenFnCallStreamParser
+from qwen_agent.llm.schema import ContentItem, Message
+
+
+def test_stream_parser_chunks():
+    cases = [
+        (NousFnCallStreamParser, 'Let me check.\n<tool_call>\n{"name": "a", "arguments": {"x": 1}}\n</tool_call>\n'
+         '<tool_call>\n{"name": "b", "arguments": {"y": "z"}}\n</tool_call>'),
+        (QwenFnCallStreamParser, 'Let me check.\n✿FUNCTION✿: a\n✿ARGS✿: {"x": 1}\n✿ARGS✿: {"x": 2} <!-- c -->\n'
+         '✿FUNCTION✿: b\n✿ARGS✿: {"y": "z"}\n'),
+    ]
+    for parser_cls, text in cases:
+        for step in (1, 3, 7):
+            parser = parser_cls()
+            for k in list(range(0, len(text), step)) + [len(text)]:
+                parser.feed(text[:k])
+                # The same as parsing the text from scratch
+                expected = parser_cls()
+                expected.feed(text[:k])
+                assert parser.segments == expected.segments
+    assert parser.segments == ['Let me check.', None, ('a', '{"x": 1}'), ('a', '{"x": 2}'), ('b', '{"y": "z"}')]
+
+
+def test_stream_parser_open_tool_call():
+    parser = NousFnCallStreamParser()
+    parser.feed('<tool_call>\n{"name": "a", "arguments": {"x": "')
+    assert parser.segments == [('a', '{"x": ')]
+    assert parser.open_state['args_start'] == len('<tool_call>\n{"name": "a", "arguments": ')
+    parser.feed('<tool_call>\n{"name": "a", "arguments": {"x": "y"}}')
+    assert parser.segments == [('a', '{"x": "y"}')]
+
+
+def test_qwen_stream_parser_rollback():
+    parser = QwenFnCallStreamParser()
+    parser.feed('✿FUNCTION✿: a\n✿ARGS✿: {}\n✿FUNCTION✿: b')
+    assert parser.segments == [('a', '{}'), ('b', '')]
+    parser.feed('✿FUNCTION✿: a\n✿ARGS✿: {"x": 1}')  # not an extension of the previous text
+    assert parser.segments == [('a', '{"x": 1}')]
+
+
+def test_postprocess_fncall_messages_incrementally():
+    cases = [
+        (NousFnCallPrompt(),
+         'Hi.\n<tool_call>\n{"name": "a", "arguments": {x: 1,}}\n</tool_call>\n<tool_call>\n{"name'),
+        (QwenFnCallPrompt(), 'Hi.\n✿FUNCTION✿: a\n✿ARGS✿: {"x": 1}\n✿FUNCTION✿: b\n✿ARGS✿: {"y": 2} <!-- c -->'),
+    ]
+    expected_fn_calls = [[('a', '{"x": 1}')], [('a', '{"x": 1}'), ('b', '{"y": 2}')]]
+    for (fncall_prompt, text), expected_fn_call in zip(cases, expected_fn_calls):
+        stream_state = {}
+        for k in range(len(text) + 1):
+            messages = [Message(role='assistant', content=[ContentItem(text=text[:k])])]
+            expected = fncall_prompt.postprocess_fncall_messages(messages)
+            assert fncall_prompt.postprocess_fncall_messages(messages, stream_state=stream_state) == expected
+        fn_calls = [(m.function_call.name, m.function_call.arguments) for m in expected if m.function_call]
+        assert fn_calls == expected_fn_call
@@ -12,11 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import os
 
 import pytest
 
 from qwen_agent.llm import get_chat_model
+from qwen_agent.llm.oai import get_openai_client
 from qwen_agent.llm.schema import Message
 
 functions = [{
@@ -65,3 +67,39 @@ def test_llm_oai(functions, stream, delta_stream):
         assert response[-1].function_call.name == 'image_gen'
     else:
         assert response[-1].function_call is None
+
+
+@pytest.mark.parametrize('functions', [None, functions])
+@pytest.mark.parametrize('stream', [True, False])
+def test_llm_oai_achat(functions, stream):
+    llm_cfg = {
+        'model': 'qwen2-7b-instruct',
+        'model_server': 'https://dashscope.aliyuncs.com/compatible-mode/v1',
+        'api_key': os.getenv('DASHSCOPE_API_KEY', 'none')
+    }
+    llm = get_chat_model(llm_cfg)
+
+    async def _achat():
+        response = await llm.achat(messages=[Message('user', 'draw a cute cat')], functions=functions, stream=stream)
+        if stream:
+            async for rsp in response:
+                pass
+            response = rsp
+        return response
+
+    response = asyncio.run(_achat())
+    assert isinstance(response[-1]['content'], str)
+    if functions:
+        assert response[-1].function_call.name == 'image_gen'
+    else:
+        assert response[-1].function_call is None
+
+
+def test_llm_oai_shared_client():
+    llm_cfg = {'model': 'qwen2-7b-instruct', 'model_server': 'http://127.0.0.1:8000/v1', 'api_key': 'EMPTY'}
+    client = get_openai_client(base_url=llm_cfg['model_server'], api_key=llm_cfg['api_key'])
+    assert client is get_openai_client(base_url=llm_cfg['model_server'], api_key=llm_cfg['api_key'])
+    assert client is not get_openai_client(base_url=llm_cfg['model_server'], api_key='another-key')
+    assert client is not get_openai_client(http_client_cfg={'max_connections': 8},
+                                           base_url=llm_cfg['model_server'],
+                                           api_key=llm_cfg['api_key'])
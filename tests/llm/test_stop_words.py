@@ -0,0 +1,41 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from qwen_agent.llm.base import StopWordMatcher, _postprocess_stop_words
+from qwen_agent.llm.schema import ContentItem, Message
+
+
+def test_stop_word_matcher():
+    matcher = StopWordMatcher(['Observation:', 'bc', 'abcd'])
+    assert matcher.partial_stop == ('Observation',)
+    assert matcher.find('no stop word') == -1
+    assert matcher.find('xxabcd') == 2  # the stop word that starts first wins
+    assert matcher.strip_partial_stop_word('Action Input: {}\nObservation') == 'Action Input: {}\n'
+
+    text = 'Thought: ok\nAction: search\nAction Input: {}\nObservation: found'
+    for n in range(len(text) + 1):
+        k = matcher.find(text[:n], key='text')
+        assert k == StopWordMatcher(matcher.stop).find(text[:n])
+
+
+def test_postprocess_stop_words_incrementally():
+    stop = ['Observation:', '✿RESULT✿']
+    text = 'Thought: I need to search.\nAction: search\nAction Input: {"q": 1}\nObservation: found it'
+    matcher = StopWordMatcher(stop)
+    for n in range(len(text) + 1):
+        messages = [Message(role='assistant', content=[ContentItem(text=text[:n])])]
+        expected = _postprocess_stop_words(messages, stop=stop)
+        assert _postprocess_stop_words(messages, stop=stop, matcher=matcher) == expected
+        assert messages[0].content[0].text == text[:n]  # the input is left intact
+    assert expected[0].content[0].text == 'Thought: I need to search.\nAction: search\nAction Input: {"q": 1}\n'
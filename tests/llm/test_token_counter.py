@@ -0,0 +1,81 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+
+from qwen_agent.llm.base import MessageTokenCounter, _truncate_input_messages_roughly
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, FunctionCall, Message
+from qwen_agent.utils.tokenization_qwen import tokenizer
+from qwen_agent.utils.utils import extract_text_from_message
+
+
+def _build_messages(num_turns: int):
+    messages = [Message(role=SYSTEM, content='You are a helpful assistant.')]
+    for i in range(num_turns):
+        messages.append(Message(role=USER, content=f'Question {i}: ' + 'how is the weather today? ' * 20))
+        messages.append(
+            Message(role=ASSISTANT,
+                    content=f'Checking the weather of day {i}.',
+                    function_call=FunctionCall(name='get_weather', arguments=f'{{"day": {i}}}')))
+        messages.append(Message(role=FUNCTION, name='get_weather',
+                                content=f'Result {i}: ' + 'sunny, 25 degrees. ' * 50))
+        messages.append(Message(role=ASSISTANT, content=f'Answer {i}: it is sunny.'))
+    return messages
+
+
+def test_message_token_counter(monkeypatch):
+    messages = _build_messages(num_turns=2)
+    expected = [tokenizer.count_tokens(extract_text_from_message(msg, add_upload_info=True)) for msg in messages]
+
+    num_calls = []
+    encode = tokenizer.encode
+
+    def _encode(text):
+        num_calls.append(text)
+        return encode(text)
+
+    # Only encoded on misses, without another memo in the tokenizer
+    monkeypatch.setattr(tokenizer, 'count_tokens', None)
+    monkeypatch.setattr(tokenizer, 'encode', _encode)
+
+    counter = MessageTokenCounter(maxsize=16)
+    counts = [counter.count(msg) for msg in messages]
+    assert counts == expected
+    assert len(num_calls) == len(messages)
+
+    # The copied and rebuilt messages hit the cache.
+    assert [counter.count(msg) for msg in copy.deepcopy(messages)] == counts
+    assert [counter.count(Message(**msg.model_dump())) for msg in messages] == counts
+    assert len(num_calls) == len(messages)
+
+    # The least recently used counts are evicted.
+    counter = MessageTokenCounter(maxsize=2)
+    for msg in messages[:3]:
+        counter.count(msg)
+    num_calls.clear()
+    counter.count(messages[0])
+    counter.count(messages[2])
+    assert len(num_calls) == 1
+
+
+def test_truncate_with_token_counter():
+    counter = MessageTokenCounter()
+    messages = _build_messages(num_turns=8)
+    for max_tokens in [300, 1000, 3000, 100000]:
+        expected = _truncate_input_messages_roughly(messages, max_tokens=max_tokens)
+        for _ in range(2):
+            truncated = _truncate_input_messages_roughly(copy.deepcopy(messages),
+                                                         max_tokens=max_tokens,
+                                                         token_counter=counter)
+            assert truncated == expected
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import shutil
+
 from qwen_agent.tools import DocParser
+from qwen_agent.tools.doc_parser import SENTENCE_SPLIT_PATTERN, _iter_last_sentences, _split_to_sentences
+from qwen_agent.tools.simple_doc_parser import SimpleDocParser
 
 
 def test_doc_parser():
@@ -21,5 +25,45 @@ def test_doc_parser():
     print(res)
 
 
+def test_doc_parser_content_cache(tmp_path):
+    tool = DocParser({'path': str(tmp_path / 'doc_parser')})
+    tool.doc_extractor = SimpleDocParser({'structured_doc': True, 'path': str(tmp_path / 'simple_doc_parser')})
+
+    file_a, file_b = str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')
+    with open(file_a, 'w') as f:
+        f.write('Hello world.')
+    shutil.copy(file_a, file_b)
+
+    res_a = tool.call({'url': file_a})
+    res_b = tool.call({'url': file_b})
+    assert res_b['url'] == file_b
+    assert res_b['title'] == 'b.txt'
+    assert res_b['raw'][0]['metadata']['source'] == file_b
+    assert res_b['raw'][0]['content'] == res_a['raw'][0]['content']
+    # The same content is parsed only once
+    assert tool.doc_extractor.db.scan('').count('_ori: ') == 1
+    # The keyword index is saved along with the chunks
+    assert tool.db.scan('').count('/keyword_index_v') == 1
+
+    with open(file_a, 'w') as f:
+        f.write('Goodbye world, the file has changed.')
+    res_a = tool.call({'url': file_a})
+    assert 'Goodbye' in res_a['raw'][0]['content']
+
+
+def test_split_to_sentences():
+    res = _split_to_sentences('Hello world. 你好世界。The end', max_token=100)
+    assert res == [['Hello world', 2], ['你好世界', 2], ['The end', 2]]
+
+    # The sentences longer than max_token are split into pieces
+    res = _split_to_sentences('one two three four five six seven. Eight', max_token=3)
+    assert res == [['one two three', 3], [' four five six', 3], [' seven', 1], ['Eight', 1]]
+
+
+def test_iter_last_sentences():
+    for text in ['', 'a', 'a. b。c', '. 。', 'a.  b. 。 c。。d. ', 'x. y..  z']:
+        assert list(_iter_last_sentences(text)) == SENTENCE_SPLIT_PATTERN.split(text)[::-1]
+
+
 if __name__ == '__main__':
     test_doc_parser()
@@ -12,7 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import random
+
 from qwen_agent.tools import KeywordSearch
+from qwen_agent.tools.doc_parser import Chunk, Record
+from qwen_agent.tools.search_tools.keyword_search import (BM25Corpus, KeywordIndex, get_keyword_index,
+                                                          get_keyword_index_key, split_text_into_keywords)
+from qwen_agent.tools.storage import Storage
 
 
 def test_keyword_search():
@@ -30,5 +36,51 @@ def test_keyword_search():
     print(res)
 
 
+def test_bm25_index_matches_rank_bm25(tmp_path):
+    from rank_bm25 import BM25Okapi
+
+    rng = random.Random(0)
+    vocab = [f'word{i}' for i in range(40)]
+    docs = []
+    for d in range(3):
+        chunks = []
+        for c in range(rng.randint(1, 30)):
+            content = ' '.join(rng.choice(vocab[:rng.randint(5, 40)]) for _ in range(rng.randint(1, 50)))
+            chunks.append(Chunk(content=content, metadata={'source': f'doc{d}', 'chunk_id': c}, token=10))
+        docs.append(Record(url=f'doc{d}', raw=chunks, title=''))
+    all_chunks = [chk for doc in docs for chk in doc.raw]
+    bm25 = BM25Okapi([split_text_into_keywords(chk.content) for chk in all_chunks])
+    corpus = BM25Corpus([KeywordIndex.build([chk.content for chk in doc.raw]) for doc in docs])
+
+    for _ in range(20):
+        query = [rng.choice(vocab) for _ in range(rng.randint(1, 5))]
+        expected = list(bm25.get_scores(query))
+        assert corpus.get_scores(query) == expected
+        ranking = sorted(range(len(expected)), key=lambda i: expected[i], reverse=True)
+        top = corpus.top_k(query, 5)
+        if top is not None:
+            assert [i for i, _ in top] == [i for i in ranking[:5] if expected[i] > 0]
+
+    tool = KeywordSearch({'index_path': str(tmp_path)})
+    query = ' '.join(vocab[:3])
+    chunk_and_score = tool.sort_by_scores(query, docs)
+    ranking = sorted(zip(all_chunks, bm25.get_scores(vocab[:3])), key=lambda x: x[1], reverse=True)
+    assert chunk_and_score == [(c.metadata['source'], c.metadata['chunk_id'], s) for c, s in ranking]
+    assert tool.search(query, docs, max_ref_token=30) == KeywordSearch().get_topk(chunk_and_score, docs, 30)
+
+
+def test_partial_record_index_not_persisted(tmp_path):
+    db = Storage({'storage_root_path': str(tmp_path)})
+    chunks = [Chunk(content='parsed so far', metadata={'source': 'doc', 'chunk_id': 0, 'partial': True}, token=3)]
+    partial = Record(url='doc', raw=chunks, title='')
+    get_keyword_index(partial, db=db)
+    assert not db.scan('')
+
+    chunks = [Chunk(content='all parsed', metadata={'source': 'doc', 'chunk_id': 0}, token=2)]
+    complete = Record(url='doc', raw=chunks, title='')
+    get_keyword_index(complete, db=db)
+    assert db.get(get_keyword_index_key(complete))
+
+
 if __name__ == '__main__':
     test_keyword_search()
@@ -0,0 +1,64 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import anyio
+
+from qwen_agent.tools.mcp_manager import MCPClient, MCPManager
+
+
+class _BrokenSession:
+
+    def __init__(self):
+        self.num_calls = 0
+
+    async def send_ping(self):
+        pass
+
+    async def call_tool(self, tool_name, tool_args):
+        self.num_calls += 1
+        raise anyio.ClosedResourceError()
+
+
+def test_mcp_reconnect_at_most_once(monkeypatch):
+    session = _BrokenSession()
+    num_reconnects = []
+
+    async def _reconnect(self):
+        num_reconnects.append(1)
+        new_client = MCPClient()
+        new_client.client_id = self.client_id
+        new_client.session = session
+        new_client.mark_alive()
+        return new_client
+
+    monkeypatch.setattr(MCPClient, 'reconnect', _reconnect)
+    client = MCPClient()
+    client.client_id = 'test_mcp_reconnect'
+    client.session = session
+    client.mark_alive()
+    MCPManager().clients[client.client_id] = client
+    try:
+        # A non-idempotent call may have run, so it is not sent again after reconnecting
+        result = asyncio.run(client.execute_function('my_tool', {}))
+        assert 'not retried' in result
+        assert session.num_calls == 1 and len(num_reconnects) == 1
+
+        # An idempotent call is sent again, but only once
+        result = asyncio.run(client.execute_function('my_tool', {}, idempotent=True))
+        assert 'exception' in result
+        assert session.num_calls == 3 and len(num_reconnects) == 2
+    finally:
+        del MCPManager().clients[client.client_id]
@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from qwen_agent.tools import SimpleDocParser
+import os
+
+from qwen_agent.tools import SimpleDocParser, simple_doc_parser
 
 
 def test_simple_doc_parser():
@@ -21,5 +23,55 @@ def test_simple_doc_parser():
     print(res)
 
 
+def test_parse_pdf_in_parallel(monkeypatch):
+    pdf_path = os.path.join(os.path.dirname(__file__), '../../examples/resource/doc.pdf')
+    monkeypatch.setattr(simple_doc_parser, 'PDF_MIN_PAGES_PER_WORKER', 1)
+    parsed_pages = []
+    res = simple_doc_parser.parse_pdf(pdf_path, max_workers=2, on_pages=parsed_pages.extend)
+    assert [page['page_num'] for page in res] == [1, 2, 3]
+    assert parsed_pages == res
+    assert res == simple_doc_parser.parse_pdf_pages(pdf_path)
+
+
+def test_content_hash_of_url(tmp_path, monkeypatch):
+    file = tmp_path / 'doc.txt'
+    file.write_text('version 1')
+    headers, requests_sent = {}, []
+
+    class FakeResponse:
+
+        def __init__(self):
+            self.headers = dict(headers)
+
+    def fake_head(*args, **kwargs):
+        requests_sent.append('head')
+        return FakeResponse()
+
+    def fake_download(url):
+        requests_sent.append('get')
+        return str(file)
+
+    monkeypatch.setattr(simple_doc_parser.requests, 'head', fake_head)
+    tool = SimpleDocParser({'path': str(tmp_path / 'simple_doc_parser'), 'url_check_interval': 100})
+    monkeypatch.setattr(tool, '_download', fake_download)
+
+    url = 'https://example.com/doc.txt'
+    hash1 = tool.get_content_hash(url)
+    assert tool.get_content_hash(url) == hash1
+    assert requests_sent == ['head', 'get']  # Not checked again within the interval
+
+    tool.url_check_interval = 0
+    assert tool.get_content_hash(url) == hash1  # No validators, assumed unchanged
+    headers['ETag'] = 'v1'
+    assert tool.get_content_hash(url) == hash1
+    assert tool.get_content_hash(url) == hash1
+    assert requests_sent == ['head', 'get', 'head', 'head', 'head']
+
+    file.write_text('version 2')
+    headers['ETag'] = 'v2'
+    assert tool.get_content_hash(url) != hash1
+    assert requests_sent[-2:] == ['head', 'get']
+
+
 if __name__ == '__main__':
     test_simple_doc_parser()
@@ -13,10 +13,20 @@
 # limitations under the License.
 
 import json
+import multiprocessing
+import subprocess
+import sys
+import threading
+import time
 
+import jsonschema
 import pytest
 
-from qwen_agent.tools import AmapWeather, CodeInterpreter, ImageGen, Retrieval, Storage
+from qwen_agent.llm.schema import ContentItem
+from qwen_agent.tools import AmapWeather, CodeInterpreter, ImageGen, PythonExecutor, Retrieval, Storage
+from qwen_agent.tools.base import BaseTool, get_json_schema_validator
+from qwen_agent.tools.code_interpreter import KernelPool
+from qwen_agent.tools.storage import KeyNotExistsError
 
 
 # [NOTE] 不带“市”会出错
@@ -31,6 +41,57 @@ def test_code_interpreter():
     tool.call("print('hello qwen')")
 
 
+def test_kernel_pool():
+
+    class FakeClient:
+
+        def __init__(self):
+            self.num_resets = 0
+
+        def shutdown(self):
+            pass
+
+    def start_kernel(kernel_id: str):
+        time.sleep(0.2)
+        return FakeClient(), subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+
+    def reset_kernel(kc):
+        kc.num_resets += 1
+
+    pool = KernelPool(start_kernel=start_kernel, reset_kernel=reset_kernel, size=2, max_idle=1)
+    try:
+        kernel1 = pool.acquire()
+        kernel2 = pool.acquire()
+        assert kernel1 and kernel2 and (kernel1 is not kernel2)
+        time.sleep(0.6)
+        assert len(pool._idle) == 2  # Replenished in the background
+
+        pool.release(kernel1)
+        kernel1[1].wait(timeout=5)  # Terminated since the pool is full
+        assert kernel1[0].num_resets == 1
+
+        time.sleep(1.5)
+        assert not pool._idle  # Shut down after idling for too long
+        assert pool.acquire() is None
+        time.sleep(0.6)
+        assert len(pool._idle) == 2
+    finally:
+        pool.close()
+        pool.release(kernel2)
+    kernel2[1].wait(timeout=5)
+
+
+def test_python_executor():
+    tool = PythonExecutor({'timeout_length': 2, 'max_workers': 2, 'max_queue_size': 2})
+    assert tool.call("print('hello qwen')") == ('hello qwen', 'Done')
+
+    # A hung snippet is killed without affecting the others
+    hung = 'import signal\nsignal.signal(signal.SIGALRM, signal.SIG_IGN)\nwhile True: pass'
+    results = tool.batch_apply([hung] + [f'print({i})' for i in range(5)])
+    assert results == [('', 'Timeout Error')] + [(str(i), 'Done') for i in range(5)]
+    assert tool.apply('print(1 + 1)') == ('2', 'Done')
+
+
 def test_image_gen():
     tool = ImageGen()
     tool.call({'prompt': 'a dog'})
@@ -44,6 +105,63 @@ def test_retrieval():
     })
 
 
+@pytest.mark.parametrize('cfg', [{'parser_workers': 2}, {'ingestion_deadline': 60}])
+def test_retrieval_parallel_parsing(tmp_path, cfg):
+    files = []
+    for i in range(4):
+        files.append(str(tmp_path / f'{i}.txt'))
+        with open(files[-1], 'w') as f:
+            f.write(f'This is document {i}.')
+    files.insert(2, str(tmp_path / 'missing.txt'))
+
+    tool = Retrieval({**cfg, 'rag_searchers': ['keyword_search']})
+    records = tool._parse_files(files)
+    # The failed file is skipped, and the others are in the input order
+    assert [rec['url'] for rec in records] == [f for f in files if 'missing' not in f]
+    assert records[3]['raw'][0]['content'] == 'This is document 3.'
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='The patched parser must reach the workers')
+def test_retrieval_parallel_parsing_timeout(tmp_path, monkeypatch):
+    from qwen_agent.tools import retrieval
+    from qwen_agent.tools.doc_parser import DocParser
+
+    doc_parser_call = DocParser.call
+
+    def slow_call(self, params, **kwargs):
+        time.sleep(60 if 'stuck' in params['url'] else 1)
+        return doc_parser_call(self, params, **kwargs)
+
+    monkeypatch.setattr(DocParser, 'call', slow_call)
+    monkeypatch.setattr(retrieval, '_PARSER_POOLS', {})  # New workers with the patched parser
+
+    files = []
+    for i in range(6):
+        files.append(str(tmp_path / f'{i}.txt'))
+        with open(files[-1], 'w') as f:
+            f.write(f'This is document {i}.')
+    cfg = {'parser_workers': 2, 'parser_timeout': 2, 'rag_searchers': ['keyword_search']}
+
+    # The stuck files of other calls kill the shared pool twice, while the files of this call are queued or running
+    stuck_results = []
+
+    def stuck_calls():
+        for _ in range(2):
+            stuck_results.extend(Retrieval(cfg)._parse_files_in_parallel([str(tmp_path / 'stuck.txt')], {}))
+
+    stuck_call = threading.Thread(target=stuck_calls)
+    stuck_call.start()
+    time.sleep(0.2)
+    try:
+        results = Retrieval(cfg)._parse_files_in_parallel(files, {})
+        stuck_call.join()
+    finally:
+        for pool, _ in retrieval._PARSER_POOLS.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+    assert all(isinstance(res, TimeoutError) for res in stuck_results)
+    assert [res['raw'][0]['content'] for res in results] == [f'This is document {i}.' for i in range(6)]
+
+
 @pytest.mark.parametrize('operate', ['put'])
 def test_storage_put(operate):
     tool = Storage()
@@ -66,3 +184,153 @@ def test_storage_get_delete(operate):
     tool.call({'operate': operate, 'key': '345/456/11'})
 
     tool.call({'operate': operate, 'key': '/345/456/12'})
+
+
+@pytest.mark.parametrize('compression', ['', 'zlib'])
+def test_storage_sqlite(tmp_path, compression):
+    # The top-level text files written by the file backend are migrated to the database
+    Storage({'storage_root_path': str(tmp_path)}).put('old', 'old value')
+    (tmp_path / 'binary').write_bytes(b'\xff\xfe\x00')
+    (tmp_path / 'hash').mkdir()
+    (tmp_path / 'hash' / 'x.pdf').write_bytes(bytes(range(256)))
+
+    tool = Storage({'storage_root_path': str(tmp_path), 'backend': 'sqlite', 'compression': compression})
+    assert tool.get('old') == 'old value'
+    for key in ['binary', 'hash/x.pdf']:
+        with pytest.raises(KeyNotExistsError):
+            tool.get(key)
+    tool.put_many({'a/b/1': 'x' * 5000, 'a/b/2': 'y', 'ab': 'z'})
+    assert tool.get('a/b/1') == 'x' * 5000
+    assert tool.call({'operate': 'scan', 'key': '/a/b'}) == '/1: ' + 'x' * 5000 + '\n/2: y'
+    assert tool.call({'operate': 'scan', 'key': '/ab'}).startswith('Scan Failed')
+    assert tool.call({'operate': 'delete', 'key': '/a/b/2'}) == 'Successfully deleted a/b/2'
+    with pytest.raises(KeyNotExistsError):
+        tool.get('a/b/2')
+
+
+@pytest.mark.parametrize('schema', [
+    {
+        'type': 'object',
+        'properties': {
+            'query': {
+                'type': 'string'
+            },
+            'top_k': {
+                'type': 'integer'
+            },
+            'mode': {
+                'type': 'string',
+                'enum': ['fast', 'exact']
+            },
+        },
+        'required': ['query'],
+    },
+    {
+        'type': 'object',
+        'properties': {
+            'query': {
+                'type': 'string',
+                'minLength': 1
+            },
+            'top_k': {
+                'type': ['integer', 'null']
+            },
+            'mode': {
+                'enum': ['fast', 'exact', 1]
+            },
+        },
+        'required': ['query'],
+    },
+])
+def test_json_schema_validator(schema):
+    validator = get_json_schema_validator(schema)
+    assert get_json_schema_validator(json.loads(json.dumps(schema))) is validator
+
+    instances = [
+        '{"query": "a"}', '{"query": "a", "top_k": 3, "mode": "fast"}', '{}', '{"query": 1}',
+        '{"query": "a", "top_k": true}', '{"query": "a", "top_k": 1.5}', '{"query": "a", "mode": "slow"}',
+        '{"query": "a", "mode": 1}', '[]'
+    ]
+    for instance in map(json.loads, instances):
+        try:
+            jsonschema.validate(instance=instance, schema=schema)
+            expected = None
+        except jsonschema.ValidationError as e:
+            expected = e.message
+        try:
+            validator.validate(instance)
+            error = None
+        except jsonschema.ValidationError as e:
+            error = e.message
+        assert error == expected
+
+    class SearchTool(BaseTool):
+        name = 'search'
+        parameters = schema
+
+        def call(self, params, **kwargs):
+            return self._verify_json_format_args(params)
+
+    tool = SearchTool()
+    assert tool.call('{"query": "a"}') == {'query': 'a'}
+    with pytest.raises(jsonschema.ValidationError):
+        tool.call('{"top_k": 3}')
+
+    with pytest.raises(jsonschema.SchemaError):
+        get_json_schema_validator({'type': 'object', 'properties': {'query': {'type': 'text'}}})
+
+
+def test_tool_result_cache(tmp_path):
+    calls = []
+
+    class LookupTool(BaseTool):
+        name = 'test_result_cache_lookup'
+        parameters = {'type': 'object', 'properties': {'key': {'type': 'string'}}, 'required': ['key']}
+        idempotent = True
+        cache_ttl = 0.5
+
+        def call(self, params, **kwargs):
+            key = self._verify_json_format_args(params)['key']
+            calls.append(key)
+            if key == 'image':
+                return [ContentItem(image='a.png'), ContentItem(text=key)]
+            return {'key': key}
+
+    tool, other_tool = LookupTool(), LookupTool()
+    assert tool.result_cache is other_tool.result_cache  # Shared by the agents using the tool
+    assert tool.call_with_cache('{"key": "a"}') == {'key': 'a'}
+    assert other_tool.call_with_cache({'key': 'a'}, messages=[]) == {'key': 'a'}
+    assert tool.call_with_cache('{"key": "a"}', files=['a.txt']) == {'key': 'a'}
+    assert tool.call_with_cache('{"key": "image"}') == tool.call_with_cache('{"key": "image"}')
+    assert isinstance(tool.call_with_cache('{"key": "image"}')[0], ContentItem)
+    assert calls == ['a', 'a', 'image']
+    stats = tool.result_cache.stats()
+    assert (stats['hits'], stats['misses']) == (3, 3)
+
+    time.sleep(0.6)
+    tool.call_with_cache('{"key": "a"}')
+    assert calls == ['a', 'a', 'image', 'a']
+
+    # The disk tier keeps the results across processes, if diskcache is installed
+    cfg = {'cache_dir': str(tmp_path / 'cache'), 'cache_cfg': {'ttl': None}}
+    tool = LookupTool(cfg)
+    tool.call_with_cache('{"key": "b"}')
+    tool.result_cache._memory.clear()
+    tool.call_with_cache('{"key": "b"}')
+    if tool.result_cache.stats()['disk_hits']:
+        assert calls == ['a', 'a', 'image', 'a', 'b']
+
+    # The tools with different cfg, e.g., another API token, do not share results even in the same disk tier
+    tool = LookupTool({**cfg, 'token': 'another'})
+    assert tool.result_cache is not LookupTool(cfg).result_cache
+    tool_with_limit = LookupTool({'name': 'test_result_cache_lookup', 'max_concurrency': 2})
+    assert tool_with_limit.result_cache is other_tool.result_cache
+    num_calls = len(calls)
+    tool.call_with_cache('{"key": "b"}')
+    assert len(calls) == num_calls + 1
+
+    tool = LookupTool({'idempotent': False})
+    assert tool.result_cache is None
+    tool.call_with_cache('{"key": "c"}')
+    tool.call_with_cache('{"key": "c"}')
+    assert calls[-2:] == ['c', 'c']
@@ -12,7 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import pickle
+import sys
+import types
+
+import numpy as np
+
 from qwen_agent.tools import VectorSearch
+from qwen_agent.tools.doc_parser import Chunk, Record
+from qwen_agent.tools.search_tools import vector_search
 
 
 def test_vector_search():
@@ -30,5 +38,85 @@ def test_vector_search():
     print(res)
 
 
+def test_vector_search_cached_embeddings(tmp_path, monkeypatch):
+    docs = []
+    for d in range(3):
+        metadata = [{'source': f'doc{d}', 'chunk_id': c} for c in range(8)]
+        chunks = [
+            Chunk(content=f'doc {d} chunk {c} about topic{c % 4}', metadata=metadata[c], token=10) for c in range(8)
+        ]
+        docs.append(Record(url=f'doc{d}', raw=chunks, title=''))
+
+    tool = VectorSearch({'embedding': 'hash', 'index_path': str(tmp_path)})
+    embedder = tool.embedder
+    query_vec = embedder.embed_query('topic1')
+    expected = {(chk.metadata['source'], chk.metadata['chunk_id']): sum(
+        (x - y)**2 for x, y in zip(embedder.embed_query(chk.content), query_vec)) for doc in docs for chk in doc.raw}
+    res = tool.sort_by_scores('topic1', docs[:2])
+    assert len(res) == 16
+    res = tool.sort_by_scores('topic1', docs)  # Only the new doc is embedded and added to the index
+    assert len(res) == len(expected)
+    assert all(abs(dist - expected[(src, cid)]) < 1e-5 for src, cid, dist in res)
+    assert [dist for _, _, dist in res] == sorted(dist for _, _, dist in res)
+
+    # The embeddings are loaded from the storage by a new instance, without embedding the chunks again
+    vector_search._EMBEDDINGS_CACHE.clear()
+    tool = VectorSearch({'embedding': 'hash', 'index_path': str(tmp_path)})
+    monkeypatch.setattr(tool.embedder, 'embed_documents', None)
+    assert tool.sort_by_scores('topic1', docs) == res
+    assert tool.search('topic1', docs, max_ref_token=20) == tool.get_topk(res, docs, 20)
+
+
+def test_vector_search_persisted_ann_index(tmp_path, monkeypatch):
+    built = []
+
+    class FakeHNSWIndex:
+        """An exact index with the interface of faiss.IndexHNSWFlat used by VectorIndex."""
+
+        def __init__(self, dim, m):
+            built.append(self)
+            self.hnsw = types.SimpleNamespace(efSearch=16)
+            self.vectors = np.zeros((0, dim), dtype=np.float32)
+
+        @property
+        def ntotal(self):
+            return len(self.vectors)
+
+        def add(self, vectors):
+            self.vectors = np.concatenate([self.vectors, vectors])
+
+        def search(self, queries, k):
+            distances = ((self.vectors[None, :, :] - queries[:, None, :])**2).sum(axis=2)
+            ids = np.argsort(distances, axis=1, kind='stable')[:, :k]
+            return np.take_along_axis(distances, ids, axis=1), ids
+
+    fake_faiss = types.SimpleNamespace(
+        IndexHNSWFlat=FakeHNSWIndex,
+        serialize_index=lambda index: np.frombuffer(pickle.dumps(index.vectors), dtype=np.uint8),
+        deserialize_index=lambda data: _load_fake_index(FakeHNSWIndex, data),
+    )
+    monkeypatch.setitem(sys.modules, 'faiss', fake_faiss)
+
+    metadata = [{'source': 'doc', 'chunk_id': c} for c in range(40)]
+    chunks = [Chunk(content=f'chunk {c} about topic{c % 4}', metadata=metadata[c], token=10) for c in range(40)]
+    docs = [Record(url='doc', raw=chunks, title='')]
+    tool = VectorSearch({'embedding': 'hash', 'index_path': str(tmp_path), 'ann_threshold': 4})
+    res = tool.search('topic1', docs, max_ref_token=20)
+    assert len(built) == 1
+
+    # A new process loads the index of the corpus instead of building it again
+    vector_search._EMBEDDINGS_CACHE.clear()
+    tool = VectorSearch({'embedding': 'hash', 'index_path': str(tmp_path), 'ann_threshold': 4})
+    assert tool.search('topic1', docs, max_ref_token=20) == res
+    assert len(built) == 1
+
+
+def _load_fake_index(cls, data):
+    index = cls.__new__(cls)
+    index.hnsw = types.SimpleNamespace(efSearch=16)
+    index.vectors = pickle.loads(data.tobytes())
+    return index
+
+
 if __name__ == '__main__':
     test_vector_search()
@@ -0,0 +1,106 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import sys
+
+import pytest
+
+# The modules that `import qwen_agent.agents` must not import, since most deployments do not use them.
+HEAVY_MODULES = [
+    'openai',
+    'dashscope',
+    'pandas',
+    'mcp',
+    'qwen_agent.llm.oai',
+    'qwen_agent.llm.qwen_dashscope',
+    'qwen_agent.tools.code_interpreter',
+    'qwen_agent.tools.mcp_manager',
+]
+
+
+def _run_python(code: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True,
+                          text=True,
+                          check=True,
+                          timeout=300)
+
+
+def test_import_time():
+    proc = _run_python('import sys, qwen_agent.agents; print("\\n".join(sys.modules))')
+    imported = set(proc.stdout.split())
+    assert not [m for m in HEAVY_MODULES if m in imported]
+
+    # The last line of `-X importtime` is the cumulative time of the top-level import, in microseconds.
+    cumulative_us = int(proc.stderr.strip().splitlines()[-1].split('|')[1])
+    print(f'import qwen_agent.agents: {cumulative_us / 1e6:.3f}s')
+
+
+def test_lazy_lookup():
+    proc = _run_python(
+        'import sys\n'
+        'from qwen_agent.llm.base import LLM_REGISTRY\n'
+        'from qwen_agent.tools.base import TOOL_REGISTRY\n'
+        'assert "oai" in LLM_REGISTRY and "qwen_agent.llm.oai" not in sys.modules\n'
+        'print(LLM_REGISTRY["oai"].__name__, TOOL_REGISTRY["storage"].__name__)\n'
+        'print("qwen_agent.llm.qwen_dashscope" in sys.modules, "qwen_agent.tools.storage" in sys.modules)')
+    assert proc.stdout.split() == ['TextChatAtOAI', 'Storage', 'False', 'True']
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    (tmp_path / 'fake_registry.py').write_text(
+        'from qwen_agent.utils.lazy_registry import LazyRegistry\n'
+        'REGISTRY = LazyRegistry({"fake": "fake_backends", "broken": "no_such_module"})\n')
+    (tmp_path / 'fake_backends.py').write_text('from fake_registry import REGISTRY\n'
+                                               'class FakeBackend:\n'
+                                               '    pass\n'
+                                               'if not REGISTRY.is_overridden("fake", FakeBackend):\n'
+                                               '    REGISTRY["fake"] = FakeBackend\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for module in ['fake_registry', 'fake_backends']:
+        monkeypatch.delitem(sys.modules, module, raising=False)
+    import fake_registry
+    yield fake_registry.REGISTRY
+    for module in ['fake_registry', 'fake_backends']:
+        sys.modules.pop(module, None)
+
+
+def test_lazy_registry(registry):
+    assert ('fake' in registry) and ('missing' not in registry)
+    assert (registry.keys() == ['fake', 'broken']) and (len(registry) == 2)
+    assert (not registry.is_loaded('fake')) and ('fake_backends' not in sys.modules)
+
+    assert registry['fake'].__name__ == 'FakeBackend'
+    assert registry.is_loaded('fake') and ('fake_backends' in sys.modules)
+    assert registry.get('missing') is None
+    with pytest.raises(KeyError):
+        registry['missing']  # noqa
+    with pytest.raises(ImportError):
+        registry['broken']  # noqa
+
+
+def test_custom_class_overrides_builtin(registry):
+
+    class CustomBackend:
+        pass
+
+    assert registry.is_taken('fake', CustomBackend)
+    registry['fake'] = CustomBackend
+
+    # Importing the built-in module later does not replace the custom class
+    import fake_backends
+    assert registry.is_overridden('fake', fake_backends.FakeBackend)
+    assert registry['fake'] is CustomBackend
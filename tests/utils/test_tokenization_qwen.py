@@ -0,0 +1,69 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+from pathlib import Path
+
+from qwen_agent.utils import tokenization_qwen
+from qwen_agent.utils.tokenization_qwen import QWenTokenizer, tokenizer
+
+
+def test_count_tokens():
+    texts = ['', 'Hello world!', 'café <|im_end|> 你好世界。' * 50, 'x' * 1000]
+    expected = [len(tokenizer.tokenize(text)) for text in texts]
+    assert [tokenizer.count_tokens(text) for text in texts] == expected
+    assert tokenizer.count_tokens_batch(texts) == expected
+    assert tokenizer.encode(texts[2]) == tokenizer.convert_tokens_to_ids(tokenizer.tokenize(texts[2]))
+
+
+def test_count_tokens_memo():
+    tok = QWenTokenizer(Path(tokenization_qwen.__file__).parent / 'qwen.tiktoken', count_cache_size=2)
+    texts = [f'{i} ' * 200 for i in range(3)]
+    counts = tok.count_tokens_batch(texts)
+    # Only the most recently counted texts are kept
+    assert len(tok._count_cache) == 2
+    assert [tok.count_tokens(text) for text in texts] == counts
+    assert len(tok._count_cache) == 2
+
+
+def test_vocab_cache(tmp_path):
+    vocab_file = Path(tokenization_qwen.__file__).parent / 'qwen.tiktoken'
+    mergeable_ranks = tokenization_qwen._load_tiktoken_bpe(vocab_file, cache_dir=None)
+
+    # The first load writes the binary cache, which the second load reads
+    assert tokenization_qwen._load_tiktoken_bpe(vocab_file, cache_dir=str(tmp_path)) == mergeable_ranks
+    cache_files = list(tmp_path.glob('qwen.tiktoken.*.bin'))
+    assert len(cache_files) == 1
+    assert tokenization_qwen._read_bpe_cache(str(cache_files[0])) == mergeable_ranks
+
+    # A truncated cache is ignored
+    cache_files[0].write_bytes(cache_files[0].read_bytes()[:-1])
+    assert tokenization_qwen._read_bpe_cache(str(cache_files[0])) is None
+    assert tokenization_qwen._load_tiktoken_bpe(vocab_file, cache_dir=str(tmp_path)) == mergeable_ranks
+
+
+def test_lazy_loading():
+    tok = QWenTokenizer(Path(tokenization_qwen.__file__).parent / 'qwen.tiktoken')
+    assert 'tokenizer' not in tok.__dict__
+    assert tok.im_end_id == tokenizer.im_end_id
+
+    text = 'café <|im_end|> 你好世界。'
+    assert tok.tokenize(text) == tokenizer.tokenize(text)
+    assert 'tokenizer' in tok.__dict__
+    assert tok.mergeable_ranks == tokenizer.get_vocab()
+
+    # Only the configuration is pickled
+    tok2 = pickle.loads(pickle.dumps(tok))
+    assert 'tokenizer' not in tok2.__dict__
+    assert tok2.get_token_offsets(tok2.encode(text)) == tok.get_token_offsets(tok.encode(text))